@@ -0,0 +1,147 @@
+# Analysis service: territory, legal moves and a search of the latest posted position, worked out off the UI thread
+import multiprocessing
+import queue
+import threading
+from typing import Callable, NamedTuple, Optional
+import numpy as np
+from Pieces import *
+import ChessEngine
+import Search
+import Territory
+
+
+class AnalysisRequest(NamedTuple):
+    id: int  # increasing, a request supersedes every one with a lower id
+    position: bytes  # see GameState.getPackedPosition
+    history: tuple[int, ...]  # keys of the positions before it, so repetitions count as draws
+    maxTime: float
+
+
+class AnalysisResult(NamedTuple):
+    id: int  # of the request it answers
+    moves: list[str]  # legal moves in long notation
+    territory: np.ndarray  # (2, 8, 8) white and black attacker counts
+    move: Optional[str]  # best move found in long notation, None if there are no legal moves
+    score: int  # for the side to move, see Search.describeScore
+    depth: int
+    nodes: int
+    pv: list[str]
+
+
+def makeRequest(id: int, gs: ChessEngine.GameState, maxTime: float) -> AnalysisRequest:
+    history = tuple(gs.zobristUpdates) + tuple(record[3] for record in gs.pushedMoves)
+    return AnalysisRequest(id, gs.getPackedPosition(), history, maxTime)
+
+
+def analyse(request: AnalysisRequest, searcher: Search.Searcher, stopped: Callable[[], bool] = None) -> AnalysisResult:
+    gs = ChessEngine.GameState()
+    gs.setPackedPosition(request.position)
+    moves, _ = gs.getValidMoves()
+    counts = gs.territory.counts
+    territory = np.array((counts[WHITE], counts[BLACK]), dtype=Territory.HEATMAP_DTYPE)
+    result = searcher.search(gs, request.maxTime, stopped=stopped, history=request.history)
+    return AnalysisResult(request.id, [move.getLongNotation() for move in moves], territory,
+                          result.move.getLongNotation() if result.move else None, result.score, result.depth,
+                          result.nodes, [move.getLongNotation() for move in result.pv])
+
+
+def serve(requests: multiprocessing.Queue, results: multiprocessing.Queue, latest):
+    '''
+    Worker process loop: answer the newest waiting request, abandoning a search as soon as a newer one is posted.
+    None stops it
+    '''
+    searcher = Search.Searcher()
+    while True:
+        request = requests.get()
+        # only the newest of a backlog matters
+        while request is not None:
+            try:
+                request = requests.get_nowait()
+            except queue.Empty:
+                break
+        if request is None:
+            break
+        if request.id != latest.value:
+            continue
+        result = analyse(request, searcher, lambda: latest.value != request.id)
+        if request.id == latest.value:
+            results.put(result)
+    results.put(None)
+
+
+class AnalysisService():
+    '''
+    Analyses positions in a worker process. post supersedes any earlier request, whose search is stopped, and notify
+    is called (from a listener thread) when the result for the latest request arrives, which poll then returns
+    '''
+
+    def __init__(self, notify: Callable[[], None] = None) -> None:
+        self.notify = notify
+        self.nextId = 1
+        self.result: AnalysisResult = None
+        self.requests = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.latest = multiprocessing.Value('q', 0, lock=False)
+        self.worker = multiprocessing.Process(target=serve, args=(
+            self.requests, self.results, self.latest), daemon=True)
+        self.worker.start()
+        self.listener = threading.Thread(target=self.listen, daemon=True)
+        self.listener.start()
+
+    def post(self, gs: ChessEngine.GameState, maxTime: float = Search.DEFAULT_TIME) -> int:
+        '''
+        Ask for an analysis of gs's current position, returns the request id
+        '''
+        id = self.nextId
+        self.nextId += 1
+        self.latest.value = id
+        self.result = None
+        self.requests.put(makeRequest(id, gs, maxTime))
+        return id
+
+    def poll(self) -> Optional[AnalysisResult]:
+        '''
+        Result for the latest request, None until it has arrived
+        '''
+        result = self.result
+        return result if result is not None and result.id == self.latest.value else None
+
+    def listen(self):
+        while (result := self.results.get()) is not None:
+            if result.id == self.latest.value:
+                self.result = result
+                if self.notify is not None:
+                    self.notify()
+
+    def close(self):
+        self.latest.value = -1  # stops a search in progress
+        self.requests.put(None)
+        self.worker.join()
+        self.listener.join()
+
+
+class InlineAnalysis():
+    '''
+    Stand-in for AnalysisService that analyses in the calling thread as soon as a position is posted, for tests and
+    machines where a second process doesn't pay off
+    '''
+
+    def __init__(self, notify: Callable[[], None] = None) -> None:
+        self.notify = notify
+        self.nextId = 1
+        self.result: AnalysisResult = None
+        self.searcher = Search.Searcher()
+
+    def post(self, gs: ChessEngine.GameState, maxTime: float = Search.DEFAULT_TIME) -> int:
+        id = self.nextId
+        self.nextId += 1
+        self.result = analyse(makeRequest(id, gs, maxTime), self.searcher)
+        if self.notify is not None:
+            self.notify()
+        return id
+
+    def poll(self) -> Optional[AnalysisResult]:
+        return self.result
+
+    def close(self):
+        pass
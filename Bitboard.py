@@ -0,0 +1,331 @@
+# Bitboard move generation backend, selected per GameState with backend=BITBOARD_BACKEND
+# Squares are indexed row * 8 + col, so bit 0 is a8 and bit 63 is h1 (same orientation as GameState.board)
+from typing import Tuple
+from Pieces import *
+import ChessEngine
+
+# same order as the directions in GameState.checkForPinsAndChecks: 4 orthogonal then 4 diagonal
+DIRECTIONS = [(-1, 0), (0, -1), (1, 0), (0, 1),
+              (-1, -1), (-1, 1), (1, -1), (1, 1)]
+ORTHOGONAL = range(0, 4)
+DIAGONAL = range(4, 8)
+# rays pointing towards higher square indices find their first blocker with the lowest set bit
+POSITIVE = [dr * 8 + dc > 0 for dr, dc in DIRECTIONS]
+
+KNIGHT_OFFSETS = [(-2, -1), (-2, 1), (-1, -2), (-1, 2),
+                  (1, -2), (1, 2), (2, -1), (2, 1)]
+KING_OFFSETS = [(dr, dc) for dr in (-1, 0, 1)
+                for dc in (-1, 0, 1) if (dr, dc) != (0, 0)]
+
+# castling corners, a rook (or queen moving orthogonally) leaving these flags castleRightsChanged
+ROOK_CORNERS = {WHITE: (7 * 8 + 0, 7 * 8 + 7), BLACK: (0, 7)}
+KING_HOMES = {WHITE: 7 * 8 + 4, BLACK: 4}
+
+
+def _leaper(offsets: list[Tuple[int, int]]) -> list[int]:
+    table = []
+    for sq in range(64):
+        row, col = divmod(sq, 8)
+        bb = 0
+        for dr, dc in offsets:
+            if 0 <= row + dr < 8 and 0 <= col + dc < 8:
+                bb |= 1 << ((row + dr) * 8 + col + dc)
+        table.append(bb)
+    return table
+
+
+def _rays() -> list[list[int]]:
+    table = []
+    for dr, dc in DIRECTIONS:
+        rays = []
+        for sq in range(64):
+            row, col = divmod(sq, 8)
+            bb = 0
+            row, col = row + dr, col + dc
+            while 0 <= row < 8 and 0 <= col < 8:
+                bb |= 1 << (row * 8 + col)
+                row, col = row + dr, col + dc
+            rays.append(bb)
+        table.append(rays)
+    return table
+
+
+KNIGHT_ATTACKS = _leaper(KNIGHT_OFFSETS)
+KING_ATTACKS = _leaper(KING_OFFSETS)
+# squares a pawn of that colour standing on sq attacks
+PAWN_ATTACKS = {WHITE: _leaper([(-1, -1), (-1, 1)]),
+                BLACK: _leaper([(1, -1), (1, 1)])}
+RAYS = _rays()
+# (row, col) of every square index, looked up when building Move objects
+SQUARES = [divmod(sq, 8) for sq in range(64)]
+# the same tables as lists of square indices, iterating a list is cheaper than splitting the bits each time
+KNIGHT_TARGETS = [[sq for sq in range(64) if bb >> sq & 1] for bb in KNIGHT_ATTACKS]
+KING_TARGETS = [[sq for sq in range(64) if bb >> sq & 1] for bb in KING_ATTACKS]
+PAWN_TARGETS = {colour: [[sq for sq in range(64) if bb >> sq & 1] for bb in table]
+                for colour, table in PAWN_ATTACKS.items()}
+# RAY_TARGETS[dirIdx][sq] -> squares walking outward from sq, nearest first
+RAY_TARGETS = [[sorted((target for target in range(64) if RAYS[dirIdx][sq] >> target & 1),
+                       key=lambda target, sq=sq: abs(target - sq)) for sq in range(64)] for dirIdx in range(8)]
+
+
+def squares(bb: int):
+    '''
+    Yield the index of every set bit, lowest first
+    '''
+    while bb:
+        low = bb & -bb
+        yield low.bit_length() - 1
+        bb ^= low
+
+
+def firstBlocker(dirIdx: int, sq: int, occupied: int) -> int:
+    '''
+    Square of the first occupied square from sq in a direction, -1 if the ray runs off the board
+    '''
+    blockers = RAYS[dirIdx][sq] & occupied
+    if not blockers:
+        return -1
+    if POSITIVE[dirIdx]:
+        return (blockers & -blockers).bit_length() - 1
+    return blockers.bit_length() - 1
+
+
+class BitboardPosition():
+    '''
+    Piece, colour and occupancy bitboards of a board, kept on GameState and brought up to date after every move by
+    update rather than rebuilt
+    '''
+
+    def __init__(self, board: list[list[str]]) -> None:
+        self.pieces = {piece: 0 for piece in PIECES}
+        self.colours = {WHITE: 0, BLACK: 0}
+        # piece on every square as of the last update, so update knows which bits to clear
+        self.mailbox = [EMPTY] * 64
+        self.update(board, SQUARES)
+
+    def update(self, board: list[list[str]], changedSquares: list[Tuple[int, int]]):
+        '''
+        Bring the bitboards in line with board after the pieces on changedSquares were moved, captured or restored
+        '''
+        pieces = self.pieces
+        colours = self.colours
+        mailbox = self.mailbox
+        for row, col in changedSquares:
+            sq = row * 8 + col
+            before, after = mailbox[sq], board[row][col]
+            if before == after:
+                continue
+            bit = 1 << sq
+            if before != EMPTY:
+                pieces[before] ^= bit
+                colours[before[0]] ^= bit
+            if after != EMPTY:
+                pieces[after] |= bit
+                colours[after[0]] |= bit
+            mailbox[sq] = after
+        self.occupied = colours[WHITE] | colours[BLACK]
+
+    def attackers(self, sq: int, allyColour: str, occupied: int) -> int:
+        '''
+        Number of enemy pieces attacking sq through the given occupancy
+        '''
+        enemyColour = BLACK if allyColour == WHITE else WHITE
+        pieces = self.pieces
+        orthogonal = pieces[enemyColour + ROOK] | pieces[enemyColour + QUEEN]
+        diagonal = pieces[enemyColour + BISHOP] | pieces[enemyColour + QUEEN]
+        count = (KNIGHT_ATTACKS[sq] & pieces[enemyColour + KNIGHT]).bit_count() + \
+            (PAWN_ATTACKS[allyColour][sq] & pieces[enemyColour + PAWN]).bit_count() + \
+            (KING_ATTACKS[sq] & pieces[enemyColour + KING]).bit_count()
+        for dirIdx in ORTHOGONAL:
+            blocker = firstBlocker(dirIdx, sq, occupied)
+            if blocker != -1 and orthogonal >> blocker & 1:
+                count += 1
+        for dirIdx in DIAGONAL:
+            blocker = firstBlocker(dirIdx, sq, occupied)
+            if blocker != -1 and diagonal >> blocker & 1:
+                count += 1
+        return count
+
+
+def checkForPinsAndChecks(gs) -> Tuple[bool, list, list]:
+    '''
+    Same pins and checks as GameState.checkForPinsAndChecks, found by walking blockers instead of squares
+    '''
+    position = gs.bitboards
+    if gs.whiteToMove:
+        allyColour, enemyColour = WHITE, BLACK
+        kingRow, kingCol = gs.whiteKingLoc
+    else:
+        allyColour, enemyColour = BLACK, WHITE
+        kingRow, kingCol = gs.blackKingLoc
+    kingSq = kingRow * 8 + kingCol
+    pieces = position.pieces
+    ally = position.colours[allyColour]
+    # our own king never blocks its rays, the list backend skips it the same way
+    occupied = position.occupied & ~pieces[allyColour + KING]
+    orthogonal = pieces[enemyColour + ROOK] | pieces[enemyColour + QUEEN]
+    diagonal = pieces[enemyColour + BISHOP] | pieces[enemyColour + QUEEN]
+    adjacent = (PAWN_ATTACKS[allyColour][kingSq] & pieces[enemyColour + PAWN]) | \
+        (KING_ATTACKS[kingSq] & pieces[enemyColour + KING])
+
+    pins = []
+    checks = []
+    for dirIdx, (dr, dc) in enumerate(DIRECTIONS):
+        sliders = orthogonal if dirIdx in ORTHOGONAL else diagonal
+        blocker = firstBlocker(dirIdx, kingSq, occupied)
+        if blocker == -1:
+            continue
+        if ally >> blocker & 1:
+            pinner = firstBlocker(dirIdx, blocker, occupied)
+            if pinner != -1 and sliders >> pinner & 1:
+                pins.append((*SQUARES[blocker], dr, dc))
+        elif sliders >> blocker & 1 or adjacent >> blocker & 1:
+            checks.append((*SQUARES[blocker], dr, dc))
+
+    for sq in squares(KNIGHT_ATTACKS[kingSq] & pieces[enemyColour + KNIGHT]):
+        row, col = SQUARES[sq]
+        checks.append((row, col, row - kingRow, col - kingCol))
+
+    return len(checks) > 0, pins, checks
+
+
+def getAllPossibleMoves(gs) -> Tuple[list, list]:
+    '''
+    All moves without considering checks, the same sets GameState.getAllPossibleMoves builds from the board list
+    '''
+    position = gs.bitboards
+    board = gs.board
+    Move = ChessEngine.Move
+    allyColour, enemyColour = (WHITE, BLACK) if gs.whiteToMove else (BLACK, WHITE)
+    pieces = position.pieces
+    ally = position.colours[allyColour]
+    enemy = position.colours[enemyColour]
+    occupied = position.occupied
+    pins = {pin[0] * 8 + pin[1]: (pin[2], pin[3]) for pin in gs.pins}
+    moves: list[Move] = []
+    protectionMoves: list[Move] = []
+
+    # pawns
+    if gs.whiteToMove:
+        moveAmount, startRow, backRow = -1, 6, 0
+    else:
+        moveAmount, startRow, backRow = 1, 1, 7
+    enPassantSq = gs.enPassantPossible[0] * 8 + \
+        gs.enPassantPossible[1] if gs.enPassantPossible else -1
+    for sq in squares(pieces[allyColour + PAWN]):
+        row, col = SQUARES[sq]
+        pinDirection = pins.get(sq)
+        pawnPromotion = row + moveAmount == backRow
+        oneStep = sq + 8 * moveAmount
+        if not occupied >> oneStep & 1 and (pinDirection is None or pinDirection[1] == 0):
+            moves.append(Move((row, col), SQUARES[oneStep], board,
+                         pawnPromotion=pawnPromotion))
+            twoStep = oneStep + 8 * moveAmount
+            if row == startRow and not occupied >> twoStep & 1:
+                moves.append(Move((row, col), SQUARES[twoStep], board))
+        for target in PAWN_TARGETS[allyColour][sq]:
+            colShift = target % 8 - col
+            if pinDirection is not None and pinDirection != (moveAmount, colShift):
+                continue
+            move = Move((row, col), SQUARES[target], board,
+                        pawnPromotion=pawnPromotion)
+            if enemy >> target & 1:
+                moves.append(move)
+            if target == enPassantSq and not _enPassantExposesKing(position, allyColour, sq, sq + colShift):
+                moves.append(Move((row, col), SQUARES[target],
+                             board, enPassant=True))
+            protectionMoves.append(move)
+
+    # knights, a pinned knight can never stay on its pin line
+    for sq in squares(pieces[allyColour + KNIGHT]):
+        if sq in pins:
+            continue
+        for target in KNIGHT_TARGETS[sq]:
+            move = Move(SQUARES[sq], SQUARES[target], board)
+            if not ally >> target & 1:
+                moves.append(move)
+            protectionMoves.append(move)
+
+    # sliders
+    corners = ROOK_CORNERS[allyColour]
+    for piece, dirIdxs in ((ROOK, ORTHOGONAL), (BISHOP, DIAGONAL), (QUEEN, range(8))):
+        for sq in squares(pieces[allyColour + piece]):
+            pinDirection = pins.get(sq)
+            for dirIdx in dirIdxs:
+                dr, dc = DIRECTIONS[dirIdx]
+                if pinDirection is not None and pinDirection != (dr, dc) and pinDirection != (-dr, -dc):
+                    continue
+                castleRightsChanged = dirIdx in ORTHOGONAL and sq in corners
+                for target in RAY_TARGETS[dirIdx][sq]:
+                    move = Move(SQUARES[sq], SQUARES[target], board,
+                                castleRightsChanged=castleRightsChanged)
+                    if not ally >> target & 1:
+                        moves.append(move)
+                    protectionMoves.append(move)
+                    if occupied >> target & 1:
+                        break  # the first blocker, captured or protected
+
+    for sq in squares(pieces[allyColour + KING]):
+        _kingMoves(gs, position, sq, moves, protectionMoves)
+
+    return (moves, protectionMoves)
+
+
+def getKingMoves(gs, row: int, col: int, moves: list, protectionMoves: list):
+    '''
+    King moves and castling from (row, col), the bitboard counterpart of GameState.getKingMoves
+    '''
+    _kingMoves(gs, gs.bitboards, row * 8 + col, moves, protectionMoves)
+
+
+def _kingMoves(gs, position: BitboardPosition, sq: int, moves: list, protectionMoves: list):
+    board = gs.board
+    Move = ChessEngine.Move
+    allyColour = WHITE if gs.whiteToMove else BLACK
+    ally = position.colours[allyColour]
+    # the king's own square must not shield the squares it steps to
+    occupied = position.occupied & ~(1 << sq)
+    castleRightsChanged = sq == KING_HOMES[allyColour]
+
+    for target in KING_TARGETS[sq]:
+        move = Move(SQUARES[sq], SQUARES[target], board,
+                    castleRightsChanged=castleRightsChanged)
+        if ally >> target & 1:
+            protectionMoves.append(move)
+            continue
+        attackers = position.attackers(target, allyColour, occupied)
+        if attackers == 0:
+            moves.append(move)
+        if attackers <= 1:
+            protectionMoves.append(move)
+
+    if gs.inCheck:
+        return  # cant castle out of a check!
+
+    castleRights = gs.currentCastleRights[:2] if gs.whiteToMove else gs.currentCastleRights[2:]
+    row, col = SQUARES[sq]
+    for idx, castleRight in enumerate(castleRights):
+        if not castleRight:
+            continue
+        dir = 1 if idx == 0 else -1
+        maxDepth = 2 if idx == 0 else 3
+        if any(board[row][col + dir * i] != EMPTY for i in range(1, maxDepth + 1)):
+            continue
+        if all(position.attackers(sq + dir * i, allyColour, occupied) == 0 for i in range(1, 3)):
+            moves.append(Move((row, col), (row, col + dir * 2), board,
+                         castleRightsChanged=True, isCastle=True, kingSideCastle=(maxDepth == 2)))
+
+
+def _enPassantExposesKing(position: BitboardPosition, allyColour: str, sq: int, capturedSq: int) -> bool:
+    enemyColour = BLACK if allyColour == WHITE else WHITE
+    king = position.pieces[allyColour + KING]
+    if not king:
+        return False
+    kingSq = king.bit_length() - 1
+    if kingSq // 8 != sq // 8:
+        return False
+    occupied = position.occupied & ~(1 << sq) & ~(1 << capturedSq)
+    dirIdx = 3 if sq > kingSq else 1  # (0, 1) or (0, -1)
+    blocker = firstBlocker(dirIdx, kingSq, occupied)
+    rooks = position.pieces[enemyColour + ROOK] | position.pieces[enemyColour + QUEEN]
+    return blocker != -1 and bool(rooks >> blocker & 1)
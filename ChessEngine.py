@@ -1,21 +1,66 @@
 # Handle and save game state, determine valid moves, move log, etc.
-from typing import Tuple
+import copy
+from typing import Iterator, Optional, Tuple
+import numpy as np
 from Pieces import *
 from Pieces import ___
 import Pieces
+import Bitboard
+import Fen
+import Territory
+import Zobrist
 
 Square = Tuple[int, int]
 CastlingRights = Tuple[bool, bool, bool, bool]
 
 DEBUG = False
 
-
-def debug(msg):
+# move generation backends, chosen per GameState
+LIST_BACKEND = "list"
+BITBOARD_BACKEND = "bitboard"
+BACKENDS = [LIST_BACKEND, BITBOARD_BACKEND]
+
+SNAPSHOT_INTERVAL = 16  # plies between the positions seek can restart from
+
+# directions outward from a king, 4 orthogonal then 4 diagonal
+DIRECTIONS = [(-1, 0), (0, -1), (1, 0), (0, 1),
+              (-1, -1), (-1, 1), (1, -1), (1, 1)]
+KNIGHT_OFFSETS = [(-2, -1), (-2, 1), (-1, -2), (-1, 2),
+                  (1, -2), (1, 2), (2, -1), (2, 1)]
+
+# RAYS[row][col][dirIdx] -> on-board squares walking outward from (row, col) in DIRECTIONS[dirIdx]
+RAYS = [[[[(row + dr * dist, col + dc * dist) for dist in range(1, 8)
+           if 0 <= row + dr * dist < 8 and 0 <= col + dc * dist < 8]
+          for dr, dc in DIRECTIONS]
+         for col in range(8)] for row in range(8)]
+# KNIGHT_TARGETS[row][col] -> (endRow, endCol, rowShift, colShift) for every on-board knight jump
+KNIGHT_TARGETS = [[[(row + dr, col + dc, dr, dc) for dr, dc in KNIGHT_OFFSETS
+                    if 0 <= row + dr < 8 and 0 <= col + dc < 8]
+                   for col in range(8)] for row in range(8)]
+# KING_TARGETS[row][col] -> on-board squares next to (row, col)
+KING_TARGETS = [[[(row + dr, col + dc) for dr, dc in DIRECTIONS
+                  if 0 <= row + dr < 8 and 0 <= col + dc < 8]
+                 for col in range(8)] for row in range(8)]
+
+
+def debug(msg, *args):
+    '''
+    Print msg when DEBUG is set, % formatted with args if there are any. Hot paths pass args rather than an
+    f-string so nothing is formatted while it's off
+    '''
     if DEBUG:
-        print(msg)
+        print(msg % args if args else msg)
 
 
 class Move():
+    '''
+    Compact value type for a move, equal (and hashed) by its packed moveID.
+    Holds no reference to the board and builds notation only when asked for it
+    '''
+    __slots__ = ("startRow", "startCol", "endRow", "endCol", "pieceMoved", "pieceCaptured", "moveID",
+                 "isPawnPromotion", "promotionChoice", "isEnPassant", "castleRightsChanged", "isCastle",
+                 "kingSideCastle", "isCheck", "isCheckmate", "isCapture")
+
     ranksToRows = {"1": 7, "2": 6, "3": 5, "4": 4,
                    "5": 3, "6": 2, "7": 1, "8": 0}
     rowsToRanks = {v: k for k, v in ranksToRows.items()}
@@ -29,7 +74,6 @@ class Move():
         self.endRow, self.endCol = endSq
         self.pieceMoved = board[self.startRow][self.startCol]
         self.pieceCaptured = board[self.endRow][self.endCol]
-        self.boardBefore = board
         self.moveID = self.startRow * 1000 + self.startCol * \
             100 + self.endRow * 10 + self.endCol
 
@@ -44,7 +88,7 @@ class Move():
 
         self.isCheck = isCheck
         self.isCheckmate = isCheckmate
-        self.isCapture = self.pieceCaptured != EMPTY
+        self.isCapture = self.pieceCaptured != EMPTY or enPassant
 
     def getChessNotation(self) -> str:
         castle = None if not self.isCastle else '0-0' if self.kingSideCastle else '0-0-0'
@@ -55,25 +99,51 @@ class Move():
         captureFlag = 'x' if self.isCapture else ''
         movedPiece = self.pieceMoved[1] if self.pieceMoved[
             1] != PAWN else startFile if self.isCapture else ''
-        pawnPromotion = '' if not self.isPawnPromotion else '=' + self.promotionChoice
+        pawnPromotion = '' if not self.isPawnPromotion or self.promotionChoice is None else '=' + self.promotionChoice
 
         return castle, movedPiece, captureFlag, endSquare, checkFlag, startRank, startFile, pawnPromotion
 
+    def withPromotion(self, choice: str) -> "Move":
+        '''
+        Copy of a pawn promotion with its piece chosen. Moves from getValidMoves are shared between callers (and with
+        the move cache), so the choice is never set on them in place
+        '''
+        move = copy.copy(self)
+        move.promotionChoice = choice
+        return move
+
     def getRankFile(self, r, c) -> str:
         return self.colsToFiles[c] + self.rowsToRanks[r]
 
+    def getLongNotation(self) -> str:
+        '''
+        Start and end square with the promotion piece, e.g. e2e4 or e7e8q
+        '''
+        return self.getRankFile(self.startRow, self.startCol) + self.getRankFile(self.endRow, self.endCol) + \
+            (self.promotionChoice.lower() if self.isPawnPromotion and self.promotionChoice else '')
+
     def __eq__(self, other: object) -> bool:
         if isinstance(other, Move):
             return self.moveID == other.moveID
         return False
 
+    def __hash__(self) -> int:
+        return self.moveID
+
     def __str__(self) -> str:
         castle, movedPiece, captureFlag, endSquare, checkFlag, _, _, pawnPromotion = self.getChessNotation()
         return castle if castle is not None else movedPiece + captureFlag + endSquare + pawnPromotion + checkFlag
 
+    def __repr__(self) -> str:
+        return f"Move({self.getRankFile(self.startRow, self.startCol)}{self.getRankFile(self.endRow, self.endCol)})"
+
 
 class GameState():
-    def __init__(self, moveLog: list[Move] = []) -> None:
+    def __init__(self, moveLog: list[Move] = None, backend: str = LIST_BACKEND, cacheSize: int = Zobrist.DEFAULT_CACHE_SIZE) -> None:
+        if backend not in BACKENDS:
+            raise ValueError(
+                f"Unknown move generation backend '{backend}', pick from {BACKENDS}")
+        self.backend = backend
         self.board = [
             [B_R, B_N, B_B, B_Q, B_K, B_B, B_N, B_R],
             [B_P, B_P, B_P, B_P, B_P, B_P, B_P, B_P],
@@ -85,9 +155,13 @@ class GameState():
             [W_R, W_N, W_B, W_Q, W_K, W_B, W_N, W_R],
         ]
         self.whiteToMove = True
-        self.moveLog: list[Move] = moveLog
-        self.moveLogSize = len(moveLog)
+        # the log is shared with the caller so a preloaded move set can be redone
+        self.moveLog: list[Move] = moveLog if moveLog is not None else []
+        self.moveLogSize = len(self.moveLog)
         self.moveIdx: int = None
+        # FEN move counters of the position the log starts from, see getMoveCounters
+        self.startHalfmoveClock = 0
+        self.startFullmoveNumber = 1
         self.whiteKingLoc = (7, 4)
         self.blackKingLoc = (0, 4)
         self.inCheck = False
@@ -99,28 +173,294 @@ class GameState():
 
         # coordinates for the square where en passant capture is possible
         self.enPassantPossible = ()
+        self.enPassantUpdates: list[tuple] = []  # values before each move, for undos
 
         self.currentCastleRights: CastlingRights = (True, True, True, True)
         self.castleRightsUpdates: list[CastlingRights] = [
             self.currentCastleRights]
 
+        # attacker counts for both colours, updated by makeMove/undoMove
+        self.territory = Territory.TerritoryMap(self.board)
+        # bitboards of the board for the bitboard backend, updated alongside the territory
+        self.bitboards = Bitboard.BitboardPosition(self.board) if backend == BITBOARD_BACKEND else None
+
+        # Zobrist key of the current position, updated by makeMove and restored by undoMove
+        self.zobristKey = Zobrist.hashPosition(
+            self.board, self.whiteToMove, self.currentCastleRights, self.enPassantPossible)
+        self.zobristUpdates: list[int] = []
+        # undo records of moves played with push, see pop
+        self.pushedMoves: list[tuple] = []
+        # getValidMoves results for recently seen positions, cacheSize=0 disables it
+        self.moveCache = Zobrist.MoveCache(cacheSize) if cacheSize > 0 else None
+        # cache entry of the last position getValidMoves ran on, with its key
+        self.validMovesEntry: list = None
+        self.validMovesKey: int = None
+        # en passant square, castling rights and key at every ply of the log reached so far, see seek
+        self.plyStates: list[tuple] = []
+        # ply -> whole position every SNAPSHOT_INTERVAL plies, see seek
+        self.snapshots: dict[int, tuple] = {}
+        self.recordPly()
+
         # self.protectionMoves = []
 
+    def setPosition(self, board: list[list[str]], whiteToMove: bool = True, castleRights: CastlingRights = (True, True, True, True), enPassantPossible: tuple = (), halfmoveClock: int = 0, fullmoveNumber: int = 1):
+        '''
+        Start from an arbitrary position instead of the initial board, the move log is cleared
+        '''
+        self.board = board
+        self.whiteToMove = whiteToMove
+        self.startHalfmoveClock = halfmoveClock
+        self.startFullmoveNumber = fullmoveNumber
+        for row in range(8):
+            for col in range(8):
+                if board[row][col] == W_K:
+                    self.whiteKingLoc = (row, col)
+                elif board[row][col] == B_K:
+                    self.blackKingLoc = (row, col)
+        self.moveLog = []
+        self.moveLogSize = 0
+        self.moveIdx = None
+        self.inCheck = False
+        self.pins = []
+        self.checks = []
+        self.checkmate = False
+        self.stalemate = False
+        self.enPassantPossible = enPassantPossible
+        self.enPassantUpdates = []
+        self.currentCastleRights = castleRights
+        self.castleRightsUpdates = [castleRights]
+        self.territory = Territory.TerritoryMap(self.board)
+        if self.bitboards is not None:
+            self.bitboards = Bitboard.BitboardPosition(self.board)
+        # cached entries are keyed by position so they stay valid
+        self.zobristKey = Zobrist.hashPosition(
+            self.board, self.whiteToMove, self.currentCastleRights, self.enPassantPossible)
+        self.zobristUpdates = []
+        self.pushedMoves = []
+        self.plyStates = []
+        self.snapshots = {}
+        self.recordPly()
+
+    def setFen(self, fen: str):
+        '''
+        Start from the position in a FEN string, see setPosition
+        '''
+        self.setPosition(*Fen.parseFen(fen))
+
+    def getFen(self) -> str:
+        return Fen.formatFen(self.getPosition())
+
+    def setPackedPosition(self, data: bytes):
+        '''
+        Start from a position packed by getPackedPosition, see setPosition
+        '''
+        self.setPosition(*Fen.unpackPosition(data))
+
+    def getPackedPosition(self) -> bytes:
+        '''
+        The current position in Fen.PACKED_SIZE bytes
+        '''
+        return Fen.packPosition(self.getPosition())
+
+    def getPosition(self) -> Fen.Position:
+        '''
+        Copy of the current position with its move counters, including pushed moves
+        '''
+        return Fen.Position([row[:] for row in self.board], self.whiteToMove, self.currentCastleRights,
+                            self.enPassantPossible, *self.getMoveCounters())
+
+    def getMoveCounters(self) -> Tuple[int, int]:
+        '''
+        FEN halfmove clock (plies since the last capture or pawn move) and fullmove number of the current position
+        '''
+        line = self.moveLog[:self.getPly()] + [record[0] for record in self.pushedMoves]
+        for plies, move in enumerate(reversed(line)):
+            if move.pieceMoved[1] == PAWN or move.isCapture:
+                halfmoveClock = plies
+                break
+        else:
+            halfmoveClock = self.startHalfmoveClock + len(line)
+        # black moving first means the first fullmove is only half long
+        startedWhite = self.whiteToMove == (len(line) % 2 == 0)
+        fullmoveNumber = self.startFullmoveNumber + \
+            (len(line) + (0 if startedWhite else 1)) // 2
+        return halfmoveClock, fullmoveNumber
+
     # Executes move, not working for castling, en passant and promotions
 
     def makeMove(self, move: Move, redo: bool = False):
-        self.board[move.startRow][move.startCol] = EMPTY
-        self.board[move.endRow][move.endCol] = move.pieceMoved
+        # pawn promotion, the choice is logged on a copy
+        if move.isPawnPromotion and move.promotionChoice is None:
+            choiceMap = {
+                'Q': QUEEN,
+                'N': KNIGHT,
+                'R': ROOK,
+                'B': BISHOP
+            }
+            choice = input(
+                "What do you want to promote to? (Q, N, R, B): ").upper()
+            while choice not in ['Q', 'N', 'R', 'B']:
+                choice = input(
+                    "Invalid input\nPlease pick from Q, N, R or B: ").upper()
+            move = move.withPromotion(choiceMap[choice])
+
         if self.moveIdx == None:
             self.moveIdx = -1
-        #  log move for undos, see history, etc
+        #  log move for undos, see history, etc
         if self.moveIdx != self.moveLogSize - 1 and not redo:
             del self.moveLog[self.moveIdx + 1:]
             self.moveLogSize = self.moveIdx + 1
+            # states and snapshots past here belong to the abandoned moves
+            del self.plyStates[self.moveIdx + 2:]
+            self.snapshots = {ply: snapshot for ply, snapshot in self.snapshots.items()
+                              if ply <= self.moveIdx + 1}
         self.moveIdx += 1
         if not redo:
             self.moveLog.append(move)
             self.moveLogSize += 1
+        else:
+            # the copy carries any promotion choice just made, and replayMove's flags are read back by undoMove
+            self.moveLog[self.moveIdx] = move
+
+        self.replayMove(move)
+
+        # update the move notation if a check(mate) occurred
+        self.getValidMoves()
+
+    def replayMove(self, move: Move):
+        '''
+        Play the logged move at moveIdx, which makeMove has already advanced, keeping the undo stacks and
+        seek records up to date but without recomputing legal moves
+        '''
+        self.enPassantUpdates.append(self.enPassantPossible)
+        self.zobristUpdates.append(self.zobristKey)
+        castleRightsBefore = self.applyMove(move)
+
+        # castle rights updates
+        if self.currentCastleRights != castleRightsBefore:
+            move.castleRightsChanged = True
+            self.castleRightsUpdates.append(self.currentCastleRights)
+        else:
+            move.castleRightsChanged = False
+        self.recordPly()
+
+    def getPly(self) -> int:
+        '''
+        Number of logged moves played to reach the current position
+        '''
+        return 0 if self.moveIdx is None else self.moveIdx + 1
+
+    def recordPly(self):
+        '''
+        Remember the current ply's state for seek, along with the whole position every SNAPSHOT_INTERVAL plies
+        '''
+        ply = self.getPly()
+        state = (self.enPassantPossible, self.currentCastleRights, self.zobristKey)
+        if ply < len(self.plyStates):
+            self.plyStates[ply] = state
+        else:
+            self.plyStates.append(state)
+        if ply % SNAPSHOT_INTERVAL == 0:
+            # the board as one string of 2 character pieces
+            self.snapshots[ply] = (''.join(''.join(row) for row in self.board), self.whiteToMove,
+                                   self.whiteKingLoc, self.blackKingLoc)
+
+    def seek(self, ply: int):
+        '''
+        Go to the position after the first ply moves of the log, without changing the log. Starts from the closest
+        snapshot at or before ply, or from the current position when that's nearer, and only computes legal moves
+        for the position it ends on
+        '''
+        if not 0 <= ply <= self.moveLogSize:
+            raise ValueError(
+                f"Can't seek to ply {ply}, the move log has {self.moveLogSize} moves!")
+        if self.pushedMoves:
+            raise ValueError("Can't seek while pushed moves are on the board!")
+        current = self.getPly()
+        if ply == current:
+            return
+
+        # snapshots only exist up to the furthest ply reached
+        start = ply - ply % SNAPSHOT_INTERVAL
+        while start not in self.snapshots:
+            start -= SNAPSHOT_INTERVAL
+        if ply < current and current - ply <= ply - start:
+            while self.getPly() > ply:
+                self.undoMove()
+        else:
+            if not start <= current < ply:
+                self.restoreSnapshot(start)
+            while self.getPly() < ply:
+                self.moveIdx = self.getPly()
+                self.replayMove(self.moveLog[self.moveIdx])
+        self.checkmate = False
+        self.stalemate = False
+        self.getValidMoves()
+
+    def restoreSnapshot(self, ply: int):
+        '''
+        Put back the position snapshotted at ply, rebuilding the undo stacks from the states recorded before it
+        '''
+        board, self.whiteToMove, self.whiteKingLoc, self.blackKingLoc = self.snapshots[ply]
+        # refill the rows in place, the board list may be shared
+        for row in range(8):
+            self.board[row][:] = [board[idx:idx + 2]
+                                  for idx in range(row * 16, row * 16 + 16, 2)]
+        self.moveIdx = ply - 1 if ply > 0 else None
+        self.enPassantPossible, self.currentCastleRights, self.zobristKey = self.plyStates[ply]
+        self.enPassantUpdates = [state[0] for state in self.plyStates[:ply]]
+        self.zobristUpdates = [state[2] for state in self.plyStates[:ply]]
+        # the rights stack only grows on moves that changed them
+        self.castleRightsUpdates = []
+        for _, castleRights, _ in self.plyStates[:ply + 1]:
+            if not self.castleRightsUpdates or self.castleRightsUpdates[-1] != castleRights:
+                self.castleRightsUpdates.append(castleRights)
+        self.territory = Territory.TerritoryMap(self.board)
+        if self.bitboards is not None:
+            self.bitboards = Bitboard.BitboardPosition(self.board)
+
+    def undoMove(self):
+        if self.moveIdx != None:
+            move: Move = self.moveLog[self.moveIdx]
+            self.moveIdx = self.moveIdx - 1 if self.moveIdx > 0 else None
+
+            if move.castleRightsChanged:
+                self.castleRightsUpdates.pop()
+            self.revertMove(move, self.castleRightsUpdates[-1],
+                            self.enPassantUpdates.pop(), self.zobristUpdates.pop())
+
+            self.checkmate = False
+            self.stalemate = False
+
+    def push(self, move: Move):
+        '''
+        Play a move without logging, prompting or recomputing legal moves, for search and bulk analysis.
+        Promotions without a choice become queens. Undo with pop, not undoMove
+        '''
+        self.pushedMoves.append((move, self.currentCastleRights, self.enPassantPossible,
+                                 self.zobristKey, self.checkmate, self.stalemate))
+        self.applyMove(move)
+
+    def pop(self) -> Move:
+        '''
+        Take back the last pushed move and return it
+        '''
+        move, castleRights, enPassantPossible, zobristKey, self.checkmate, self.stalemate = self.pushedMoves.pop()
+        self.revertMove(move, castleRights, enPassantPossible, zobristKey)
+        return move
+
+    def applyMove(self, move: Move) -> CastlingRights:
+        '''
+        Board, king, en passant, castling rights, territory, key and turn updates shared by makeMove and push.
+        Returns the castling rights from before the move
+        '''
+        board = self.board
+        board[move.startRow][move.startCol] = EMPTY
+        if move.isPawnPromotion:
+            board[move.endRow][move.endCol] = move.pieceMoved[0] + \
+                (move.promotionChoice or QUEEN)
+        else:
+            board[move.endRow][move.endCol] = move.pieceMoved
 
         # track kings
         if move.pieceMoved == W_K:
@@ -128,48 +468,41 @@ class GameState():
         elif move.pieceMoved == B_K:
             self.blackKingLoc = (move.endRow, move.endCol)
 
-        # pawn promotion
-        if move.isPawnPromotion:
-            if move.promotionChoice is None:
-                choiceMap = {
-                    'Q': QUEEN,
-                    'N': KNIGHT,
-                    'R': ROOK,
-                    'B': BISHOP
-                }
-                choice = input(
-                    "What do you want to promote to? (Q, N, R, B): ").upper()
-                while choice not in ['Q', 'N', 'R', 'B']:
-                    choice = input(
-                        "Invalid input\nPlease pick from Q, N, R or B: ").upper()
-                move.promotionChoice = choiceMap[choice]
-            self.board[move.endRow][move.endCol] = move.pieceMoved[0] + \
-                move.promotionChoice
-
         # en passant
         if move.isEnPassant:
-            self.board[move.startRow][move.endCol] = EMPTY
+            board[move.startRow][move.endCol] = EMPTY
+
+        # castling
+        if move.isCastle:
+            if move.endCol - move.startCol == 2:  # castled king side
+                board[move.endRow][move.endCol - 1] = board[move.endRow][7]
+                board[move.endRow][7] = EMPTY
+            else:
+                board[move.endRow][move.endCol + 1] = board[move.endRow][0]
+                board[move.endRow][0] = EMPTY
 
         # update en passant field
         # only on 2 square pawn advances
+        enPassantBefore = self.enPassantPossible
         if move.pieceMoved[1] == PAWN and abs(move.startRow - move.endRow) == 2:
             self.enPassantPossible = (
                 (move.startRow + move.endRow) // 2, move.startCol)
         else:
             self.enPassantPossible = ()
 
-        # castle rights updates
-        wks, wqs, bks, bqs = self.currentCastleRights
-        if move.pieceCaptured == W_R and (move.endRow, move.endCol) == (7, 7):
-            wks = False
-        elif move.pieceCaptured == W_R and (move.endRow, move.endCol) == (7, 0):
-            wqs = False
-        elif move.pieceCaptured == B_R and (move.endRow, move.endCol) == (0, 7):
-            bks = False
-        elif move.pieceCaptured == B_R and (move.endRow, move.endCol) == (0, 0):
-            bqs = False
-
-        if move.castleRightsChanged:
+        # castle rights updates, lost when a king or rook leaves its square or a rook is captured on it
+        castleRightsBefore = self.currentCastleRights
+        if castleRightsBefore != (False, False, False, False):
+            wks, wqs, bks, bqs = castleRightsBefore
+            if move.pieceCaptured == W_R and (move.endRow, move.endCol) == (7, 7):
+                wks = False
+            elif move.pieceCaptured == W_R and (move.endRow, move.endCol) == (7, 0):
+                wqs = False
+            elif move.pieceCaptured == B_R and (move.endRow, move.endCol) == (0, 7):
+                bks = False
+            elif move.pieceCaptured == B_R and (move.endRow, move.endCol) == (0, 0):
+                bqs = False
+
             if move.pieceMoved == W_K:
                 wks, wqs = False, False
             elif move.pieceMoved == B_K:
@@ -182,77 +515,91 @@ class GameState():
                 bks = False
             elif move.pieceMoved == B_R and (move.startRow, move.startCol) == (0, 0):
                 bqs = False
+            self.currentCastleRights = (wks, wqs, bks, bqs)
 
-        if (wks, wqs, bks, bqs) != self.currentCastleRights:
-            move.castleRightsChanged = True
-            self.castleRightsUpdates.append((wks, wqs, bks, bqs))
-            self.currentCastleRights = self.castleRightsUpdates[-1]
-        else:
-            move.castleRightsChanged = False
-
-        # castling
-        if move.isCastle:
-            if move.endCol - move.startCol == 2:  # castled king side
-                self.board[move.endRow][move.endCol -
-                                        1] = self.board[move.endRow][7]
-                debug(self.board[move.endRow][7])
-                self.board[move.endRow][7] = EMPTY
-            else:
-                self.board[move.endRow][move.endCol +
-                                        1] = self.board[move.endRow][0]
-                self.board[move.endRow][0] = EMPTY
+        changedSquares = Territory.changedSquares(move)
+        self.territory.update(board, changedSquares)
+        if self.bitboards is not None:
+            self.bitboards.update(board, changedSquares)
+        self.updateZobristKey(move, castleRightsBefore, enPassantBefore)
 
         self.whiteToMove = not self.whiteToMove  #  switch turn
+        return castleRightsBefore
 
-        # update the move notation if a check(mate) occurred
-        self.getValidMoves()
-
-    def undoMove(self):
-        if self.moveIdx != None:
-            move: Move = self.moveLog[self.moveIdx]
-            self.moveIdx = self.moveIdx - 1 if self.moveIdx > 0 else None
-            self.board[move.startRow][move.startCol] = move.pieceMoved
-            self.board[move.endRow][move.endCol] = move.pieceCaptured
-            self.whiteToMove = not self.whiteToMove  #  switch turn back
-
-            # track kings
-            if move.pieceMoved == W_K:
-                self.whiteKingLoc = (move.startRow, move.startCol)
-            elif move.pieceMoved == B_K:
-                self.blackKingLoc = (move.startRow, move.startCol)
-
-            self.checkmate = False
-            self.stalemate = False
-
-            if move.isEnPassant:
-                self.board[move.startRow][move.endCol] = B_P if move.pieceMoved[0] == WHITE else W_P
-                self.enPassantPossible = (move.endRow, move.endCol)
+    def revertMove(self, move: Move, castleRights: CastlingRights, enPassantPossible: tuple, zobristKey: int):
+        '''
+        Put the board back to before move and restore the state saved when it was played
+        '''
+        board = self.board
+        board[move.startRow][move.startCol] = move.pieceMoved
+        board[move.endRow][move.endCol] = move.pieceCaptured
+        self.whiteToMove = not self.whiteToMove  #  switch turn back
 
-            if move.pieceMoved[1] == PAWN and abs(move.startRow - move.endRow) == 2:
-                self.enPassantPossible = ()
+        # track kings
+        if move.pieceMoved == W_K:
+            self.whiteKingLoc = (move.startRow, move.startCol)
+        elif move.pieceMoved == B_K:
+            self.blackKingLoc = (move.startRow, move.startCol)
 
-            if move.castleRightsChanged:
-                self.castleRightsUpdates.pop()
-                self.currentCastleRights = self.castleRightsUpdates[-1]
+        if move.isEnPassant:
+            board[move.startRow][move.endCol] = B_P if move.pieceMoved[0] == WHITE else W_P
 
-            if move.isCastle:
-                if move.endCol - move.startCol == 2:  # castled king side
-                    self.board[move.endRow][7] = self.board[move.endRow][move.endCol - 1]
-                    self.board[move.endRow][move.endCol - 1] = EMPTY
-                else:
-                    self.board[move.endRow][0] = self.board[move.endRow][move.endCol + 1]
-                    self.board[move.endRow][move.endCol + 1] = EMPTY
+        if move.isCastle:
+            if move.endCol - move.startCol == 2:  # castled king side
+                board[move.endRow][7] = board[move.endRow][move.endCol - 1]
+                board[move.endRow][move.endCol - 1] = EMPTY
+            else:
+                board[move.endRow][0] = board[move.endRow][move.endCol + 1]
+                board[move.endRow][move.endCol + 1] = EMPTY
+
+        self.enPassantPossible = enPassantPossible
+        self.currentCastleRights = castleRights
+        changedSquares = Territory.changedSquares(move)
+        self.territory.update(board, changedSquares)
+        if self.bitboards is not None:
+            self.bitboards.update(board, changedSquares)
+        self.zobristKey = zobristKey
+
+    def updateZobristKey(self, move: Move, castleRightsBefore: CastlingRights, enPassantBefore: tuple):
+        '''
+        XOR the squares, rights and en passant file a move changed into the key, the board must already be updated
+        '''
+        pieceKeys = Zobrist.PIECE_KEYS
+        key = self.zobristKey ^ Zobrist.BLACK_TO_MOVE_KEY
+        key ^= pieceKeys[move.pieceMoved][move.startRow][move.startCol]
+        key ^= pieceKeys[self.board[move.endRow][move.endCol]
+                         ][move.endRow][move.endCol]
+        if move.isEnPassant:
+            capturedPawn = B_P if move.pieceMoved[0] == WHITE else W_P
+            key ^= pieceKeys[capturedPawn][move.startRow][move.endCol]
+        elif move.pieceCaptured != EMPTY:
+            key ^= pieceKeys[move.pieceCaptured][move.endRow][move.endCol]
+        if move.isCastle:
+            rook = move.pieceMoved[0] + ROOK
+            rookCols = (7, move.endCol - 1) if move.endCol - \
+                move.startCol == 2 else (0, move.endCol + 1)
+            for rookCol in rookCols:
+                key ^= pieceKeys[rook][move.endRow][rookCol]
+        if castleRightsBefore != self.currentCastleRights:
+            key ^= Zobrist.castleKey(castleRightsBefore) ^ Zobrist.castleKey(
+                self.currentCastleRights)
+        key ^= Zobrist.enPassantKey(enPassantBefore) ^ Zobrist.enPassantKey(
+            self.enPassantPossible)
+        self.zobristKey = key
 
     def redoMove(self):
         if self.moveLogSize > 0:
-            debug(f"move idx before redo: {self.moveIdx}")
+            debug("move idx before redo: %s", self.moveIdx)
             if self.moveIdx == None:
                 self.makeMove(self.moveLog[0], redo=True)
             elif self.moveIdx < self.moveLogSize - 1:
                 self.makeMove(self.moveLog[self.moveIdx + 1], redo=True)
-            debug(f"move idx after redo: {self.moveIdx}")
+            debug("move idx after redo: %s", self.moveIdx)
+
+    def checkForPinsAndChecks(self):
+        if self.backend == BITBOARD_BACKEND:
+            return Bitboard.checkForPinsAndChecks(self)
 
-    def checkForPinsAndChecks(self, phantom: bool = False):
         pins = []  # squares where the allied pinned piece is and direction pinned from
         checks = []  #  squares where enemy is applying a check
         inCheck = False
@@ -266,85 +613,98 @@ class GameState():
             startRow, startCol = self.blackKingLoc
 
         # check outward from king for pins and checks, keep track of pins
-        directions = [(-1, 0), (0, -1), (1, 0), (0, 1),
-                      (-1, -1), (-1, 1), (1, -1), (1, 1)]
-        for dir_idx, dir in enumerate(directions):
+        for dir_idx, ray in enumerate(RAYS[startRow][startCol]):
+            dir = DIRECTIONS[dir_idx]
             possiblePin = ()  # reset possible pins
-            for dist in range(1, 8):
-                endRow = startRow + dir[0] * dist
-                endCol = startCol + dir[1] * dist
-
-                if 0 <= endRow < 8 and 0 <= endCol < 8:
-                    endPiece = self.board[endRow][endCol]
-
-                    if endPiece[0] == allyColour and endPiece[1] != KING:
-                        if possiblePin == ():  #  1st allied piece could be pinned
-                            possiblePin = (endRow, endCol, dir[0], dir[1])
-                            if not phantom:
-                                debug(
-                                    f"Possible pin by {endPiece} on ({endRow},{endCol})")
-                        else:  # 2nd allied piece, so no pin or check possible in this direction
+            for dist, (endRow, endCol) in enumerate(ray, start=1):
+                endPiece = self.board[endRow][endCol]
+
+                if endPiece[0] == allyColour and endPiece[1] != KING:
+                    if possiblePin == ():  #  1st allied piece could be pinned
+                        possiblePin = (endRow, endCol, dir[0], dir[1])
+                        debug("Possible pin by %s on (%d,%d)",
+                              endPiece, endRow, endCol)
+                    else:  # 2nd allied piece, so no pin or check possible in this direction
+                        break
+                elif endPiece[0] == enemyColour:
+                    type = endPiece[1]
+                    # 5 possibilities here in this complex conditional
+                    # 1.) Orthogonally away from king and piece is a rook
+                    # 2.) Diagonally away from king and piece is a bishop
+                    # 3.) 1 square away diagonally and piece is a pawn
+                    # 4.) Any direction and piece is a Queen
+                    # 5.) Any direction 1 square away and piece is a King (prevents king move to enemy king territory)
+                    if (0 <= dir_idx <= 3 and type == ROOK) or \
+                        (4 <= dir_idx <= 7 and type == BISHOP) or \
+                            (dist == 1 and type == PAWN and ((enemyColour == WHITE and 6 <= dir_idx <= 7) or (enemyColour == BLACK and 4 <= dir_idx <= 5))) or \
+                            (type == QUEEN) or (dist == 1 and type == KING):
+                        if possiblePin == ():  #  no piece blocking, so check
+                            inCheck = True
+                            checks.append((endRow, endCol, dir[0], dir[1]))
+                            debug("Checked by %s on (%d,%d)",
+                                  endPiece, endRow, endCol)
                             break
-                    elif endPiece[0] == enemyColour:
-                        type = endPiece[1]
-                        # 5 possibilities here in this complex conditional
-                        # 1.) Orthogonally away from king and piece is a rook
-                        # 2.) Diagonally away from king and piece is a bishop
-                        # 3.) 1 square away diagonally and piece is a pawn
-                        # 4.) Any direction and piece is a Queen
-                        # 5.) Any direction 1 square away and piece is a King (prevents king move to enemy king territory)
-                        if (0 <= dir_idx <= 3 and type == ROOK) or \
-                            (4 <= dir_idx <= 7 and type == BISHOP) or \
-                                (dist == 1 and type == PAWN and ((enemyColour == WHITE and 6 <= dir_idx <= 7) or (enemyColour == BLACK and 4 <= dir_idx <= 5))) or \
-                                (type == QUEEN) or (dist == 1 and type == KING):
-                            if possiblePin == ():  #  no piece blocking, so check
-                                inCheck = True
-                                checks.append((endRow, endCol, dir[0], dir[1]))
-                                if not phantom:
-                                    debug(
-                                        f"Checked by {endPiece} on ({endRow},{endCol})")
-                                    self.moveLog[-1].isCheck = True
-                                break
-                            else:  # piece blocking so pin
-                                pins.append(possiblePin)
-                                if not phantom:
-                                    debug(
-                                        f"{self.board[possiblePin[0]][possiblePin[1]]} on ({possiblePin[0]},{possiblePin[1]}) pinned by {endPiece} on ({endRow},{endCol})")
-                                break
-                        else:  # enemy piece not applying check
+                        else:  # piece blocking so pin
+                            pins.append(possiblePin)
+                            debug("%s on (%d,%d) pinned by %s on (%d,%d)", self.board[possiblePin[0]][possiblePin[1]],
+                                  possiblePin[0], possiblePin[1], endPiece, endRow, endCol)
                             break
-                else:  # looking off board
-                    break
+                    else:  # enemy piece not applying check
+                        break
 
         # check for knights
-        knightMoves = [(-2, -1), (-2, 1), (-1, -2), (-1, 2),
-                       (1, -2), (1, 2), (2, -1), (2, 1)]
-        for move in knightMoves:
-            endRow = startRow + move[0]
-            endCol = startCol + move[1]
+        enemyKnight = enemyColour + KNIGHT
+        for endRow, endCol, rowShift, colShift in KNIGHT_TARGETS[startRow][startCol]:
+            if self.board[endRow][endCol] == enemyKnight:  # enemy knight attacking our King
+                inCheck = True
+                checks.append((endRow, endCol, rowShift, colShift))
+                debug("Checked by %s on (%d,%d)",
+                      enemyKnight, endRow, endCol)
 
-            if 0 <= endRow < 8 and 0 <= endCol < 8:
-                endPiece = self.board[endRow][endCol]
-                enemyKnight = enemyColour + KNIGHT
+        return inCheck, pins, checks
 
-                if endPiece == enemyKnight:  # enemy knight attacking our King
-                    inCheck = True
-                    checks.append((endRow, endCol, move[0], move[1]))
-                    if not phantom:
-                        debug(f"Checked by {endPiece} on ({endRow},{endCol})")
+    def getTerritoryHeatmap(self, colour: str = WHITE, kind: str = Territory.NET) -> np.ndarray:
+        '''
+        8x8 NumPy array of Territory.ATTACKERS, DEFENDERS or NET control for colour, without touching pygame
+        '''
+        return self.territory.heatmap(colour, kind)
 
-        return inCheck, pins, checks
+    def getValidMoves(self) -> Tuple[list[Move], list[Move]]:
+        '''
+        All moves considering checks, positions seen recently are served from the move cache.
+        The returned lists are shared with the cache so must not be modified
+        '''
+        entry = self.moveCache.get(
+            self.zobristKey) if self.moveCache is not None else None
+        if entry is None:
+            moves, protectionMoves = self.generateValidMoves()
+            # the notation index is only built if asked for, see getNotationIndex
+            entry = [moves, protectionMoves, self.inCheck, self.checks, None]
+            if self.moveCache is not None:
+                self.moveCache.put(self.zobristKey, entry)
+        else:
+            moves, protectionMoves, self.inCheck, self.checks, _ = entry
+        self.validMovesEntry = entry
+        self.validMovesKey = self.zobristKey
 
-    def getEnemyTerritory(self) -> list[Move]:
-        self.whiteToMove = not self.whiteToMove
-        _, enemy_protectionMoves = self.getValidMoves()
-        self.whiteToMove = not self.whiteToMove
+        # flag the move that led here, the log can run ahead of moveIdx after undos and pushed moves are never flagged
+        lastMove = self.moveLog[self.moveIdx] if self.moveIdx is not None and not self.pushedMoves else None
+        if self.inCheck and lastMove:
+            lastMove.isCheck = True
 
-        return enemy_protectionMoves
+        if len(moves) == 0:
+            if self.inCheck:
+                self.checkmate = True
+                if lastMove:
+                    lastMove.isCheckmate = True
+            else:
+                self.stalemate = True
 
-    def getValidMoves(self) -> Tuple[list[Move], list[Move]]:
+        return (moves, protectionMoves)
+
+    def generateValidMoves(self) -> Tuple[list[Move], list[Move]]:
         '''
-        All moves considering checks
+        All moves considering checks, always generated from the board
         '''
         moves = []
         protectionMoves = []
@@ -357,30 +717,10 @@ class GameState():
             if len(self.checks) == 1:  # only 1 check, move king or block/capture
                 debug("only one check, move king or block/capture")
                 moves, _ = self.getAllPossibleMoves()
-                protectionMoves = moves
-                # to block a check you must move a piece into one of the squares between the enemy piece and king
-                checkRow, checkCol, checkDirV, checkDirH = self.checks[0]
-                # enemy piece causing check
-                pieceChecking = self.board[checkRow][checkCol]
-                validSqs = []  # squares pieces can move to
-                # if knight, must capture or move king, other pieces can be blocked
-                if pieceChecking[1] == KNIGHT:
-                    validSqs = [(checkRow, checkCol)]
-                else:
-                    for i in range(1, 8):
-                        validSq = (kingRow + checkDirV * i,
-                                   kingCol + checkDirH * i)
-                        validSqs.append(validSq)
-                        # reached checking enemy piece
-                        if validSq[0] == checkRow and validSq[1] == checkCol:
-                            break
-
                 # get rid of any moves that don't block check or move king
-                for move in moves[::-1]:
-                    if move.pieceMoved != myKing:  # move doesn't move king so it must block or capture
-                        #  move does not block or capture checking enemy piece
-                        if not (move.endRow, move.endCol) in validSqs:
-                            moves.remove(move)
+                blockSquares = self.checkBlockSquares()
+                moves = [move for move in moves if move.pieceMoved == myKing or self.blocksCheck(move, blockSquares)]
+                protectionMoves = moves
             else:  # double check, king has to move
                 debug("Double check!")
                 self.getKingMoves(kingRow, kingCol, moves, [])
@@ -388,50 +728,175 @@ class GameState():
         else:  #  not in check, all moves are fine
             moves, protectionMoves = self.getAllPossibleMoves()
 
-        if len(moves) == 0:
-            if self.inCheck:
-                self.checkmate = True
-                self.moveLog[-1].isCheckmate = True
-            else:
-                self.stalemate = True
-
         return (moves, protectionMoves)
 
+    def checkBlockSquares(self) -> set[Square]:
+        '''
+        With a single check, the squares a piece other than the king can move to to get out of it: the checking
+        piece's, and for a slider the ones between it and the king
+        '''
+        kingRow, kingCol = self.whiteKingLoc if self.whiteToMove else self.blackKingLoc
+        checkRow, checkCol, checkDirV, checkDirH = self.checks[0]
+        # if knight, must capture or move king, other pieces can be blocked
+        if self.board[checkRow][checkCol][1] == KNIGHT:
+            return {(checkRow, checkCol)}
+        blockSquares = set()
+        for i in range(1, 8):
+            blockSquare = (kingRow + checkDirV * i, kingCol + checkDirH * i)
+            blockSquares.add(blockSquare)
+            # reached checking enemy piece
+            if blockSquare == (checkRow, checkCol):
+                break
+        return blockSquares
+
+    def blocksCheck(self, move: Move, blockSquares: set[Square]) -> bool:
+        '''
+        Whether a move of a piece other than the king blocks the single check or captures the checking piece
+        '''
+        checkRow, checkCol = self.checks[0][:2]
+        # en passant captures the checking pawn without landing on its square
+        return (move.endRow, move.endCol) in blockSquares or \
+            (move.isEnPassant and (move.startRow, move.endCol) == (checkRow, checkCol))
+
+    def iterLegalMoves(self, start: Square = None) -> Iterator[Move]:
+        '''
+        The moves getValidMoves finds (in the same order with the list backend), but generated a piece at a time and
+        filtered for checks as they go, so a caller that stops early (at the first capture, or any move at all)
+        doesn't pay for the rest. Only the moves of the piece on start if given. Nothing is cached and the position
+        mustn't change while iterating
+        '''
+        self.inCheck, self.pins, self.checks = self.checkForPinsAndChecks()
+        kingSquare = self.whiteKingLoc if self.whiteToMove else self.blackKingLoc
+        allyColour = WHITE if self.whiteToMove else BLACK
+        myKing = allyColour + KING
+        if len(self.checks) > 1:
+            # double check, king has to move
+            squares = [kingSquare] if start is None or start == kingSquare else []
+        elif start is not None:
+            squares = [start] if self.board[start[0]][start[1]][0] == allyColour else []
+        else:
+            squares = [(row, col) for row in range(len(self.board)) for col in range(len(self.board[row]))
+                       if self.board[row][col][0] == allyColour]
+        blockSquares = self.checkBlockSquares() if len(self.checks) == 1 else None
+
+        for row, col in squares:
+            moves: list[Move] = []
+            self.getPieceMoves(row, col, moves, [])
+            for move in moves:
+                if blockSquares is None or move.pieceMoved == myKing or self.blocksCheck(move, blockSquares):
+                    yield move
+
+    def hasLegalMove(self) -> bool:
+        '''
+        Whether the side to move has a legal move, i.e. is neither checkmated nor stalemated. Answered from the last
+        getValidMoves or the move cache if either has the position, otherwise by generating moves up to the first
+        legal one
+        '''
+        entry = self.validMovesEntry if self.validMovesKey == self.zobristKey else self.moveCache.get(
+            self.zobristKey) if self.moveCache is not None else None
+        if entry is not None:
+            return bool(entry[0])
+        return next(self.iterLegalMoves(), None) is not None
+
+    def legalMove(self, move: Move) -> Optional[Move]:
+        '''
+        The generated legal move with the same squares (see Move.__eq__) as move, which carries the castling, en
+        passant and promotion flags a move built from two squares lacks, or None. Only the moves of the piece on its
+        start square are generated
+        '''
+        return next((legalMove for legalMove in self.iterLegalMoves((move.startRow, move.startCol))
+                     if move == legalMove), None)
+
+    def isLegal(self, move: Move) -> bool:
+        '''
+        Whether a move with the same squares is legal here, see legalMove
+        '''
+        return self.legalMove(move) is not None
+
+    def getCaptures(self) -> list[Move]:
+        '''
+        Legal captures and promotions for quiescence search, read off the territory's attackers of each enemy piece
+        instead of generating every move. Sets inCheck, and in check returns nothing: the evasions need
+        getValidMoves. En passant captures are left out
+        '''
+        self.inCheck, self.pins, self.checks = self.checkForPinsAndChecks()
+        if self.inCheck:
+            return []
+        if self.whiteToMove:
+            allyColour, enemyColour, moveAmount, backRow = WHITE, BLACK, -1, 0
+        else:
+            allyColour, enemyColour, moveAmount, backRow = BLACK, WHITE, 1, 7
+        pins = {(pin[0], pin[1]): (pin[2], pin[3]) for pin in self.pins}
+        defenders = self.territory.counts[enemyColour]
+
+        def pinnedAway(startRow: int, startCol: int, endRow: int, endCol: int) -> bool:
+            pinDirection = pins.get((startRow, startCol))
+            if pinDirection is None:
+                return False
+            if self.board[startRow][startCol][1] == KNIGHT:
+                return True  # its jumps never stay on the pin line
+            direction = ((endRow > startRow) - (endRow < startRow), (endCol > startCol) - (endCol < startCol))
+            return direction != pinDirection and direction != (-pinDirection[0], -pinDirection[1])
+
+        captures: list[Move] = []
+        for row in range(8):
+            for col in range(8):
+                if self.board[row][col][0] != enemyColour:
+                    continue
+                for startRow, startCol in self.territory.attackedBy[row][col]:
+                    piece = self.board[startRow][startCol]
+                    if piece[0] != allyColour or pinnedAway(startRow, startCol, row, col):
+                        continue
+                    # not in check, so no slider is lined up behind the king to x-ray through it
+                    if piece[1] == KING and defenders[row][col]:
+                        continue
+                    captures.append(Move((startRow, startCol), (row, col), self.board,
+                                         pawnPromotion=piece[1] == PAWN and row == backRow))
+
+        pawnRow = backRow - moveAmount
+        for col in range(8):
+            if self.board[pawnRow][col] == allyColour + PAWN and self.board[backRow][col] == EMPTY and \
+                    not pinnedAway(pawnRow, col, backRow, col):
+                captures.append(Move((pawnRow, col), (backRow, col), self.board, pawnPromotion=True))
+        return captures
+
     def getAllPossibleMoves(self) -> Tuple[list[Move], list[Move]]:
         '''
         All moves without considering checks
         '''
+        if self.backend == BITBOARD_BACKEND:
+            return Bitboard.getAllPossibleMoves(self)
+
         moves: list[Move] = []
         protectionMoves: list[Move] = []
         for row in range(len(self.board)):
             for col in range(len(self.board[row])):
                 turn = self.board[row][col][0]
                 if (turn == WHITE and self.whiteToMove) or (turn == BLACK and not self.whiteToMove):
-                    piece = self.board[row][col][1]
-                    match piece:
-                        case Pieces.PAWN:
-                            self.getPawnMoves(
-                                row, col, moves, protectionMoves)
-                        case Pieces.ROOK:
-                            self.getRookMoves(
-                                row, col, moves, protectionMoves)
-                        case Pieces.KNIGHT:
-                            self.getKnightMoves(
-                                row, col, moves, protectionMoves)
-                        case Pieces.BISHOP:
-                            self.getBishopMoves(
-                                row, col, moves, protectionMoves)
-                        case Pieces.KING:
-                            self.getKingMoves(
-                                row, col, moves, protectionMoves)
-                        case Pieces.QUEEN:
-                            self.getQueenMoves(
-                                row, col, moves, protectionMoves)
-                        case _:
-                            raise ValueError(
-                                f"Piece undefined at ({row},{col})")
+                    self.getPieceMoves(row, col, moves, protectionMoves)
         return (moves, protectionMoves)
 
+    def getPieceMoves(self, row: int, col: int, moves: list[Move], protectionMoves: list[Move]):
+        '''
+        Moves of the piece at (row, col) without considering checks, added to moves
+        '''
+        match self.board[row][col][1]:
+            case Pieces.PAWN:
+                self.getPawnMoves(row, col, moves, protectionMoves)
+            case Pieces.ROOK:
+                self.getRookMoves(row, col, moves, protectionMoves)
+            case Pieces.KNIGHT:
+                self.getKnightMoves(row, col, moves, protectionMoves)
+            case Pieces.BISHOP:
+                self.getBishopMoves(row, col, moves, protectionMoves)
+            case Pieces.KING:
+                self.getKingMoves(row, col, moves, protectionMoves)
+            case Pieces.QUEEN:
+                self.getQueenMoves(row, col, moves, protectionMoves)
+            case _:
+                raise ValueError(
+                    f"Piece undefined at ({row},{col})")
+
     def canCaptureSquare(self, row, col) -> bool:
         '''
         Assumes valid square given, returns true is square empty or contains enemy piece, false otherwise
@@ -441,6 +906,24 @@ class GameState():
     def onBoard(self, row, col) -> bool:
         return row >= 0 and row < len(self.board) and col >= 0 and col < len(self.board[row])
 
+    def enPassantExposesKing(self, row: int, col: int, capturedCol: int) -> bool:
+        '''
+        En passant removes two pawns from the same rank, check that doing so does not open that rank onto our king
+        '''
+        kingRow, kingCol = self.whiteKingLoc if self.whiteToMove else self.blackKingLoc
+        if kingRow != row:
+            return False
+        enemyColour = BLACK if self.whiteToMove else WHITE
+        step = 1 if col > kingCol else -1
+        endCol = kingCol + step
+        while 0 <= endCol <= 7:
+            if endCol != col and endCol != capturedCol:
+                endPiece = self.board[row][endCol]
+                if endPiece != EMPTY:
+                    return endPiece[0] == enemyColour and endPiece[1] in (ROOK, QUEEN)
+            endCol += step
+        return False
+
     def getPawnMoves(self, row: int, col: int, moves: list[Move], protectionMoves: list[Move]):
         '''
         Get all pawn moves at pawn location and add to moves list
@@ -471,7 +954,8 @@ class GameState():
 
         # Pawn advance
         if self.board[row + moveAmount][col] == EMPTY:
-            if not piecePinned or pinDirection == (moveAmount, 0):
+            # a vertical pin still allows the pawn to advance along the pin line
+            if not piecePinned or pinDirection in ((moveAmount, 0), (-moveAmount, 0)):
                 moves.append(
                     Move((row, col), (row + moveAmount, col), self.board, pawnPromotion=pawnPromotion))
                 if row == startRow and self.board[row + 2 * moveAmount][col] == EMPTY:
@@ -481,28 +965,28 @@ class GameState():
         # Pawn captures
         if col - 1 >= 0:
             if not piecePinned or pinDirection == (moveAmount, -1):
+                move = Move((row, col), (row + moveAmount, col - 1),
+                            self.board, pawnPromotion=pawnPromotion)
                 if self.board[row + moveAmount][col - 1][0] == enemyColour:
-                    moves.append(
-                        Move((row, col), (row + moveAmount, col - 1), self.board, pawnPromotion=pawnPromotion))
+                    moves.append(move)
 
-                if (row + moveAmount, col - 1) == self.enPassantPossible:
+                if (row + moveAmount, col - 1) == self.enPassantPossible and not self.enPassantExposesKing(row, col, col - 1):
                     moves.append(
                         Move((row, col), (row + moveAmount, col - 1), self.board, enPassant=True))
 
-                protectionMoves.append(
-                    Move((row, col), (row + moveAmount, col - 1), self.board, pawnPromotion=pawnPromotion))
+                protectionMoves.append(move)
 
         if col + 1 <= 7:
             if not piecePinned or pinDirection == (moveAmount, 1):
+                move = Move((row, col), (row + moveAmount, col + 1),
+                            self.board, pawnPromotion=pawnPromotion)
                 if self.board[row + moveAmount][col + 1][0] == enemyColour:
-                    moves.append(
-                        Move((row, col), (row + moveAmount, col + 1), self.board, pawnPromotion=pawnPromotion))
-                if (row + moveAmount, col + 1) == self.enPassantPossible:
+                    moves.append(move)
+                if (row + moveAmount, col + 1) == self.enPassantPossible and not self.enPassantExposesKing(row, col, col + 1):
                     moves.append(
                         Move((row, col), (row + moveAmount, col + 1), self.board, enPassant=True))
 
-                protectionMoves.append(
-                    Move((row, col), (row + moveAmount, col + 1), self.board, pawnPromotion=pawnPromotion))
+                protectionMoves.append(move)
 
     def getRookMoves(self, row: int, col: int, moves: list[Move], protectionMoves: list[Move]):
         '''
@@ -539,20 +1023,15 @@ class GameState():
 
                 if 0 <= endRow <= 7 and 0 <= endCol <= 7:  # looking on the board
                     if not piecePinned or pinDirection == (rowShift, colShift) or pinDirection == (-rowShift, -colShift):
+                        move = Move((row, col), (endRow, endCol), self.board,
+                                    castleRightsChanged=castleRightsChanged)
+                        protectionMoves.append(move)
                         if self.board[endRow][endCol] == EMPTY:
-                            moves.append(
-                                Move((row, col), (endRow, endCol), self.board, castleRightsChanged=castleRightsChanged))
-                            protectionMoves.append(
-                                Move((row, col), (endRow, endCol), self.board, castleRightsChanged=castleRightsChanged))
+                            moves.append(move)
                         elif self.board[endRow][endCol][0] == enemyColour:
-                            moves.append(
-                                Move((row, col), (endRow, endCol), self.board, castleRightsChanged=castleRightsChanged))
-                            protectionMoves.append(
-                                Move((row, col), (endRow, endCol), self.board, castleRightsChanged=castleRightsChanged))
+                            moves.append(move)
                             break  # cant look beyond this piece
                         else:
-                            protectionMoves.append(
-                                Move((row, col), (endRow, endCol), self.board, castleRightsChanged=castleRightsChanged))
                             break  # hit ally piece, cannot attack or go further
                     else:
                         break  # cant move rook in this direction due to pin
@@ -576,12 +1055,11 @@ class GameState():
                         newCol = col + (colMultiplier * colInc)
                         # col on board
                         if newCol >= 0 and newCol < len(self.board[newRow]):
+                            move = Move((row, col), (newRow, newCol), self.board)
                             if self.canCaptureSquare(newRow, newCol):
-                                moves.append(
-                                    Move((row, col), (newRow, newCol), self.board))
+                                moves.append(move)
 
-                            protectionMoves.append(
-                                Move((row, col), (newRow, newCol), self.board))
+                            protectionMoves.append(move)
 
     def getBishopMoves(self, row: int, col: int, moves: list[Move], protectionMoves: list[Move]):
         '''
@@ -606,69 +1084,68 @@ class GameState():
                         newRow = row + rowShift
                         newCol = col + colShift
                         if self.onBoard(newRow, newCol):
+                            move = Move((row, col), (newRow, newCol), self.board)
+                            protectionMoves.append(move)
                             if self.board[newRow][newCol] == EMPTY:
-                                moves.append(
-                                    Move((row, col), (newRow, newCol), self.board))
-                                protectionMoves.append(
-                                    Move((row, col), (newRow, newCol), self.board))
+                                moves.append(move)
                             elif self.canCaptureSquare(newRow, newCol):
-                                moves.append(
-                                    Move((row, col), (newRow, newCol), self.board))
-                                protectionMoves.append(
-                                    Move((row, col), (newRow, newCol), self.board))
+                                moves.append(move)
                                 break  # cannot look further
                             else:
-                                protectionMoves.append(
-                                    Move((row, col), (newRow, newCol), self.board))
                                 break  # hit ally
                             rowShift += rowShiftInc
                             colShift += colShiftInc
                         else:
                             break  # looking off the board
                 else:  # cant move in this direction
-                    break
+                    continue
 
     def getKingMoves(self, row: int, col: int, moves: list[Move], protectionMoves: list[Move]):
         '''
         Get all king moves at king location and add to moves list
         '''
-        # wks, wqs, bks, bqs = self.currentCastleRights
+        if self.backend == BITBOARD_BACKEND:
+            return Bitboard.getKingMoves(self, row, col, moves, protectionMoves)
 
         castlingRightsChanged = True if (self.whiteToMove and (row, col) == (7, 4)) \
             or (not self.whiteToMove and (row, col) == (0, 4)) else False
 
-        for rowShift in [-1, 0, 1]:
-            for colShift in [-1, 0, 1]:
-                if not (rowShift == 0 and colShift == 0):  # not looking at curr pos
-                    newRow, newCol = row + rowShift, col + colShift
-                    if self.onBoard(newRow, newCol):
-                        if self.canCaptureSquare(newRow, newCol):
-                            if self.whiteToMove:  # place King on end square and check for checks
-                                self.whiteKingLoc = (newRow, newCol)
-                            else:
-                                self.blackKingLoc = (newRow, newCol)
-                            inCheck, pins, checks = self.checkForPinsAndChecks(
-                                phantom=True)
-                            if not inCheck:
-                                moves.append(
-                                    Move((row, col), (newRow, newCol), self.board, castleRightsChanged=castlingRightsChanged))
-                                protectionMoves.append(Move(
-                                    (row, col), (newRow, newCol), self.board, castleRightsChanged=castlingRightsChanged))
-                                debug(f"King can move to ({newRow},{newCol})")
-                            elif len(checks) == 1:
-                                protectionMoves.append(Move(
-                                    (row, col), (newRow, newCol), self.board, castleRightsChanged=castlingRightsChanged))
-                            if self.whiteToMove:
-                                self.whiteKingLoc = (row, col)
-                            else:
-                                self.blackKingLoc = (row, col)
-                        else:
-                            protectionMoves.append(Move(
-                                (row, col), (newRow, newCol), self.board, castleRightsChanged=castlingRightsChanged))
+        attackers = self.kingSquareAttackers(row, col)
+        for newRow, newCol in KING_TARGETS[row][col]:
+            if self.canCaptureSquare(newRow, newCol):
+                if attackers[newRow][newCol] == 0:
+                    move = Move((row, col), (newRow, newCol), self.board,
+                                castleRightsChanged=castlingRightsChanged)
+                    moves.append(move)
+                    protectionMoves.append(move)
+                    debug("King can move to (%d,%d)", newRow, newCol)
+                elif attackers[newRow][newCol] == 1:
+                    protectionMoves.append(Move(
+                        (row, col), (newRow, newCol), self.board, castleRightsChanged=castlingRightsChanged))
+            else:
+                protectionMoves.append(Move(
+                    (row, col), (newRow, newCol), self.board, castleRightsChanged=castlingRightsChanged))
 
-        self.getCastlingMoves(row, col, moves)
+        self.getCastlingMoves(row, col, moves, attackers)
 
-    def getCastlingMoves(self, row: int, col: int, moves: list[Move]):
+    def kingSquareAttackers(self, row: int, col: int) -> list[list[int]]:
+        '''
+        Enemy attackers of every square once the king on (row, col) steps off it, in a single pass: the territory
+        map counts plus the squares behind the king on the line of a checking slider
+        '''
+        enemyColour = BLACK if self.whiteToMove else WHITE
+        attackers = self.territory.counts[enemyColour]
+        xRayed = [(row - checkDirV, col - checkDirH) for checkRow, checkCol, checkDirV, checkDirH in self.checks
+                  if self.board[checkRow][checkCol][1] in (ROOK, BISHOP, QUEEN)]
+        if not xRayed:
+            return attackers
+        attackers = [counts[:] for counts in attackers]
+        for xRayRow, xRayCol in xRayed:
+            if 0 <= xRayRow < 8 and 0 <= xRayCol < 8:
+                attackers[xRayRow][xRayCol] += 1
+        return attackers
+
+    def getCastlingMoves(self, row: int, col: int, moves: list[Move], attackers: list[list[int]]):
         if self.inCheck:
             return  #  cant castle out of a check!
 
@@ -687,38 +1164,10 @@ class GameState():
                         clearSight = False
                         break
 
-                if clearSight:
-                    canCastle = True
-                    # check empty squares are not being attacked
-                    if self.whiteToMove:  # white king
-                        for i in range(1, 3):
-                            self.whiteKingLoc = (row, col + dir * i)
-                            inCheck, _, _ = self.checkForPinsAndChecks(
-                                phantom=True)
-                            if inCheck:
-                                canCastle = False
-                                break
-
-                        if canCastle:
-                            moves.append(Move((row, col), (row, col + dir * 2),
-                                         self.board, castleRightsChanged=True, isCastle=True, kingSideCastle=(maxDepth == 2)))
-
-                        self.whiteKingLoc = (row, col)
-
-                    else:  #  black king
-                        for i in range(1, 3):
-                            self.blackKingLoc = (row, col + dir * i)
-                            inCheck, _, _ = self.checkForPinsAndChecks(
-                                phantom=True)
-                            if inCheck:
-                                canCastle = False
-                                break
-
-                        if canCastle:
-                            moves.append(Move((row, col), (row, col + dir * 2),
-                                         self.board, castleRightsChanged=True, isCastle=True, kingSideCastle=(maxDepth == 2)))
-
-                        self.blackKingLoc = (row, col)
+                # check empty squares the king crosses are not being attacked
+                if clearSight and attackers[row][col + dir] == 0 and attackers[row][col + dir * 2] == 0:
+                    moves.append(Move((row, col), (row, col + dir * 2),
+                                 self.board, castleRightsChanged=True, isCastle=True, kingSideCastle=(maxDepth == 2)))
 
     def getQueenMoves(self, row: int, col: int, moves: list[Move], protectionMoves: list[Move]):
         '''
@@ -739,34 +1188,8 @@ class GameState():
 
         # check if another piece of same type could've moved to that square (not pawn or king)
         if lastMove.pieceMoved[1] not in [PAWN, KING]:
-            foundSameFile = False
-            foundSameRank = False
-            foundSame = False
-
-            for move in validMoves:
-                if move != lastMove and move.pieceMoved == lastMove.pieceMoved and move.endRow == lastMove.endRow and move.endCol == lastMove.endCol:
-                    foundSame = True
-                    # there can be confusion in the notation, clear it up
-                    _, _, _, _, _, otherStartRank, otherStartFile, _ = move.getChessNotation()
-
-                    foundSameFile = otherStartFile == startFile or foundSameFile
-                    foundSameRank = otherStartRank == startRank or foundSameRank
-
-                    if foundSameRank and foundSameFile:
-                        # Once there exists same piece type for both rank and file that could've made that move,
-                        # we now know we need to be extremely explicit which piece moved using both rank and file
-                        break
-
-            if foundSame:
-                if foundSameFile and foundSameRank:
-                    file = startFile
-                    rank = startRank
-                elif foundSameFile:
-                    rank = startRank
-                # elif foundSameRank:
-                #     file = startFile
-                else:
-                    file = startFile
+            file, rank = disambiguation(lastMove, [move for move in validMoves if move != lastMove and move.pieceMoved ==
+                                                   lastMove.pieceMoved and move.endRow == lastMove.endRow and move.endCol == lastMove.endCol])
 
         notation = movedPiece + file + rank + \
             captureFlag + endSquare + pawnPromotion + checkFlag
@@ -775,20 +1198,85 @@ class GameState():
             print(properNotation)
         return notation
 
-    def convertNotationToValidMove(self, notation: str, validMoves: list[Move]) -> Move:
-        notations = []
-        for move in validMoves:
-            moveNotation = self.displayNotation(
-                validMoves, lastMove=move, display=False)
-            notations.append(moveNotation)
-            if notation.startswith(moveNotation):
-                return move
-        print(f"Possible moves:\n{notations}")
-        print(self.board)
+    def getNotationIndex(self, validMoves: list[Move] = None) -> dict[str, Move]:
+        '''
+        SAN (without check flags or promotion piece) of every legal move in the current position, built in one
+        pass and kept in the move cache entry next to the moves it indexes
+        '''
+        if validMoves is None:
+            validMoves, _ = self.getValidMoves()
+        entry = self.validMovesEntry
+        if self.validMovesKey != self.zobristKey or entry[0] is not validMoves:
+            # moves that didn't come from getValidMoves for this position
+            return buildNotationIndex(validMoves)
+        if entry[4] is None:
+            entry[4] = buildNotationIndex(validMoves)
+        return entry[4]
+
+    def convertNotationToValidMove(self, notation: str, validMoves: list[Move] = None, display: bool = True) -> Move:
+        '''
+        Legal move for a SAN token, check flags and annotations are ignored and a promotion piece (e8=Q) is
+        set on the returned move
+        '''
+        notation, _, promotionChoice = notation.rstrip('+#!?').partition('=')
+        notation = notation.replace('O', '0')  # PGN castles with the letter O
+        if promotionChoice and promotionChoice not in [QUEEN, ROOK, BISHOP, KNIGHT]:
+            raise ValueError(
+                f"Provided notation '{notation}={promotionChoice}' promotes to an unknown piece!")
+
+        notationIndex = self.getNotationIndex(validMoves)
+        move = notationIndex.get(notation)
+        if move is not None and (move.isPawnPromotion or not promotionChoice):
+            return move.withPromotion(promotionChoice) if promotionChoice else move
+        if display:
+            print(f"Possible moves:\n{list(notationIndex)}")
+            print(self.board)
         raise ValueError(
             f"Provided notation '{notation}' is not valid in current game state!")
 
 
+def disambiguation(move: Move, others: list[Move]) -> Tuple[str, str]:
+    '''
+    File and rank needed to tell move apart from others, the moves of same type of piece to the same square
+    '''
+    if not others:
+        return '', ''
+    _, _, _, _, _, startRank, startFile, _ = move.getChessNotation()
+    foundSameFile = any(other.startCol == move.startCol for other in others)
+    foundSameRank = any(other.startRow == move.startRow for other in others)
+    if foundSameFile and foundSameRank:
+        # need to be extremely explicit which piece moved using both rank and file
+        return startFile, startRank
+    if foundSameFile:
+        return '', startRank
+    return startFile, ''
+
+
+def buildNotationIndex(validMoves: list[Move]) -> dict[str, Move]:
+    '''
+    SAN to move for every move in validMoves, pieces that could've moved to the same square are found
+    through a dict instead of searching the whole list again
+    '''
+    sameTarget: dict[Tuple[str, int, int], list[Move]] = {}
+    for move in validMoves:
+        if move.pieceMoved[1] not in [PAWN, KING]:
+            sameTarget.setdefault(
+                (move.pieceMoved, move.endRow, move.endCol), []).append(move)
+
+    notationIndex = {}
+    for move in validMoves:
+        castle, movedPiece, captureFlag, endSquare, _, _, _, _ = move.getChessNotation()
+        if castle:
+            notationIndex[castle] = move
+            continue
+        file = rank = ''
+        if move.pieceMoved[1] not in [PAWN, KING]:
+            file, rank = disambiguation(move, [other for other in sameTarget[(
+                move.pieceMoved, move.endRow, move.endCol)] if other is not move])
+        notationIndex[movedPiece + file + rank + captureFlag + endSquare] = move
+    return notationIndex
+
+
 def main() -> None:
     opening = ["e4", "e5"]
     gs = GameState()
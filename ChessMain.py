@@ -1,159 +1,585 @@
 # Handle user input, display current game state
+import argparse
+import os
+from collections import OrderedDict
+from typing import Tuple
 import pygame as p
+import Analysis
 import ChessEngine
+import Fen
+import PgnImport
 import Pieces
+import PositionStore
+import Profiling
+import Search
+import SpriteAtlas
 # from Pieces import PIECES, EMPTY, WHITE, BLACK
 from ChessEngine import debug
 
-WIDTH = HEIGHT = 640  # 640 | 512 | 400
+WIDTH = HEIGHT = 640  # starting window size, it can be resized
 DIMENSION = 8
-SQ_SIZE = HEIGHT // DIMENSION
-MAX_FPS = 15  # for animations
+DESIGN_SQ_SIZE = 80  # square size the font sizes and offsets below were picked for
+MIN_SQ_SIZE = 8
+MAX_FPS = 15  # main loop rate when polling for events
+ANIMATION_FPS = 60  # frame budget while a move is animating
+ANIMATION_TIME = 1 / 6  # seconds a move takes to slide, however many frames that turns out to be
+EVENT_DRIVEN = True  # sleep until the next event instead of polling at MAX_FPS
+BOARD_COLOURS = ["white", "dark grey"]  # light, dark
+COORD_FONT = ("Comic Sans MS", 15)
+BANNER_FONT = "Helvetica"  # bold, size given per banner
+TEXT_CACHE_SIZE = 128  # rendered strings
+UNDO_HINT = ("(shft+)cmd+z to re/undo, cmd+r to restart", "black", False, 22, 60)
+SEEK_STEP = 10  # moves page up/down jump through the game
+# positions whose legal moves are kept, so stepping back and forth through a game doesn't regenerate them. Enough for
+# a long game and its side lines, unlike perft and search the GUI keeps coming back to the same positions
+MOVE_CACHE_SIZE = 1024
+SUGGEST_TIME = 1.0  # seconds the engine thinks about each position while h analysis is on
+ANALYSIS_EVENT = p.USEREVENT + 1  # posted from the analysis listener thread, USEREVENT is the undo timer
+SUGGESTION_COLOUR = "green"
+OVERLAY_FONT = ("Courier New", 12)
+OVERLAY_ROWS = 8  # functions listed while p profiling is on, most self time first
+# drawText arguments for each way a game can end
+GAME_OVER_TEXTS = {
+    "black": (("Black wins by checkmate!", "black", False, 32, 0), UNDO_HINT),
+    "white": (("White wins by checkmate!", "white", False, 32, 0), UNDO_HINT),
+    "stalemate": (("Stalemate :/", "black", True, 32, 0), UNDO_HINT),
+}
+IMAGE_DIR = "images"
+ATLAS_PATH = os.path.join(IMAGE_DIR, "atlas.bin")  # piece sprites at every size used so far, see SpriteAtlas
 IMAGES = {}
 
 
+class Layout():
+    '''
+    Where the board sits in the window: the largest whole-pixel squares that fit, centred.
+    Drawing goes through it (or onto its board surface) and so does hit-testing, so the window can be any size
+    '''
+
+    def __init__(self, width: int, height: int) -> None:
+        self.resize(width, height)
+
+    def resize(self, width: int, height: int) -> bool:
+        '''
+        Fit the board to a new window size, returns True if the squares changed size
+        '''
+        oldSqSize = getattr(self, "sqSize", None)
+        self.width, self.height = width, height
+        self.sqSize = max(min(width, height) // DIMENSION, MIN_SQ_SIZE)
+        self.boardSize = self.sqSize * DIMENSION
+        # a window smaller than the smallest board crops it on the right and bottom
+        self.left = max((width - self.boardSize) // 2, 0)
+        self.top = max((height - self.boardSize) // 2, 0)
+        return self.sqSize != oldSqSize
+
+    def scaled(self, length: float, minimum: int = 0) -> int:
+        '''
+        A length picked for DESIGN_SQ_SIZE squares, at the current square size
+        '''
+        return max(round(length * self.sqSize / DESIGN_SQ_SIZE), minimum)
+
+    def boardRect(self) -> p.Rect:
+        return p.Rect(self.left, self.top, self.boardSize, self.boardSize)
+
+    def boardSurface(self, screen: p.Surface) -> p.Surface:
+        '''
+        The part of screen the board covers, drawing functions work in its coordinates
+        '''
+        return screen.subsurface(self.boardRect().clip(screen.get_rect()))
+
+    def squareRect(self, row: int, col: int) -> p.Rect:
+        '''
+        (row, col) in board surface coordinates
+        '''
+        return p.Rect(col * self.sqSize, row * self.sqSize, self.sqSize, self.sqSize)
+
+    def toWindow(self, rect: p.Rect) -> p.Rect:
+        return rect.move(self.left, self.top)
+
+    def squareAt(self, x: int, y: int) -> ChessEngine.Square:
+        '''
+        Square under window position (x, y), None off the board
+        '''
+        col = (x - self.left) // self.sqSize
+        row = (y - self.top) // self.sqSize
+        if 0 <= row < DIMENSION and 0 <= col < DIMENSION:
+            return (row, col)
+        return None
+
+
+layout = Layout(WIDTH, HEIGHT)
+
+
 def loadImages():
-    for piece in Pieces.PIECES:
-        IMAGES[piece] = p.transform.scale(p.image.load(
-            f"images/{piece}.png"), (SQ_SIZE, SQ_SIZE))
-
-
-def highlightSquares(screen: p.Surface, validMoves: list[ChessEngine.Move], protectionMoves: list[ChessEngine.Move], sqSelected: ChessEngine.Square):
-    if sqSelected != ():
-        row, col = sqSelected
-
-        # sqSelected is a piece that can be moved
-        if gs.board[row][col][0] == (Pieces.WHITE if gs.whiteToMove else Pieces.BLACK):
-            #  highlight selected square
-            s = p.Surface((SQ_SIZE, SQ_SIZE))
-            s.set_alpha(100)  # transparency value -> 0 transparent; 255 opaque
-            s.fill(p.Color("blue"))
-            screen.blit(s, (col * SQ_SIZE, row * SQ_SIZE))
-            # highlight moves from that square
-            s.fill(p.Color("yellow"))
-            for move in validMoves:
-                if move.startRow == row and move.startCol == col:
-                    screen.blit(
-                        s, (move.endCol * SQ_SIZE, move.endRow * SQ_SIZE))
-    else:
-        for row in range(DIMENSION):
-            for col in range(DIMENSION):
-                sq_colour = (128, 128, 128)
-                p.draw.rect(screen, sq_colour, p.Rect(
-                    col*SQ_SIZE, row*SQ_SIZE, SQ_SIZE, SQ_SIZE))
-                p.draw.rect(screen, "black", p.Rect(
-                    col*SQ_SIZE, row*SQ_SIZE, SQ_SIZE, SQ_SIZE), 1)
-        (allyColour, enemyColour) = (
-            "Blue", "Red") if gs.whiteToMove else ("Red", "Blue")
-        s = p.Surface((SQ_SIZE, SQ_SIZE))
-        s.set_alpha(60)  # transparency value -> 0 transparent; 255 opaque
-        s.fill(p.Color(allyColour))
-        for move in protectionMoves:
-            screen.blit(
-                s, (move.endCol * SQ_SIZE, move.endRow * SQ_SIZE))
-
-        s.fill(p.Color(enemyColour))
-        attackMoves = gs.getEnemyTerritory()
-        for move in attackMoves:
-            screen.blit(
-                s, (move.endCol * SQ_SIZE, move.endRow * SQ_SIZE))
-
-
-def drawGameState(screen: p.Surface, validMoves: list[ChessEngine.Move], protectionMoves: list[ChessEngine.Move], sqSelected: ChessEngine.Square):
     '''
-    Responsible for all the graphics within a current game state
+    Fill IMAGES with sprites for the current square size from the saved atlas, only decoding the PNGs if it's missing
+    or out of date. Called again after a resize, when the atlas is already loaded and usually has the size cached
+    '''
+    global atlas
+    if globals().get("atlas") is None:
+        atlas = SpriteAtlas.loadAtlas(ATLAS_PATH, IMAGE_DIR) or SpriteAtlas.buildAtlas(IMAGE_DIR)
+    IMAGES.update(atlas.sprites(layout.sqSize))
+    if atlas.changed:
+        try:
+            atlas.save(ATLAS_PATH)
+        except OSError as e:
+            debug(f"Couldn't save sprite atlas: {e}")
+
+
+class TextCache():
+    '''
+    Bounded least recently used cache of rendered text keyed by string, font, size and colour.
+    Fonts are looked up once each, and banners are pre-blended into a single surface
     '''
-    drawBoard(screen)  # draw squares on board
-    # add in piece highlighting or move suggestions [later] (code for attack visualiser goes here)
-    highlightSquares(screen, validMoves, protectionMoves, sqSelected)
-    drawBorder(screen)
-    drawPieces(screen, gs.board)  # draw pieces on top of those squares
-    drawCoords(screen)
 
+    def __init__(self, maxSize: int = TEXT_CACHE_SIZE) -> None:
+        self.maxSize = maxSize
+        self.fonts: dict[tuple, p.font.Font] = {}
+        self.surfaces: OrderedDict[tuple, p.Surface] = OrderedDict()
+
+    def font(self, name: str, size: int, bold: bool = False) -> p.font.Font:
+        key = (name, size, bold)
+        font = self.fonts.get(key)
+        if font is None:
+            font = self.fonts[key] = p.font.SysFont(name, size, bold, False)
+        return font
+
+    def render(self, text: str, name: str, size: int, colour: str, bold: bool = False, antialias: bool = True) -> p.Surface:
+        key = ("text", text, name, size, colour, bold, antialias)
+        surface = self._get(key)
+        if surface is None:
+            surface = self.font(name, size, bold).render(
+                text, antialias, p.Color(colour))
+            self._put(key, surface)
+        return surface
+
+    def banner(self, text: str, colour: str = "black", stalemate: bool = False, size: int = 32) -> p.Surface:
+        '''
+        drawText's black, green (or yellow) and colour copies of text, each shifted a pixel, as one surface
+        '''
+        key = ("banner", text, colour, stalemate, size)
+        surface = self._get(key)
+        if surface is None:
+            layers = [self.render(text, BANNER_FONT, size, layerColour, True, False)
+                      for layerColour in ["black", "Green" if not stalemate else "Yellow", colour]]
+            width, height = layers[0].get_size()
+            surface = p.Surface((width + 2, height + 2), p.SRCALPHA)
+            for offset, layer in enumerate(layers):
+                surface.blit(layer, (offset, offset))
+            self._put(key, surface)
+        return surface
+
+    def _get(self, key: tuple) -> p.Surface:
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+        return surface
+
+    def _put(self, key: tuple, surface: p.Surface):
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.maxSize:
+            self.surfaces.popitem(last=False)
+
+
+TEXT_CACHE = TextCache()
+
+
+def preloadText():
+    '''
+    Rasterise the coordinates and every game over banner once at startup (and after a resize), not while drawing
+    '''
+    for label in [str(rank + 1) for rank in range(DIMENSION)] + list("abcdefgh"):
+        TEXT_CACHE.render(label, COORD_FONT[0],
+                          layout.scaled(COORD_FONT[1], 1), "black")
+    for texts in GAME_OVER_TEXTS.values():
+        for text, colour, stalemate, size, _ in texts:
+            TEXT_CACHE.banner(text, colour, stalemate,
+                              layout.scaled(size, 1))
 
-# Top left square is always light
-def drawBoard(screen: p.Surface):
+
+class MoveAnimation():
     '''
-    Draw the squares on the board
+    Pieces sliding between squares, drawn by the renderer over its cached squares. Where they are comes from the time
+    since the animation started, so a slow host skips frames instead of slowing the move down, and nothing blocks:
+    a new move or undo just replaces the animation
     '''
-    global colours
-    colours = [p.Color("white"), p.Color("dark grey")]
 
-    for row in range(DIMENSION):
-        for col in range(DIMENSION):
-            colour = colours[(row + col) % 2]
-            p.draw.rect(screen, colour, p.Rect(
-                col * SQ_SIZE, row * SQ_SIZE, SQ_SIZE, SQ_SIZE))
+    def __init__(self, move: ChessEngine.Move, undoMove: bool, duration: float = ANIMATION_TIME) -> None:
+        self.startTime = p.time.get_ticks()
+        self.duration = duration * 1000  # ms
+        start, end = (move.startRow, move.startCol), (move.endRow, move.endCol)
+        # (piece, from, to) for each sliding sprite
+        self.sprites: list[tuple] = []
+        # what to show on squares the board already has the sliding pieces on
+        self.overrides: dict[ChessEngine.Square, str] = {}
+
+        if not undoMove:
+            self.sprites.append((move.pieceMoved, start, end))
+            # the captured piece stays until it's covered
+            self.overrides[end] = move.pieceCaptured
+        else:
+            self.sprites.append((move.pieceMoved, end, start))
+            self.overrides[start] = Pieces.EMPTY
+        if move.isCastle:
+            row = move.endRow
+            rookStart, rookEnd = ((row, 7), (row, 5)) if move.kingSideCastle else (
+                (row, 0), (row, 3))
+            if undoMove:
+                rookStart, rookEnd = rookEnd, rookStart
+            self.sprites.append(
+                (move.pieceMoved[0] + Pieces.ROOK, rookStart, rookEnd))
+            self.overrides[rookEnd] = Pieces.EMPTY
+
+    def progress(self) -> float:
+        return min((p.time.get_ticks() - self.startTime) / self.duration, 1) if self.duration else 1
+
+    def finished(self) -> bool:
+        return self.progress() >= 1
+
+    def spriteRects(self) -> list[Tuple[str, p.Rect]]:
+        '''
+        (piece, board surface rect) of every sprite where it is now
+        '''
+        progress = self.progress()
+        sqSize = layout.sqSize
+        rects = []
+        for piece, (startRow, startCol), (endRow, endCol) in self.sprites:
+            x = round((startCol + (endCol - startCol) * progress) * sqSize)
+            y = round((startRow + (endRow - startRow) * progress) * sqSize)
+            rects.append((piece, p.Rect(x, y, sqSize, sqSize)))
+        return rects
+
+
+def moveAnimation(undoMove: bool) -> MoveAnimation:
+    '''
+    Animation of the move just made, undone or redone in gs
+    '''
+    move = gs.moveLog[gs.moveIdx] if not undoMove else gs.moveLog[gs.moveIdx +
+                                                                  1 if gs.moveIdx != None else 0]
+    return MoveAnimation(move, undoMove)
+
+
+class BoardRenderer():
+    '''
+    Retained-mode drawing of the game state. Square backgrounds (with their territory overlay or highlight) and the
+    coordinate and text layers are composed once and cached, and each frame only redraws the squares whose contents
+    changed since they were last drawn, returning their rects for p.display.update
+    '''
+
+    def __init__(self, screen: p.Surface) -> None:
+        self.texts: tuple = ()
+        # where animated sprites were drawn last frame, those squares need redrawing underneath
+        self.spriteRects: list[p.Rect] = []
+        # (2, 8, 8) white and black attacker counts shown instead of gs.territory, e.g. from a PositionStore
+        self.territory = None
+        self.suggestion: ChessEngine.Move = None  # its squares are highlighted while nothing is selected
+        self.overlay: list[str] = []  # lines of text drawn in a panel over the top left of the board
+        self.resize(screen)
+
+    def resize(self, screen: p.Surface, rescale: bool = True):
+        '''
+        Start drawing onto screen at the current layout, when rescale the squares changed size and the cached
+        layers are rebuilt, otherwise the board only moved
+        '''
+        self.screen = layout.boardSurface(screen)
+        self.drawn = None
+        if not rescale:
+            return
+        # background key -> composed square, see squareBackground
+        self.backgrounds: dict[tuple, p.Surface] = {}
+        self.coordLayer = p.Surface(
+            (layout.boardSize, layout.boardSize), p.SRCALPHA)
+        drawCoords(self.coordLayer)
+        self.textLayer = self.drawTextLayer(self.texts)
+        # state of every square as last drawn, None forces a full redraw
+        self.drawn: list[list[tuple]] = None
+
+    def drawTextLayer(self, texts: tuple) -> p.Surface:
+        if not texts:
+            return None
+        textLayer = p.Surface(
+            (layout.boardSize, layout.boardSize), p.SRCALPHA)
+        for args in texts:
+            drawText(textLayer, *args)
+        return textLayer
+
+    def invalidate(self):
+        '''
+        Redraw everything next frame, for when something else drew over the screen
+        '''
+        self.drawn = None
+
+    def draw(self, validMoves: list[ChessEngine.Move], sqSelected: ChessEngine.Square, texts: tuple = (), animation: MoveAnimation = None) -> list[p.Rect]:
+        '''
+        Bring the screen up to date, texts are drawText argument tuples drawn over the board.
+        Returns the window rects that changed
+        '''
+        if texts != self.texts:
+            self.texts = texts
+            self.textLayer = self.drawTextLayer(texts)
+            self.invalidate()
+
+        sprites = animation.spriteRects() if animation is not None else []
+        # squares under the sprites, both where they were and where they're going
+        covered = set()
+        for rect in self.spriteRects + [rect for _, rect in sprites]:
+            covered |= squaresUnder(rect)
+        self.spriteRects = [rect for _, rect in sprites]
+
+        states = self.squareStates(
+            validMoves, sqSelected, animation.overrides if animation is not None else {})
+        dirty = []
+        for row in range(DIMENSION):
+            for col in range(DIMENSION):
+                if self.drawn is None or self.drawn[row][col] != states[row][col] or (row, col) in covered:
+                    dirty.append(layout.toWindow(
+                        self.drawSquare(row, col, states[row][col])))
+        self.drawn = states
+
+        for piece, rect in sprites:
+            self.screen.blit(IMAGES[piece], rect)
+        if self.overlay:
+            # redrawn every frame, its squares are redrawn underneath next frame like a sprite's
+            rect = self.drawOverlay(self.overlay)
+            self.spriteRects.append(rect)
+            dirty.append(layout.toWindow(rect))
+        return dirty
+
+    def drawOverlay(self, lines: list[str]) -> p.Rect:
+        fontSize = layout.scaled(OVERLAY_FONT[1], 1)
+        padding = layout.scaled(4)
+        surfaces = [TEXT_CACHE.render(line, OVERLAY_FONT[0], fontSize, "white") for line in lines]
+        width = max(surface.get_width() for surface in surfaces) + 2 * padding
+        height = sum(surface.get_height() for surface in surfaces) + 2 * padding
+        panel = p.Surface((min(width, layout.boardSize), min(height, layout.boardSize)), p.SRCALPHA)
+        panel.fill((0, 0, 0, 180))
+        y = padding
+        for surface in surfaces:
+            panel.blit(surface, (padding, y))
+            y += surface.get_height()
+        return self.screen.blit(panel, (0, 0))
+
+    def squareStates(self, validMoves: list[ChessEngine.Move], sqSelected: ChessEngine.Square, overrides: dict = {}) -> list[list[tuple]]:
+        '''
+        (background key, piece, border colour) for every square, the border only matters on the edge squares.
+        overrides replaces the piece on some squares, for animations
+        '''
+        highlights = {}
+        if sqSelected != ():
+            row, col = sqSelected
+            # sqSelected is a piece that can be moved
+            if gs.board[row][col][0] == (Pieces.WHITE if gs.whiteToMove else Pieces.BLACK):
+                for move in validMoves:
+                    if move.startRow == row and move.startCol == col:
+                        highlights[(move.endRow, move.endCol)] = "yellow"
+                highlights[sqSelected] = "blue"
+        if sqSelected == () and self.suggestion is not None:
+            move = self.suggestion
+            highlights[(move.startRow, move.startCol)] = highlights[(
+                move.endRow, move.endCol)] = SUGGESTION_COLOUR
+        border = borderColour()
+        if self.territory is not None:
+            whiteCounts, blackCounts = self.territory.tolist()
+        else:
+            whiteCounts = gs.territory.counts[Pieces.WHITE]
+            blackCounts = gs.territory.counts[Pieces.BLACK]
+        allyCounts, enemyCounts = (whiteCounts, blackCounts) if gs.whiteToMove else (blackCounts, whiteCounts)
+
+        states = []
+        for row in range(DIMENSION):
+            stateRow = []
+            for col in range(DIMENSION):
+                if sqSelected != () or (row, col) in highlights:
+                    background = ("board", (row + col) % 2,
+                                  highlights.get((row, col)))
+                else:
+                    background = ("territory", allyCounts[row][col], enemyCounts[row][col])
+                onEdge = row in (0, DIMENSION - 1) or col in (0, DIMENSION - 1)
+                piece = overrides.get((row, col), gs.board[row][col])
+                stateRow.append(
+                    (background, piece, border if onEdge else None))
+            states.append(stateRow)
+        return states
+
+    def squareBackground(self, key: tuple) -> p.Surface:
+        surface = self.backgrounds.get(key)
+        if surface is not None:
+            return surface
+        surface = p.Surface((layout.sqSize, layout.sqSize))
+        rect = p.Rect(0, 0, layout.sqSize, layout.sqSize)
+        s = p.Surface((layout.sqSize, layout.sqSize))
+        if key[0] == "board":
+            _, parity, highlight = key
+            surface.fill(p.Color(BOARD_COLOURS[parity]))
+            if highlight is not None:
+                s.set_alpha(100)  # transparency value -> 0 transparent; 255 opaque
+                s.fill(p.Color(highlight))
+                surface.blit(s, (0, 0))
+        else:
+            _, allyCount, enemyCount = key
+            surface.fill((128, 128, 128))
+            p.draw.rect(surface, "black", rect, 1)
+            # the side to move's territory is blue and the opponent's red, one blit per attacker so contested squares
+            # get darker
+            s.set_alpha(60)
+            for territoryColour, count in (("Blue", allyCount), ("Red", enemyCount)):
+                s.fill(p.Color(territoryColour))
+                for _ in range(count):
+                    surface.blit(s, (0, 0))
+        self.backgrounds[key] = surface
+        return surface
+
+    def drawSquare(self, row: int, col: int, state: tuple) -> p.Rect:
+        background, piece, border = state
+        rect = layout.squareRect(row, col)
+        self.screen.blit(self.squareBackground(background), rect)
+        if border is not None:
+            self.screen.set_clip(rect)
+            drawBorder(self.screen)
+            self.screen.set_clip(None)
+        if piece != Pieces.EMPTY:
+            self.screen.blit(IMAGES[piece], rect)
+        self.screen.blit(self.coordLayer, rect, rect)
+        if self.textLayer is not None:
+            self.screen.blit(self.textLayer, rect, rect)
+        return rect
+
+
+# Top left square is always light
+def squaresUnder(rect: p.Rect) -> set[ChessEngine.Square]:
+    '''
+    Squares a board surface rect overlaps
+    '''
+    sqSize = layout.sqSize
+    return {(row, col)
+            for row in range(max(rect.top // sqSize, 0), min((rect.bottom - 1) // sqSize, DIMENSION - 1) + 1)
+            for col in range(max(rect.left // sqSize, 0), min((rect.right - 1) // sqSize, DIMENSION - 1) + 1)}
 
 
 def drawCoords(screen: p.Surface):
+    sqSize = layout.sqSize
+    fontSize = layout.scaled(COORD_FONT[1], 1)
     for rank in range(DIMENSION):
-        txt_surface = font.render(f"{DIMENSION - rank}", True, (0, 0, 0))
-        screen.blit(txt_surface, (7, (rank * SQ_SIZE) + 5))
+        txt_surface = TEXT_CACHE.render(
+            f"{DIMENSION - rank}", COORD_FONT[0], fontSize, "black")
+        screen.blit(txt_surface, (layout.scaled(7),
+                    (rank * sqSize) + layout.scaled(5)))
 
     for i, file in enumerate("abcdefgh"):
-        txt_surface = font.render(file, True, (0, 0, 0))
-        screen.blit(txt_surface, ((i * SQ_SIZE) + (0.85 * SQ_SIZE),
-                    (7 * SQ_SIZE) + (0.65 * SQ_SIZE)))
+        txt_surface = TEXT_CACHE.render(
+            file, COORD_FONT[0], fontSize, "black")
+        screen.blit(txt_surface, ((i * sqSize) + (0.85 * sqSize),
+                    (7 * sqSize) + (0.65 * sqSize)))
 
 
-def drawBorder(screen):
-    borderColour = "white" if gs.whiteToMove else "black"
-    if gs.stalemate:
-        borderColour = "yellow"
+def borderColour() -> str:
     if gs.checkmate:
-        borderColour = "green"
+        return "green"
+    if gs.stalemate:
+        return "yellow"
+    return "white" if gs.whiteToMove else "black"
+
+
+def drawBorder(screen):
+    p.draw.rect(screen, borderColour(),
+                (0, 0, layout.boardSize, layout.boardSize), layout.scaled(5, 1))
+
+
+def profilingLines() -> list[str]:
+    lines = [f"{'function':<22}{'calls':>8}{'us/call':>9}{'self ms':>9}"]
+    for row in Profiling.reportRows()[:OVERLAY_ROWS]:
+        lines.append(f"{row.function:<22}{row.calls:>8}{row.seconds / row.calls * 1e6:>9.1f}"
+                     f"{row.selfSeconds * 1000:>9.1f}")
+    return lines
 
-    p.draw.rect(screen, borderColour,
-                (0, 0, WIDTH, HEIGHT), 5)
+
+def loadStoredPly(records, ply: int) -> tuple:
+    '''
+    Show a ply of a game from a PositionStore. Only the board and side to move are put on gs, the territory drawn is
+    the stored one and nothing is recomputed, so the rest of gs is stale until setUpStoredPosition.
+    Returns the position and its stored territory
+    '''
+    position = Fen.unpackPosition(records[ply]["position"].tobytes())
+    gs.board = position.board
+    gs.whiteToMove = position.whiteToMove
+    gs.checkmate = gs.stalemate = False
+    return position, records[ply]["territory"]
 
 
-def drawPieces(screen: p.Surface, board: list):
+def setUpStoredPosition(position: Fen.Position) -> list[ChessEngine.Move]:
     '''
-    Draw the pieces on the board using the current GameState.board
+    Set gs up properly on a position loadStoredPly only showed, for when its legal moves are needed. Returns them
     '''
-    for row in range(DIMENSION):
-        for col in range(DIMENSION):
-            piece = board[row][col]
-            if piece != Pieces.EMPTY:
-                screen.blit(IMAGES[piece], p.Rect(
-                    col * SQ_SIZE, row * SQ_SIZE, SQ_SIZE, SQ_SIZE))
+    gs.setPosition(*position)
+    return gs.getValidMoves()[0]
 
 
-def main(moves: list[ChessEngine.Move] = []) -> None:
-    global font
+def main(moves: list[ChessEngine.Move] = [], eventDriven: bool = EVENT_DRIVEN, maxFps: int = MAX_FPS, animationFps: int = ANIMATION_FPS, store: PositionStore.PositionStore = None, gameId: int = None, analysis=None) -> None:
+    '''
+    Run the visualiser. When eventDriven the loop blocks until there is input (or an undo timer fires) and only
+    animations are frame paced, otherwise it polls maxFps times a second.
+    With a store, game gameId is shown from its records (territory included) and the arrow keys step through them.
+    analysis is an Analysis.AnalysisService or stand-in, one is started the first time h is pressed otherwise.
+    It is closed when the window is
+    '''
     global gs
     p.init()
-    font = p.font.SysFont('Comic Sans MS', 15)
-    screen = p.display.set_mode((WIDTH, HEIGHT))
+    screen = p.display.set_mode((layout.width, layout.height), p.RESIZABLE)
     clock = p.time.Clock()
     screen.fill(p.Color("white"))
-    gs = ChessEngine.GameState(moves)
-    validMoves, protectionMoves = gs.getValidMoves()
+    gs = ChessEngine.GameState(moves, cacheSize=MOVE_CACHE_SIZE)
+    validMoves, _ = gs.getValidMoves()
     moveMade = False
     undoMove = False
+    animate = True  # slide the piece of the move made or undone
     canUndo = False
     gameOver = False
     UNDO_DELAY = 0.2  # seconds
     loadImages()  # do this once, before the while loop
+    preloadText()
+    renderer = BoardRenderer(screen)
+    analysing = False  # every new position is posted for analysis and its best move highlighted
+    storedGame = store.game(gameId) if store is not None else None
+    storedPly = 0
+    shownPosition = None  # stored position on the board that gs hasn't been set up on yet, see loadStoredPly
+    if storedGame is not None:
+        shownPosition, renderer.territory = loadStoredPly(storedGame, storedPly)
+        validMoves = []
+    if eventDriven:
+        p.event.set_blocked(p.MOUSEMOTION)  # nothing reacts to it, don't wake up for it
 
     # most recent square player clicked on (basically playerClicks[-1])
     sqSelected = ()
     playerClicks = []  # history of player square clicks of up to 2 records
 
     running = True
+    animation = None
+    events = []  # already waited for, handled ahead of the queue
     while running:
-        for e in p.event.get():
+        refresh = resized = False
+        for e in events + p.event.get():
             if e.type == p.QUIT:
                 running = False
                 # break # ?
 
+            elif e.type in (p.VIDEOEXPOSE, p.WINDOWEXPOSED):
+                refresh = True
+
+            # only the last of a run of resize events matters
+            elif e.type == p.VIDEORESIZE:
+                resized = True
+
             # mouse handler
             elif e.type == p.MOUSEBUTTONDOWN:
+                if shownPosition is not None:
+                    # moves are only needed once a piece is picked up
+                    validMoves = setUpStoredPosition(shownPosition)
+                    shownPosition = None
                 if not gameOver:
                     location = p.mouse.get_pos()  # (x, y)
-                    col = location[0] // SQ_SIZE
-                    row = location[1] // SQ_SIZE
+                    square = layout.squareAt(*location)
+                    if square is None:
+                        continue  # clicked beside the board
+                    row, col = square
                     if sqSelected == (row, col):
                         # deselect
                         sqSelected = ()
@@ -165,17 +591,17 @@ def main(moves: list[ChessEngine.Move] = []) -> None:
                     if len(playerClicks) == 2:  # after 2nd click
                         move = ChessEngine.Move(
                             playerClicks[0], playerClicks[1], gs.board)
-                        for validMove in validMoves:
-                            if move == validMove:
-                                if validMove.isPawnPromotion:
-                                    print("Pawn promotion!")
-                                gs.makeMove(validMove)
-                                # print(validMove.getChessNotation())
-                                gs.displayNotation(validMoves)
-                                moveMade = True
-                                undoMove = False
-                                canUndo = True
-                                break
+                        validMove = gs.legalMove(move)
+                        if validMove is not None:
+                            if validMove.isPawnPromotion:
+                                print("Pawn promotion!")
+                            gs.makeMove(validMove)
+                            renderer.territory = None  # off the stored game now
+                            # print(validMove.getChessNotation())
+                            gs.displayNotation(validMoves)
+                            moveMade = True
+                            undoMove = False
+                            canUndo = True
                         if not moveMade and (gs.board[playerClicks[1][0]][playerClicks[1][1]][0] == (Pieces.WHITE if gs.whiteToMove else Pieces.BLACK)):
                             playerClicks = [sqSelected]
                         else:
@@ -204,10 +630,67 @@ def main(moves: list[ChessEngine.Move] = []) -> None:
                     undoMove = idxBefore != idxAfter
                     p.time.set_timer(p.USEREVENT, int(UNDO_DELAY * 1000))
 
+                # arrow keys step through the game, page up/down jump SEEK_STEP moves and home/end go to either end
+                elif e.key in (p.K_LEFT, p.K_RIGHT, p.K_PAGEUP, p.K_PAGEDOWN, p.K_HOME, p.K_END):
+                    plyBefore, lastPly = (storedPly, len(storedGame) - 1) if storedGame is not None else (
+                        gs.getPly(), gs.moveLogSize)
+                    ply = {p.K_LEFT: plyBefore - 1, p.K_RIGHT: plyBefore + 1,
+                           p.K_PAGEUP: plyBefore - SEEK_STEP, p.K_PAGEDOWN: plyBefore + SEEK_STEP,
+                           p.K_HOME: 0, p.K_END: lastPly}[e.key]
+                    ply = min(max(ply, 0), lastPly)
+                    if storedGame is not None:
+                        # straight from the store, nothing is replayed or recomputed
+                        storedPly = ply
+                        shownPosition, renderer.territory = loadStoredPly(storedGame, storedPly)
+                        moveMade = True
+                        animate = False
+                    else:
+                        gs.seek(ply)
+                        moveMade = gs.getPly() != plyBefore
+                        undoMove = gs.getPly() < plyBefore
+                        # only single steps slide, a jump just shows the new position
+                        animate = abs(gs.getPly() - plyBefore) == 1
+                    sqSelected = ()
+                    playerClicks = []
+
+                # `h` turns analysis on and off
+                elif e.key == p.K_h:
+                    analysing = not analysing
+                    if analysing:
+                        if analysis is None:
+                            analysis = Analysis.AnalysisService(
+                                lambda: p.event.post(p.event.Event(ANALYSIS_EVENT)))
+                        if shownPosition is not None:
+                            validMoves = setUpStoredPosition(shownPosition)
+                            shownPosition = None
+                        analysis.post(gs, SUGGEST_TIME)
+                    else:
+                        renderer.suggestion = None
+
+                # `p` turns profiling of the move generator on and off, the counts are printed when it's turned off
+                elif e.key == p.K_p:
+                    if Profiling.enabled():
+                        Profiling.disable()
+                        print(Profiling.report())
+                        renderer.overlay = []
+                    else:
+                        Profiling.reset()
+                        Profiling.enable()
+
                 # `command + r` for restart
                 elif e.key == p.K_r and (p.key.get_mods() & p.KMOD_META):
-                    gs = ChessEngine.GameState(moves)
-                    validMoves, protectionMoves = gs.getValidMoves()
+                    gs = ChessEngine.GameState(moves, cacheSize=MOVE_CACHE_SIZE)
+                    renderer.suggestion = None
+                    validMoves, _ = gs.getValidMoves()
+                    if storedGame is not None:
+                        storedPly = 0
+                        shownPosition, renderer.territory = loadStoredPly(storedGame, storedPly)
+                        validMoves = []
+                    if analysing:
+                        if shownPosition is not None:
+                            validMoves = setUpStoredPosition(shownPosition)
+                            shownPosition = None
+                        analysis.post(gs, SUGGEST_TIME)
                     sqSelected = ()
                     playerClicks = []
                     undoMove = False
@@ -218,137 +701,122 @@ def main(moves: list[ChessEngine.Move] = []) -> None:
                 canUndo = True
                 p.time.set_timer(p.USEREVENT, 0)
 
+            # results for positions that have since changed are never delivered
+            if e.type == ANALYSIS_EVENT and analysing and (result := analysis.poll()) is not None:
+                renderer.suggestion = next((move for move in validMoves
+                                            if move.getLongNotation()[:4] == (result.move or '')[:4]), None)
+                print(f"Suggested move: {renderer.suggestion} ({Search.describeScore(result.score)}, "
+                      f"depth {result.depth}, {result.nodes} nodes)")
+
+        if resized:
+            screen = p.display.get_surface()
+            rescale = layout.resize(*screen.get_size())
+            if rescale:
+                # sprites come from the atlas, which usually has the size cached already
+                loadImages()
+                preloadText()
+            renderer.resize(screen, rescale)
+        if resized or refresh:
+            screen.fill(p.Color("white"))
+            renderer.invalidate()
+
         if moveMade:
-            validMoves, protectionMoves = gs.getValidMoves()
-            gameOver = gs.checkmate or gs.stalemate
+            renderer.suggestion = None  # it was for the previous position
+            if shownPosition is not None and (analysing or storedPly == len(storedGame) - 1):
+                # analysis needs the whole position, and only a game's last ply can be checkmate or stalemate
+                setUpStoredPosition(shownPosition)
+                shownPosition = None
+            if shownPosition is None:
+                validMoves, _ = gs.getValidMoves()
+                if analysing:
+                    analysis.post(gs, SUGGEST_TIME)
+                gameOver = not gs.hasLegalMove()
+            else:
+                validMoves = []
+                gameOver = False
             moveMade = False
             debug(gs.castleRightsUpdates)
             debug(gs.currentCastleRights)
-            if gs.moveLogSize > 0:
-                animateMove(gs.moveLog, screen,
-                            gs.board, clock, undoMove)
+            if animate and gs.moveLogSize > 0:
+                # replaces any animation still running, its move has already been made
+                animation = moveAnimation(undoMove)
+            elif not animate:
+                animation = None
+            animate = True
             debug(gs.moveIdx)
             debug(gs.moveLogSize)
             debug(len(gs.moveLog))
 
-        drawGameState(screen, validMoves, protectionMoves, sqSelected)
+        texts = ()
         if gameOver:
-            if gs.checkmate:
-                if gs.whiteToMove:
-                    drawText(screen, "Black wins by checkmate!", "black")
-                else:
-                    drawText(screen, "White wins by checkmate!", "white")
-            else:
-                drawText(screen, "Stalemate :/", stalemate=True)
-            drawText(screen, "(shft+)cmd+z to re/undo, cmd+r to restart",
-                     size=22, yoffset=60)
-        clock.tick_busy_loop(MAX_FPS)
-        p.display.flip()
+            texts = GAME_OVER_TEXTS["stalemate" if not gs.checkmate else
+                                    "black" if gs.whiteToMove else "white"]
+        if animation is not None and animation.finished():
+            animation = None  # this frame puts the pieces back on the board
+        if Profiling.enabled():
+            renderer.overlay = profilingLines()
+        dirty = renderer.draw(validMoves, sqSelected, texts, animation)
+        if animation is not None:
+            clock.tick(animationFps)  # keep handling input between frames
+        elif not eventDriven:
+            clock.tick_busy_loop(maxFps)
+        if resized or refresh:
+            p.display.flip()  # the margins around the board too
+        elif dirty:
+            p.display.update(dirty)
+        events = [p.event.wait()] if eventDriven and running and animation is None else []
+    if analysis is not None:
+        analysis.close()
+    if Profiling.enabled():
+        Profiling.disable()
+        print(Profiling.report())
 
 
 def drawText(screen: p.Surface, text: str, colour: str = "black", stalemate: bool = False, size: int = 32, yoffset: int = 0):
-    font = p.font.SysFont("Helvetica", size, True, False)
-    textObject = font.render(text, 0, p.Color("black"))
-    textLocation = p.Rect(0, 0, WIDTH, HEIGHT).move(
-        WIDTH/2 - textObject.get_width()/2, HEIGHT/2 - textObject.get_height()/2).move(0, yoffset)
+    textObject = TEXT_CACHE.banner(
+        text, colour, stalemate, layout.scaled(size, 1))
+    # centre on the black copy, the others hang off it to the bottom right
+    boardSize = layout.boardSize
+    textLocation = p.Rect(0, 0, boardSize, boardSize).move(
+        boardSize/2 - (textObject.get_width() - 2)/2, boardSize/2 - (textObject.get_height() - 2)/2).move(0, layout.scaled(yoffset))
     screen.blit(textObject, textLocation)
-    # screen.blit(textObject, textLocation.move(3, 3))
-    textObject = font.render(text, 0, p.Color(
-        "Green" if not stalemate else "Yellow"))
-    screen.blit(textObject, textLocation.move(1, 1))
-    textObject = font.render(text, 0, p.Color(colour))
-    screen.blit(textObject, textLocation.move(2, 2))
-
-
-def animateMove(moveLog: list[ChessEngine.Move], screen: p.Surface, board: list[list[int]], clock: p.time.Clock, undoMove: bool):
-    global colours
-    move = moveLog[gs.moveIdx] if not undoMove else moveLog[gs.moveIdx +
-                                                            1 if gs.moveIdx != None else 0]
-    startRow, startCol, endRow, endCol = move.startRow, move.startCol, move.endRow, move.endCol
-    if undoMove:
-        startRow, startCol, endRow, endCol = move.endRow, move.endCol, move.startRow, move.startCol
-    dR = endRow - startRow
-    dC = endCol - startCol
-
-    if move.isCastle:
-        rook_dR = 0
-        if dC == 2:  # king side castle
-            rook_dC = -2 if not undoMove else -3
-            rook_startCol = 7 if not undoMove else 3
-            rook_endCol = 5 if not undoMove else 0
-        else:
-            rook_dC = 3 if not undoMove else 2
-            rook_startCol = 0 if not undoMove else 5
-            rook_endCol = 3 if not undoMove else 7
-
-    framesPerMove = 10
-
-    for frame in range(framesPerMove + 1):
-        row, col = (startRow + (dR * frame/framesPerMove),
-                    startCol + (dC * frame/framesPerMove))
-
-        if move.isCastle:
-            rookRow, rookCol = (endRow + (rook_dR * frame/framesPerMove),
-                                rook_startCol + (rook_dC * frame/framesPerMove))
-
-        drawBoard(screen)
-        drawPieces(screen, board)
-
-        # erase the piece moved from its ending square
-        colour = colours[(endRow + endCol) % 2]
-        endSquare = p.Rect(endCol*SQ_SIZE,
-                           endRow*SQ_SIZE, SQ_SIZE, SQ_SIZE)
-        p.draw.rect(screen, colour, endSquare)
-
-        if move.isCastle:
-            colour = colours[(endRow + endCol + (0 if dC >
-                              0 and undoMove else 1)) % 2]
-            endSquare = p.Rect(rook_endCol*SQ_SIZE,
-                               endRow*SQ_SIZE, SQ_SIZE, SQ_SIZE)
-            p.draw.rect(screen, colour, endSquare)
-
-        # draw captured piece onto rectangle
-        if not undoMove and move.pieceCaptured != Pieces.EMPTY:
-            screen.blit(IMAGES[move.pieceCaptured], endSquare)
-
-        drawCoords(screen)
-        drawBorder(screen)
-
-        # draw moving piece
-        screen.blit(IMAGES[move.pieceMoved], p.Rect(
-            col*SQ_SIZE, row*SQ_SIZE, SQ_SIZE, SQ_SIZE))
-        if move.isCastle:
-            screen.blit(IMAGES[move.pieceMoved[0]+Pieces.ROOK], p.Rect(
-                rookCol*SQ_SIZE, rookRow*SQ_SIZE, SQ_SIZE, SQ_SIZE))
-        p.display.flip()
-        clock.tick(60)
 
 
 if __name__ == "__main__":
-    while (choice := input("Will you provide a move set? [y/n]: ")).lower() not in ["y", "n"]:
-        continue
-    moves: list[ChessEngine.Move] = []
-    if choice == "y":
-        print("Please enter the moves:")
-        contents = []
-        while True:
-            try:
-                line = input()
-                if line == "":
+    parser = argparse.ArgumentParser(description="Chess territory visualiser")
+    parser.add_argument("--store", help="position store to show a game from, see PositionStore")
+    parser.add_argument("--game", type=int, default=0, help="id of the game to show from the store (default 0)")
+    args = parser.parse_args()
+    if args.store is not None:
+        try:
+            store = PositionStore.PositionStore(args.store)
+            store.entry(args.game)  # fail before opening a window
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        main(store=store, gameId=args.game)
+    else:
+        while (choice := input("Will you provide a move set? [y/n]: ")).lower() not in ["y", "n"]:
+            continue
+        moves: list[ChessEngine.Move] = []
+        if choice == "y":
+            print("Please enter the moves:")
+            contents = []
+            while True:
+                try:
+                    line = input()
+                    if line == "":
+                        break
+                except EOFError:
                     break
-            except EOFError:
-                break
-            contents.append(line)
-        potentialMoves = ' '.join(contents)
-        potentialMoves = potentialMoves.split(' ')
-        potentialMoves = list(filter(lambda x: '.' not in x, potentialMoves))
-
-        # Check if moves is valid gameplay by converting to list of ChessEngine.Move
-        gs = ChessEngine.GameState()
-        for move in potentialMoves:
-            validMoves, _ = gs.getValidMoves()
-            validMove = gs.convertNotationToValidMove(move, validMoves)
-            gs.makeMove(validMove)
-            moves.append(validMove)
-
-    main(moves)
+                contents.append(line)
+            potentialMoves = PgnImport.sanTokens(' '.join(contents))
+
+            # Check if moves is valid gameplay by converting to list of ChessEngine.Move
+            gs = ChessEngine.GameState()
+            for move in potentialMoves:
+                validMoves, _ = gs.getValidMoves()
+                validMove = gs.convertNotationToValidMove(move, validMoves)
+                gs.makeMove(validMove)
+                moves.append(gs.moveLog[gs.moveIdx])  # with the promotion choice, if makeMove asked for one
+
+        main(moves)
@@ -0,0 +1,166 @@
+# FEN strings and a fixed size binary encoding of positions, see GameState.setFen/getFen and pack/unpack
+import struct
+from typing import NamedTuple, Tuple
+from Pieces import *
+import Territory
+
+INITIAL_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+CASTLE_FLAGS = "KQkq"  # same order as GameState.currentCastleRights
+# for each flag: the row, the column of its rook, and the king and rook that have to stand there (king on column 4)
+CASTLE_SQUARES = [(7, 7, W_K, W_R), (7, 0, W_K, W_R), (0, 7, B_K, B_R), (0, 0, B_K, B_R)]
+
+# occupancy (bit row * 8 + col set for every piece), one nibble per piece in square order (PIECES index + 1),
+# flags (bit 0 white to move, bits 1-4 castling rights), en passant square (NO_EN_PASSANT if none),
+# halfmove clock, fullmove number
+_PACKED = struct.Struct("<Q16sBBHH")
+PACKED_SIZE = _PACKED.size
+NO_EN_PASSANT = 0xFF
+MAX_PACKED_PIECES = 32  # pieces that fit in the nibbles
+
+
+class Position(NamedTuple):
+    board: list[list[str]]
+    whiteToMove: bool
+    castleRights: Tuple[bool, bool, bool, bool]
+    enPassantPossible: tuple  # (row, col) or ()
+    halfmoveClock: int
+    fullmoveNumber: int
+
+
+def squareName(row: int, col: int) -> str:
+    return "abcdefgh"[col] + str(8 - row)
+
+
+def parseFen(fen: str) -> Position:
+    '''
+    Position described by a FEN string, the move counters default to 0 and 1 if they're left off
+    '''
+    fields = fen.split()
+    if len(fields) not in (4, 6):
+        raise ValueError(f"FEN '{fen}' should have 6 fields (or 4 without the move counters)!")
+    placement, side, castling, enPassant = fields[:4]
+
+    board = []
+    for rank in placement.split('/'):
+        row = []
+        for char in rank:
+            if char in "12345678":
+                row += [EMPTY] * int(char)
+            elif char.upper() in "RNBKQP":
+                row.append((WHITE if char.isupper() else BLACK) + char.upper())
+            else:
+                raise ValueError(f"Unknown piece '{char}' in FEN '{fen}'!")
+        if len(row) != 8:
+            raise ValueError(f"Rank '{rank}' of FEN '{fen}' isn't 8 squares long!")
+        board.append(row)
+    if len(board) != 8:
+        raise ValueError(f"FEN '{fen}' doesn't have 8 ranks!")
+    for king, colour in ((W_K, "white"), (B_K, "black")):
+        if sum(row.count(king) for row in board) != 1:
+            raise ValueError(f"FEN '{fen}' needs exactly one {colour} king!")
+    if W_P in board[0] + board[7] or B_P in board[0] + board[7]:
+        raise ValueError(f"FEN '{fen}' has a pawn on the first or last rank!")
+
+    if side not in ('w', 'b'):
+        raise ValueError(f"Side to move in FEN '{fen}' must be w or b!")
+    whiteToMove = side == 'w'
+    # the side that just moved can't have left its own king in check
+    waiting = B_K if whiteToMove else W_K
+    kingRow, kingCol = next((row, col) for row in range(8) for col in range(8) if board[row][col] == waiting)
+    if Territory.TerritoryMap(board).attackers(kingRow, kingCol, WHITE if whiteToMove else BLACK):
+        raise ValueError(f"FEN '{fen}' has the {'black' if whiteToMove else 'white'} king in check with "
+                         f"{'white' if whiteToMove else 'black'} to move!")
+    if castling != '-' and (not castling or any(flag not in CASTLE_FLAGS for flag in castling)):
+        raise ValueError(f"Castling field '{castling}' of FEN '{fen}' isn't - or made of {CASTLE_FLAGS}!")
+    # rights whose king or rook has left its square are dropped, they could never be used
+    castleRights = tuple(flag in castling and board[row][4] == king and board[row][col] == rook
+                         for flag, (row, col, king, rook) in zip(CASTLE_FLAGS, CASTLE_SQUARES))
+
+    if enPassant == '-':
+        enPassantPossible = ()
+    elif len(enPassant) == 2 and enPassant[0] in "abcdefgh" and enPassant[1] == ("6" if whiteToMove else "3"):
+        row, col = 8 - int(enPassant[1]), "abcdefgh".index(enPassant[0])
+        # the pawn that just moved two squares stands in front of it, and passed over it from an empty square
+        forward = 1 if whiteToMove else -1
+        if board[row + forward][col] != (B_P if whiteToMove else W_P) or board[row][col] != EMPTY or \
+                board[row - forward][col] != EMPTY:
+            raise ValueError(f"En passant square {enPassant} of FEN '{fen}' isn't behind a pawn that just moved "
+                             "two squares!")
+        enPassantPossible = (row, col)
+    else:
+        raise ValueError(f"En passant field '{enPassant}' of FEN '{fen}' isn't - or a square on rank "
+                         f"{'6' if whiteToMove else '3'}!")
+
+    halfmoveClock, fullmoveNumber = 0, 1
+    if len(fields) == 6:
+        if not fields[4].isdigit() or not fields[5].isdigit() or int(fields[5]) < 1:
+            raise ValueError(f"Move counters of FEN '{fen}' must be whole numbers, the fullmove number from 1!")
+        halfmoveClock, fullmoveNumber = int(fields[4]), int(fields[5])
+    return Position(board, whiteToMove, castleRights, enPassantPossible, halfmoveClock, fullmoveNumber)
+
+
+def formatFen(position: Position) -> str:
+    ranks = []
+    for row in position.board:
+        rank = ''
+        empty = 0
+        for piece in row:
+            if piece == EMPTY:
+                empty += 1
+                continue
+            if empty:
+                rank += str(empty)
+                empty = 0
+            rank += piece[1] if piece[0] == WHITE else piece[1].lower()
+        ranks.append(rank + (str(empty) if empty else ''))
+    castling = ''.join(flag for flag, right in zip(
+        CASTLE_FLAGS, position.castleRights) if right) or '-'
+    enPassant = squareName(*position.enPassantPossible) if position.enPassantPossible else '-'
+    return f"{'/'.join(ranks)} {'w' if position.whiteToMove else 'b'} {castling} {enPassant} " \
+        f"{position.halfmoveClock} {position.fullmoveNumber}"
+
+
+def packPosition(position: Position) -> bytes:
+    '''
+    PACKED_SIZE bytes for the position, positions with more than MAX_PACKED_PIECES pieces can't be packed
+    '''
+    occupancy = 0
+    nibbles = []
+    for sq, piece in enumerate(piece for row in position.board for piece in row):
+        if piece != EMPTY:
+            occupancy |= 1 << sq
+            nibbles.append(PIECES.index(piece) + 1)
+    if len(nibbles) > MAX_PACKED_PIECES:
+        raise ValueError(f"Can't pack a position with {len(nibbles)} pieces, the limit is {MAX_PACKED_PIECES}!")
+    nibbles += [0] * (MAX_PACKED_PIECES - len(nibbles))
+    pieces = bytes(nibbles[idx] << 4 | nibbles[idx + 1] for idx in range(0, MAX_PACKED_PIECES, 2))
+
+    flags = int(position.whiteToMove)
+    for idx, right in enumerate(position.castleRights):
+        flags |= right << (idx + 1)
+    enPassant = position.enPassantPossible[0] * 8 + position.enPassantPossible[1] \
+        if position.enPassantPossible else NO_EN_PASSANT
+    return _PACKED.pack(occupancy, pieces, flags, enPassant,
+                        min(position.halfmoveClock, 0xFFFF), min(position.fullmoveNumber, 0xFFFF))
+
+
+def unpackPosition(data: bytes) -> Position:
+    if len(data) != PACKED_SIZE:
+        raise ValueError(f"Packed positions are {PACKED_SIZE} bytes, not {len(data)}!")
+    occupancy, pieces, flags, enPassant, halfmoveClock, fullmoveNumber = _PACKED.unpack(data)
+    nibbles = [nibble for byte in pieces for nibble in (byte >> 4, byte & 0xF)]
+    squares = []
+    pieceIdx = 0
+    for sq in range(64):
+        if occupancy >> sq & 1:
+            nibble = nibbles[pieceIdx] if pieceIdx < MAX_PACKED_PIECES else 0
+            if not 1 <= nibble <= len(PIECES):
+                raise ValueError(f"Packed position has no valid piece for square {squareName(*divmod(sq, 8))}!")
+            squares.append(PIECES[nibble - 1])
+            pieceIdx += 1
+        else:
+            squares.append(EMPTY)
+    board = [squares[row * 8:row * 8 + 8] for row in range(8)]
+    castleRights = tuple(bool(flags >> (idx + 1) & 1) for idx in range(4))
+    enPassantPossible = divmod(enPassant, 8) if enPassant != NO_EN_PASSANT else ()
+    return Position(board, bool(flags & 1), castleRights, enPassantPossible, halfmoveClock, fullmoveNumber)
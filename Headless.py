@@ -0,0 +1,275 @@
+# Headless analysis: legal moves, check status and territory of positions read from PGN or FEN, written as JSON Lines
+# or a NumPy archive. Only the engine is imported, never pygame, so it starts quickly and runs without a display
+import argparse
+import json
+import os
+import re
+import sys
+from itertools import chain
+from typing import Iterable, Iterator, NamedTuple, Optional, TextIO, Tuple
+import numpy as np
+from Pieces import *
+import ChessEngine
+import Fen
+import PgnImport
+import Territory
+
+AUTO = "auto"
+PGN = "pgn"
+FEN = "fen"  # a position per line, see parseFenLine
+INPUT_FORMATS = [AUTO, PGN, FEN]
+JSON_LINES = "jsonl"
+NUMPY = "npz"
+OUTPUT_FORMATS = [JSON_LINES, NUMPY]
+STATUSES = ["normal", "check", "checkmate", "stalemate"]  # the status field of a NumPy archive indexes these
+PROMOTION_CHOICES = [QUEEN, ROOK, BISHOP, KNIGHT]
+ARCHIVE_FIELDS = ["games", "plies", "positions", "status", "territory", "moves", "moveOffsets"]
+_PGN_START = re.compile(r'^\s*(\[|\{|;|%|\d+\.)')
+
+
+class PositionReport(NamedTuple):
+    ply: int  # moves played from the starting position of its game or line
+    position: bytes  # see GameState.getPackedPosition
+    fen: str
+    moves: list[str]  # legal moves in long notation, a promotion once per piece
+    status: str  # one of STATUSES
+    territory: np.ndarray  # (2, 8, 8) white and black attacker counts
+
+
+class GameReport(NamedTuple):
+    label: str  # game or line it came from, for error messages
+    positions: list[PositionReport]
+    error: Optional[str]  # None if every move was valid, otherwise the positions stop at the last valid move
+
+
+def reportPosition(gs: ChessEngine.GameState, ply: int) -> PositionReport:
+    moves, _ = gs.getValidMoves()
+    status = ("checkmate" if gs.inCheck else "stalemate") if not moves else "check" if gs.inCheck else "normal"
+    notations = []
+    for move in moves:
+        squares = move.getLongNotation()[:4]
+        notations += [squares + choice.lower() for choice in PROMOTION_CHOICES] if move.isPawnPromotion else [squares]
+    counts = gs.territory.counts
+    territory = np.array((counts[WHITE], counts[BLACK]), dtype=Territory.HEATMAP_DTYPE)
+    return PositionReport(ply, gs.getPackedPosition(), gs.getFen(), notations, status, territory)
+
+
+def playLongNotation(gs: ChessEngine.GameState, notation: str):
+    '''
+    Push the legal move written in long notation (e2e4, e7e8q), promotions have to name their piece
+    '''
+    validMoves, _ = gs.getValidMoves()
+    move = next((move for move in validMoves if move.getLongNotation()[:4] == notation[:4]), None)
+    choice = notation[4:].upper()
+    if move is None or len(notation) not in (4, 5) or (choice and (not move.isPawnPromotion or
+                                                                  choice not in PROMOTION_CHOICES)):
+        raise ValueError(f"Move '{notation}' is not valid in current game state!")
+    if move.isPawnPromotion and not choice:
+        raise ValueError(f"Move '{notation}' doesn't say which piece to promote to!")
+    gs.push(move.withPromotion(choice) if choice else move)
+
+
+def parseFenLine(line: str) -> Tuple[str, list[str]]:
+    '''
+    FEN (or startpos) and long notation moves of a line, written the way UCI's position command does: optionally
+    prefixed with fen and followed by moves and the moves played from it. A trailing result is ignored, so
+    PgnImport's output for set up games reads too
+    '''
+    fields = line.split()
+    if fields and fields[0] == "fen":
+        fields = fields[1:]
+    setUp, moves = fields, []
+    if "moves" in fields:
+        split = fields.index("moves")
+        setUp, moves = fields[:split], fields[split + 1:]
+    if moves and moves[-1] in PgnImport.RESULTS:
+        moves = moves[:-1]
+    return Fen.INITIAL_FEN if setUp == ["startpos"] else ' '.join(setUp), moves
+
+
+def analysePgn(lines: Iterable[str], final: bool = False) -> Iterator[GameReport]:
+    '''
+    Report every position of every game, or only the last one reached when final
+    '''
+    for game in PgnImport.readGames(lines):
+        positions = []
+        states = []
+
+        def visit(gs):
+            if final:
+                states[:] = [gs]  # the same state throughout, reported once the game stops
+            else:
+                positions.append(reportPosition(gs, len(positions)))
+
+        try:
+            imported = PgnImport.convertGame(game, visit)
+            if states:
+                positions.append(reportPosition(states[0], len(imported.moves)))
+        except Exception as e:
+            # a bug rather than a bad game, reported like one so the rest still get analysed
+            imported = PgnImport.ImportedGame(game.index, game.tags, [], "*", unexpectedError(e))
+        yield GameReport(PgnImport.describeGame(imported), positions, imported.error)
+
+
+def analyseFen(lines: Iterable[str], final: bool = False) -> Iterator[GameReport]:
+    '''
+    Report the position on every line, and after each of the line's moves unless final. Blank lines and lines
+    starting with # are skipped
+    '''
+    for number, line in enumerate(lines, start=1):
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        positions = []
+        try:
+            error = analyseFenLine(line, positions, final)
+        except Exception as e:
+            # a bug rather than a bad line, reported like one so the rest still get analysed
+            error = unexpectedError(e)
+        yield GameReport(f"line {number}", positions, error)
+
+
+def analyseFenLine(line: str, positions: list[PositionReport], final: bool) -> Optional[str]:
+    '''
+    Add the reports of a line's positions to positions, returning why it stopped early or None
+    '''
+    gs = ChessEngine.GameState(cacheSize=0)
+    fen, moves = parseFenLine(line)
+    try:
+        gs.setFen(fen)
+    except ValueError as e:
+        return str(e)
+    error = None
+    if not final:
+        positions.append(reportPosition(gs, 0))
+    for ply, notation in enumerate(moves, start=1):
+        try:
+            playLongNotation(gs, notation)
+        except ValueError as e:
+            error = f"ply {ply}: {e}"
+            break
+        if not final:
+            positions.append(reportPosition(gs, ply))
+    if final:
+        positions.append(reportPosition(gs, len(gs.pushedMoves)))
+    return error
+
+
+def unexpectedError(e: Exception) -> str:
+    return f"unexpected {type(e).__name__}: {e}"
+
+
+def detectFormat(lines: Iterator[str]) -> Tuple[str, Iterator[str]]:
+    '''
+    PGN if the first line with anything on it starts with a tag, comment or move number, FEN otherwise.
+    Returns the format and every line, including those read to decide
+    '''
+    head = []
+    for line in lines:
+        head.append(line)
+        if line.strip():
+            break
+    return (PGN if head and _PGN_START.match(head[-1]) else FEN), chain(head, lines)
+
+
+def jsonRecord(game: int, report: PositionReport) -> str:
+    return json.dumps({"game": game, "ply": report.ply, "fen": report.fen, "status": report.status,
+                       "moves": report.moves, "territory": {"white": report.territory[0].tolist(),
+                                                            "black": report.territory[1].tolist()}},
+                      separators=(',', ':'))
+
+
+def writeArchive(path: str, reports: list[Tuple[int, PositionReport]]):
+    '''
+    Save (game, position) pairs as ARCHIVE_FIELDS: game and ply of each position, its packed position, status index,
+    attacker counts, and every position's legal moves end to end with where each position's start (plus the total).
+    The file is written under a temporary name and renamed once complete
+    '''
+    moveCounts = [len(report.moves) for _, report in reports]
+    arrays = {
+        "games": np.array([game for game, _ in reports], dtype=np.int64),
+        "plies": np.array([report.ply for _, report in reports], dtype=np.int32),
+        "positions": np.frombuffer(b''.join(report.position for _, report in reports),
+                                   dtype=np.uint8).reshape(len(reports), Fen.PACKED_SIZE),
+        "status": np.array([STATUSES.index(report.status) for _, report in reports], dtype=np.uint8),
+        "territory": np.stack([report.territory for _, report in reports]) if reports else
+        np.empty((0, 2, 8, 8), dtype=Territory.HEATMAP_DTYPE),
+        "moves": np.array([move for _, report in reports for move in report.moves], dtype="U5"),
+        "moveOffsets": np.concatenate(([0], np.cumsum(moveCounts, dtype=np.int64))),
+    }
+    with open(path + ".tmp", "wb") as file:
+        np.savez_compressed(file, **arrays)
+    os.replace(path + ".tmp", path)
+
+
+def run(streams: Iterable[TextIO], output: Optional[str], inputFormat: str = AUTO, outputFormat: str = JSON_LINES,
+        final: bool = False) -> int:
+    '''
+    Analyse every game or line of the streams in turn, numbering them across all of them. JSON Lines are written to
+    output (stdout if None) a game at a time as they're analysed, a NumPy archive once everything has been.
+    Returns the number of games or lines with errors, which are printed to stderr
+    '''
+    gameCount = errorCount = 0
+    archived: list[Tuple[int, PositionReport]] = []
+    file = sys.stdout if output is None else open(output, 'w') if outputFormat == JSON_LINES else None
+    try:
+        for stream in streams:
+            format, lines = detectFormat(iter(stream)) if inputFormat == AUTO else (inputFormat, stream)
+            for game in (analysePgn if format == PGN else analyseFen)(lines, final):
+                if outputFormat == JSON_LINES:
+                    file.writelines(jsonRecord(gameCount, report) + '\n' for report in game.positions)
+                    file.flush()  # whoever reads the pipe gets each game as soon as it's done
+                else:
+                    archived += [(gameCount, report) for report in game.positions]
+                if game.error is not None:
+                    errorCount += 1
+                    print(f"{game.label}: {game.error}", file=sys.stderr)
+                gameCount += 1
+    finally:
+        if file is not None and file is not sys.stdout:
+            file.close()
+    if outputFormat == NUMPY:
+        writeArchive(output, archived)
+    return errorCount
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Legal moves, check status and territory of every position in PGN games or FEN lines")
+    parser.add_argument("inputs", nargs='*', default=['-'],
+                        help="PGN or FEN files, - for stdin (default). A FEN line can be followed by "
+                        "'moves e2e4 ...' and startpos stands for the initial position")
+    parser.add_argument("--input-format", choices=INPUT_FORMATS, default=AUTO,
+                        help="how to read the inputs, auto decides per input from its first line")
+    parser.add_argument("-o", "--output", help="file to write, stdout if left off (JSON Lines only)")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS,
+                        help="jsonl: a JSON object per position, npz: a NumPy archive of arrays (default: npz if the "
+                        "output ends in .npz, jsonl otherwise)")
+    parser.add_argument("--final", action="store_true",
+                        help="only the last position of each game or line, not every one along the way")
+    args = parser.parse_args()
+    outputFormat = args.format or (NUMPY if args.output and args.output.endswith(".npz") else JSON_LINES)
+    if outputFormat == NUMPY and args.output is None:
+        parser.error("a NumPy archive needs an output file")
+
+    def streams():
+        for input in args.inputs:
+            if input == '-':
+                yield sys.stdin
+            else:
+                # opened one at a time, as they're reached
+                with open(input, encoding="utf-8", errors="replace") as stream:
+                    yield stream
+
+    try:
+        errorCount = run(streams(), args.output, args.input_format, outputFormat, args.final)
+    except BrokenPipeError:
+        # piped into something like head that stopped reading, don't complain when stdout is flushed on exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    except OSError as e:
+        sys.exit(str(e))
+    sys.exit(1 if errorCount else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+# Perft: count the leaf nodes of the legal move tree to check and time the move generator
+import argparse
+import sys
+import time
+from typing import Tuple
+from Pieces import *
+import ChessEngine
+import Profiling
+import Zobrist
+
+PROMOTION_CHOICES = [QUEEN, ROOK, BISHOP, KNIGHT]
+
+# name, FEN, published node counts for depth 1, 2, 3, ...
+POSITIONS: list[Tuple[str, str, list[int]]] = [
+    ("initial", "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+     [20, 400, 8902, 197281, 4865609]),
+    ("kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+     [48, 2039, 97862, 4085603]),
+    ("rook endgame, en passant pins", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+     [14, 191, 2812, 43238, 674624]),
+    ("in check, promotions", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+     [6, 264, 9467, 422333]),
+    ("promotion with capture", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+     [44, 1486, 62379, 2103487]),
+    ("middlegame", "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+     [46, 2079, 89890, 3894594]),
+    ("illegal en passant", "3k4/3p4/8/K1P4r/8/8/8/8 b - - 0 1",
+     [18, 92, 1670, 10138]),
+    ("en passant gives check", "8/8/4k3/8/2p5/8/B2P2K1/8 w - - 0 1",
+     [13, 102, 1266, 10276]),
+    ("short castle gives check", "5k2/8/8/8/8/8/8/4K2R w K - 0 1",
+     [15, 66, 1198, 6399]),
+    ("long castle gives check", "3k4/8/8/8/8/8/8/R3K3 w Q - 0 1",
+     [16, 71, 1286, 7418]),
+    ("castling prevented", "r3k2r/8/3Q4/8/8/5q2/8/R3K2R b KQkq - 0 1",
+     [44, 1494, 50509, 1720476]),
+    ("promote out of check", "2K2r2/4P3/8/8/8/8/8/3k4 w - - 0 1",
+     [11, 133, 1442, 19174]),
+    ("discovered and double check", "8/8/1P2K3/8/2n5/1q6/8/5k2 b - - 0 1",
+     [29, 165, 5160, 31961]),
+    ("promote to give check", "4k3/1P6/8/8/8/8/K7/8 w - - 0 1",
+     [9, 40, 472, 2661]),
+    ("underpromote to give check", "8/P1k5/K7/8/8/8/8/8 w - - 0 1",
+     [6, 27, 273, 1329]),
+    ("self stalemate", "K1k5/8/P7/8/8/8/8/8 w - - 0 1",
+     [2, 6, 13, 63]),
+    ("stalemate and checkmate", "8/k1P5/8/1K6/8/8/8/8 w - - 0 1",
+     [10, 25, 268, 926]),
+    ("knight and queen checks", "8/8/2k5/5q2/5n2/8/5K2/8 b - - 0 1",
+     [37, 183, 6559, 23527]),
+]
+
+
+def positionFromFen(fen: str, backend: str = ChessEngine.LIST_BACKEND, cacheSize: int = Zobrist.DEFAULT_CACHE_SIZE) -> ChessEngine.GameState:
+    gs = ChessEngine.GameState(backend=backend, cacheSize=cacheSize)
+    gs.setFen(fen)
+    return gs
+
+
+def perft(gs: ChessEngine.GameState, depth: int) -> int:
+    '''
+    Number of leaf nodes depth plies below the current position, every promotion piece counts as its own move
+    '''
+    if depth == 0:
+        return 1
+    moves, _ = gs.getValidMoves()
+    if depth == 1:
+        return sum(len(PROMOTION_CHOICES) if move.isPawnPromotion else 1 for move in moves)
+    nodes = 0
+    for move in moves:
+        for choice in PROMOTION_CHOICES if move.isPawnPromotion else [None]:
+            gs.push(move.withPromotion(choice) if choice else move)
+            nodes += perft(gs, depth - 1)
+            gs.pop()
+    return nodes
+
+
+def divide(gs: ChessEngine.GameState, depth: int) -> list[Tuple[str, int]]:
+    '''
+    Perft split by root move, for finding which move a wrong count comes from
+    '''
+    results = []
+    moves, _ = gs.getValidMoves()
+    for move in moves:
+        for choice in PROMOTION_CHOICES if move.isPawnPromotion else [None]:
+            child = move.withPromotion(choice) if choice else move
+            gs.push(child)
+            results.append((child.getLongNotation(), perft(gs, depth - 1)))
+            gs.pop()
+    return results
+
+
+def timedPerft(gs: ChessEngine.GameState, depth: int) -> Tuple[int, float]:
+    start = time.perf_counter()
+    nodes = perft(gs, depth)
+    return nodes, time.perf_counter() - start
+
+
+def runSuite(maxDepth: int, backend: str = ChessEngine.LIST_BACKEND, cacheSize: int = Zobrist.DEFAULT_CACHE_SIZE, positions: list = POSITIONS) -> bool:
+    '''
+    Perft every position up to maxDepth and compare against the published counts, returns True if all match
+    '''
+    allPassed = True
+    totalNodes = 0
+    totalTime = 0.0
+    for name, fen, expectedCounts in positions:
+        for depth, expected in enumerate(expectedCounts[:maxDepth], start=1):
+            gs = positionFromFen(fen, backend, cacheSize)
+            nodes, seconds = timedPerft(gs, depth)
+            totalNodes += nodes
+            totalTime += seconds
+            passed = nodes == expected
+            allPassed = allPassed and passed
+            print(f"{'ok  ' if passed else 'FAIL'} {name:<30} depth {depth}: {nodes:>9} nodes (expected {expected:>9}) "
+                  f"{nodes / seconds if seconds else 0:>9.0f} nodes/s")
+            if gs.moveCache is not None:
+                print(f"     move cache: {gs.moveCache}")
+    print(f"{'all passed' if allPassed else 'FAILED'}: {totalNodes} nodes in {totalTime:.2f}s "
+          f"({totalNodes / totalTime if totalTime else 0:.0f} nodes/s)")
+    return allPassed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Count and time move generation to a fixed depth")
+    parser.add_argument("--depth", type=int, default=3,
+                        help="depth to search, the suite runs every depth up to this one (default 3)")
+    parser.add_argument("--fen", help="run a single position instead of the suite")
+    parser.add_argument("--divide", action="store_true",
+                        help="with --fen, print the node count below each root move")
+    parser.add_argument("--backend", choices=ChessEngine.BACKENDS,
+                        default=ChessEngine.LIST_BACKEND)
+    parser.add_argument("--cache-size", type=int, default=Zobrist.DEFAULT_CACHE_SIZE,
+                        help=f"move cache entries per game state, 0 to disable (default {Zobrist.DEFAULT_CACHE_SIZE})")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="count calls and time per move generator function and save them to FILE (.csv or .json)")
+    args = parser.parse_args()
+
+    if args.profile is not None:
+        Profiling.enable()
+    try:
+        passed = run(args)
+    finally:
+        if args.profile is not None:
+            Profiling.disable()
+            print(Profiling.report())
+            Profiling.writeReport(args.profile)
+    sys.exit(0 if passed else 1)
+
+
+def run(args: argparse.Namespace) -> bool:
+    if args.fen is None:
+        return runSuite(args.depth, args.backend, args.cache_size)
+
+    gs = positionFromFen(args.fen, args.backend, args.cache_size)
+    if args.divide:
+        results = divide(gs, args.depth)
+        for name, nodes in results:
+            print(f"{name}: {nodes}")
+        print(f"total: {sum(nodes for _, nodes in results)}")
+    else:
+        nodes, seconds = timedPerft(gs, args.depth)
+        print(f"depth {args.depth}: {nodes} nodes in {seconds:.2f}s ({nodes / seconds if seconds else 0:.0f} nodes/s)")
+    if gs.moveCache is not None:
+        print(f"move cache: {gs.moveCache}")
+    return True
+
+
+if __name__ == "__main__":
+    main()
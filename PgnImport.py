@@ -0,0 +1,216 @@
+# Bulk PGN import: stream games out of a PGN file and validate them move by move in a process pool
+import argparse
+import multiprocessing
+import os
+import re
+import sys
+import time
+from itertools import islice
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional, TextIO
+import ChessEngine
+
+RESULTS = ["1-0", "0-1", "1/2-1/2", "*"]
+DEFAULT_BATCH_SIZE = 32  # games sent to a worker at a time
+MAX_REPORTED_ERRORS = 20
+
+_TAG = re.compile(r'^\[\s*(\w+)\s+"(.*)"\s*\]\s*$')
+_COMMENT = re.compile(r'\{[^}]*\}|;[^\n]*')
+_MOVE_NUMBER = re.compile(r'^\d+\.+')
+
+
+class PgnGame(NamedTuple):
+    index: int  # position of the game in the file, from 0
+    tags: dict[str, str]
+    movetext: str
+
+
+class ImportedGame(NamedTuple):
+    index: int
+    tags: dict[str, str]
+    moves: list[str]  # long notation (e2e4, e7e8q) of every move that was valid
+    result: str
+    error: Optional[str]  # None if every move was valid
+
+
+def readGames(lines: Iterable[str]) -> Iterator[PgnGame]:
+    '''
+    Split a stream of PGN lines into games without reading the whole file, movetext is left unparsed
+    '''
+    index = 0
+    tags: dict[str, str] = {}
+    movetext: list[str] = []
+    openComments = 0
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if openComments == 0:
+            if line.startswith('%'):
+                continue
+            tag = _TAG.match(line)
+            if tag:
+                # a tag after movetext starts the next game
+                if movetext:
+                    yield PgnGame(index, tags, ' '.join(movetext))
+                    index += 1
+                    tags, movetext = {}, []
+                tags[tag.group(1)] = tag.group(2).replace('\\"', '"')
+                continue
+        if line.strip():
+            movetext.append(line)
+            openComments += line.count('{') - line.count('}')
+            # so does the result, for games without tags
+            if openComments == 0 and line.split()[-1] in RESULTS:
+                yield PgnGame(index, tags, ' '.join(movetext))
+                index += 1
+                tags, movetext = {}, []
+    if tags or movetext:
+        yield PgnGame(index, tags, ' '.join(movetext))
+
+
+def sanTokens(movetext: str) -> list[str]:
+    '''
+    SAN moves of the main line, without comments, variations, move numbers, NAGs or the result
+    '''
+    text = _COMMENT.sub(' ', movetext)
+    mainLine = []
+    depth = 0
+    for part in re.split(r'([()])', text):
+        if part == '(':
+            depth += 1
+        elif part == ')':
+            depth = max(depth - 1, 0)
+        elif depth == 0:
+            mainLine.append(part)
+
+    tokens = []
+    for token in ' '.join(mainLine).split():
+        token = _MOVE_NUMBER.sub('', token)
+        if token and not token.startswith('$') and token not in RESULTS:
+            tokens.append(token)
+    return tokens
+
+
+def convertGame(game: PgnGame, visit: Callable[[ChessEngine.GameState], None] = None) -> ImportedGame:
+    '''
+    Play a game's moves from the initial position or its FEN tag, stopping at the first one that isn't legal.
+    visit is called with the game state at the starting position and after every move
+    '''
+    result = game.tags.get("Result", "*")
+    for token in reversed(game.movetext.split()):
+        if token in RESULTS:
+            result = token
+            break
+    moves: list[str] = []
+    gs = ChessEngine.GameState(cacheSize=0)
+    if "FEN" in game.tags:
+        try:
+            gs.setFen(game.tags["FEN"])
+        except ValueError as e:
+            return ImportedGame(game.index, game.tags, moves, result, f"FEN tag: {e}")
+    elif game.tags.get("SetUp") == "1":
+        return ImportedGame(game.index, game.tags, moves, result, "SetUp tag without a FEN tag")
+    if visit is not None:
+        visit(gs)
+
+    for ply, token in enumerate(sanTokens(game.movetext), start=1):
+        try:
+            validMoves, _ = gs.getValidMoves()
+            move = gs.convertNotationToValidMove(token, validMoves, display=False)
+            if move.isPawnPromotion and move.promotionChoice is None:
+                raise ValueError(
+                    f"Provided notation '{token}' doesn't say which piece to promote to!")
+        except ValueError as e:
+            return ImportedGame(game.index, game.tags, moves, result, f"ply {ply}: {e}")
+        gs.push(move)
+        moves.append(move.getLongNotation())
+        if visit is not None:
+            visit(gs)
+    return ImportedGame(game.index, game.tags, moves, result, None)
+
+
+def importGames(games: Iterable[PgnGame], workers: int = os.cpu_count() or 1, batchSize: int = DEFAULT_BATCH_SIZE, convert: Callable = convertGame) -> Iterator:
+    '''
+    Convert games in a pool of worker processes, yielding results in file order. Only two batches of
+    games are held in memory at a time, so the input can be larger than memory. convert must be a module level
+    function so it can be sent to the workers
+    '''
+    if workers <= 1:
+        yield from map(convert, games)
+        return
+
+    games = iter(games)
+    batchGames = workers * batchSize * 4
+    with multiprocessing.Pool(workers) as pool:
+        pending = None
+        while True:
+            # read and queue the next batch while the workers are still busy with the current one
+            batch = list(islice(games, batchGames))
+            queued = pool.map_async(convert, batch, chunksize=batchSize) if batch else None
+            if pending is not None:
+                yield from pending.get()
+            if queued is None:
+                break
+            pending = queued
+
+
+def describeGame(game: ImportedGame) -> str:
+    tags = game.tags
+    return f"game {game.index + 1} ({tags.get('White', '?')} - {tags.get('Black', '?')}, {tags.get('Event', '?')})"
+
+
+def runImport(stream: TextIO, workers: int, batchSize: int = DEFAULT_BATCH_SIZE, output: TextIO = None, maxErrors: int = MAX_REPORTED_ERRORS) -> int:
+    '''
+    Import every game in stream, write valid games to output and print throughput and errors.
+    Returns the number of games with errors
+    '''
+    start = time.perf_counter()
+    gameCount = moveCount = errorCount = 0
+    for game in importGames(readGames(stream), workers, batchSize):
+        gameCount += 1
+        moveCount += len(game.moves)
+        if game.error is not None:
+            errorCount += 1
+            if errorCount <= maxErrors:
+                print(f"{describeGame(game)}: {game.error}", file=sys.stderr)
+        elif output is not None:
+            # set up games say where they start from the way UCI's position command does
+            setUp = [f"fen {game.tags['FEN']} moves"] if "FEN" in game.tags else []
+            output.write(' '.join(setUp + game.moves + [game.result]) + '\n')
+
+    seconds = time.perf_counter() - start
+    if errorCount > maxErrors:
+        print(f"... {errorCount - maxErrors} more games with errors", file=sys.stderr)
+    print(f"{gameCount} games, {moveCount} moves in {seconds:.2f}s "
+          f"({gameCount / seconds if seconds else 0:.1f} games/s, {moveCount / seconds if seconds else 0:.0f} moves/s), "
+          f"{errorCount} with errors")
+    return errorCount
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Validate every game in a PGN file and convert it to long notation")
+    parser.add_argument("pgn", help="PGN file to import, - for stdin")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1,
+                        help="worker processes, 1 to import in this process (default: one per CPU)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f"games sent to a worker at a time (default {DEFAULT_BATCH_SIZE})")
+    parser.add_argument("-o", "--output",
+                        help="write each valid game as a line of long notation moves followed by the result, "
+                        "prefixed with 'fen <FEN> moves' for games from a set up position")
+    parser.add_argument("--max-errors", type=int, default=MAX_REPORTED_ERRORS,
+                        help=f"number of game errors to print (default {MAX_REPORTED_ERRORS})")
+    args = parser.parse_args()
+
+    # PGN files in the wild aren't always UTF-8, don't let one bad byte stop the import
+    stream = sys.stdin if args.pgn == '-' else open(args.pgn, encoding="utf-8", errors="replace")
+    output = open(args.output, 'w') if args.output else None
+    try:
+        runImport(stream, args.workers, args.batch_size, output, args.max_errors)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+        if output is not None:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
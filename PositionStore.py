@@ -0,0 +1,175 @@
+# Position store: one fixed size record (packed position and territory) per ply of every game, memory mapped for reading
+import argparse
+import os
+import struct
+import sys
+import time
+from typing import Iterable, NamedTuple, Optional
+import numpy as np
+from Pieces import *
+import Fen
+import PgnImport
+import Territory
+import TerritoryBatch
+
+STORE_MAGIC = b"CTPS"
+STORE_VERSION = 1
+_HEADER = struct.Struct("<4sHQQQ")  # magic, version, game count, record count, offset of the index
+RECORDS_OFFSET = 64  # records start after the header, padded
+# packed position (see Fen.packPosition) then white and black attacker counts, indexed [colour][row][col]
+RECORD_DTYPE = np.dtype([("position", np.uint8, (Fen.PACKED_SIZE,)),
+                         ("territory", Territory.HEATMAP_DTYPE, (2, 8, 8))])
+# one entry per game, sorted by game id: its first record and number of records (plies + 1)
+INDEX_DTYPE = np.dtype([("game", "<i8"), ("first", "<i8"), ("count", "<i4"), ("complete", "?")])
+
+
+class GameRecords(NamedTuple):
+    index: int  # game id, its position across the input files
+    records: np.ndarray  # RECORD_DTYPE, starting position first
+    error: Optional[str]  # None if every move was valid, otherwise the records stop at the last valid move
+
+
+def storeGame(game: PgnImport.PgnGame) -> GameRecords:
+    '''
+    Play a game and pack its position and attacker counts after every move
+    '''
+    positions = []
+    maps = []
+
+    def record(gs):
+        positions.append(gs.getPackedPosition())
+        counts = gs.territory.counts
+        maps.append(np.array((counts[WHITE], counts[BLACK]), dtype=Territory.HEATMAP_DTYPE))
+
+    imported = PgnImport.convertGame(game, record)
+    records = np.empty(len(positions), dtype=RECORD_DTYPE)
+    if positions:
+        records["position"] = np.frombuffer(
+            b''.join(positions), dtype=np.uint8).reshape(len(positions), Fen.PACKED_SIZE)
+        records["territory"] = np.stack(maps)
+    return GameRecords(game.index, records, imported.error)
+
+
+def writeStore(path: str, games: Iterable[GameRecords]) -> np.ndarray:
+    '''
+    Write games to a store file at path, streaming the records so only the index is kept in memory. The file is
+    written under a temporary name and renamed once complete. Returns the index
+    '''
+    entries = []
+    recordCount = 0
+    with open(path + ".tmp", "wb") as file:
+        file.write(bytes(RECORDS_OFFSET))
+        for game in games:
+            file.write(game.records.tobytes())
+            entries.append((game.index, recordCount, len(game.records), game.error is None))
+            recordCount += len(game.records)
+        index = np.array(sorted(entries), dtype=INDEX_DTYPE)
+        indexOffset = file.tell()
+        file.write(index.tobytes())
+        file.seek(0)
+        file.write(_HEADER.pack(STORE_MAGIC, STORE_VERSION, len(index), recordCount, indexOffset))
+    os.replace(path + ".tmp", path)
+    return index
+
+
+class PositionStore():
+    '''
+    Read only view of a store file. Records are memory mapped, so opening is instant whatever the size and a
+    (game, ply) lookup only reads the pages it touches
+    '''
+
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as file:
+            header = file.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise ValueError(f"{path} is too short to be a position store!")
+        magic, version, gameCount, recordCount, indexOffset = _HEADER.unpack(header)
+        if magic != STORE_MAGIC or version != STORE_VERSION:
+            raise ValueError(f"{path} isn't a version {STORE_VERSION} position store!")
+        if indexOffset != RECORDS_OFFSET + recordCount * RECORD_DTYPE.itemsize or \
+                os.path.getsize(path) != indexOffset + gameCount * INDEX_DTYPE.itemsize:
+            raise ValueError(f"{path} is truncated or corrupt!")
+        self.path = path
+        # np.memmap can't map nothing
+        self.records = np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=RECORDS_OFFSET, shape=(recordCount,)) \
+            if recordCount else np.empty(0, dtype=RECORD_DTYPE)
+        self.index = np.memmap(path, dtype=INDEX_DTYPE, mode="r", offset=indexOffset, shape=(gameCount,)) \
+            if gameCount else np.empty(0, dtype=INDEX_DTYPE)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def gameIds(self) -> np.ndarray:
+        return self.index["game"]
+
+    def entry(self, gameId: int) -> np.void:
+        idx = np.searchsorted(self.index["game"], gameId)
+        if idx == len(self.index) or self.index["game"][idx] != gameId:
+            raise ValueError(f"Game {gameId} isn't in {self.path}!")
+        return self.index[idx]
+
+    def game(self, gameId: int) -> np.ndarray:
+        '''
+        Every record of a game, a view into the mapped file
+        '''
+        entry = self.entry(gameId)
+        return self.records[entry["first"]:entry["first"] + entry["count"]]
+
+    def record(self, gameId: int, ply: int) -> np.void:
+        records = self.game(gameId)
+        if not 0 <= ply < len(records):
+            raise ValueError(f"Game {gameId} has no ply {ply}, it has {len(records) - 1}!")
+        return records[ply]
+
+    def position(self, gameId: int, ply: int) -> Fen.Position:
+        return Fen.unpackPosition(self.record(gameId, ply)["position"].tobytes())
+
+    def territory(self, gameId: int, ply: int) -> np.ndarray:
+        '''
+        (2, 8, 8) white and black attacker counts
+        '''
+        return self.record(gameId, ply)["territory"]
+
+
+def buildStore(path: str, output: str, workers: int = os.cpu_count() or 1,
+               batchSize: int = PgnImport.DEFAULT_BATCH_SIZE) -> np.ndarray:
+    '''
+    Play every game in a PGN file or directory in a pool of workers and write their records to a store at output
+    '''
+    start = time.perf_counter()
+    recordCount = errorCount = 0
+
+    def played(games):
+        nonlocal recordCount, errorCount
+        for game in games:
+            recordCount += len(game.records)
+            errorCount += game.error is not None
+            yield game
+
+    games = TerritoryBatch.readAllGames(TerritoryBatch.pgnFiles(path))
+    index = writeStore(output, played(PgnImport.importGames(games, workers, batchSize, storeGame)))
+    seconds = time.perf_counter() - start
+    print(f"{len(index)} games, {recordCount} positions in {seconds:.2f}s "
+          f"({recordCount / seconds if seconds else 0:.0f} positions/s), {errorCount} with errors, "
+          f"{os.path.getsize(output) / 1e6:.1f}MB")
+    return index
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Build a memory mapped store of every position and its territory in a PGN file or directory")
+    parser.add_argument("pgn", help="PGN file, or directory searched for .pgn files")
+    parser.add_argument("-o", "--output", required=True, help="store file to write")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1,
+                        help="worker processes, 1 to play the games in this process (default: one per CPU)")
+    parser.add_argument("--batch-size", type=int, default=PgnImport.DEFAULT_BATCH_SIZE,
+                        help=f"games sent to a worker at a time (default {PgnImport.DEFAULT_BATCH_SIZE})")
+    args = parser.parse_args()
+    try:
+        buildStore(args.pgn, args.output, args.workers, args.batch_size)
+    except ValueError as e:
+        sys.exit(str(e))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# Opt-in profiling of the move generator: calls, time and Move objects created per function
+# Nothing is wrapped until enable(), so there is no cost at all while it's off
+import csv
+import json
+import time
+from typing import NamedTuple
+import ChessEngine
+
+# GameState methods that are counted, the bitboard backend is counted through the GameState methods that call it
+HOT_PATHS = ["getValidMoves", "generateValidMoves", "getAllPossibleMoves", "checkForPinsAndChecks",
+             "getPawnMoves", "getRookMoves", "getKnightMoves", "getBishopMoves", "getQueenMoves", "getKingMoves",
+             "getCastlingMoves"]
+REPORT_FIELDS = ["function", "calls", "seconds", "selfSeconds", "moves"]
+
+
+class FunctionStats():
+    def __init__(self) -> None:
+        self.calls = 0
+        self.seconds = 0.0  # including the counted functions it calls
+        self.selfSeconds = 0.0  # excluding them
+        self.moves = 0  # Move objects created during its calls, including by the counted functions it calls
+
+
+class ReportRow(NamedTuple):
+    function: str
+    calls: int
+    seconds: float
+    selfSeconds: float
+    moves: int
+
+
+stats: dict[str, FunctionStats] = {name: FunctionStats() for name in HOT_PATHS}
+_originals: dict[str, object] = {}  # name -> unwrapped function while enabled
+_childSeconds: list[float] = []  # time spent in counted callees, one entry per counted call in progress
+_movesCreated = 0
+
+
+def enabled() -> bool:
+    return bool(_originals)
+
+
+def _wrap(name: str, function):
+    entry = stats[name]
+
+    def wrapper(*args, **kwargs):
+        movesBefore = _movesCreated
+        _childSeconds.append(0.0)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            childSeconds = _childSeconds.pop()
+            if _childSeconds:
+                _childSeconds[-1] += elapsed
+            entry.calls += 1
+            entry.seconds += elapsed
+            entry.selfSeconds += elapsed - childSeconds
+            entry.moves += _movesCreated - movesBefore
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+
+
+def _countingInit(move, *args, **kwargs):
+    global _movesCreated
+    _movesCreated += 1
+    _originals["Move.__init__"](move, *args, **kwargs)
+
+
+def enable():
+    '''
+    Start counting, on every GameState
+    '''
+    if enabled():
+        return
+    for name in HOT_PATHS:
+        _originals[name] = getattr(ChessEngine.GameState, name)
+        setattr(ChessEngine.GameState, name, _wrap(name, _originals[name]))
+    _originals["Move.__init__"] = ChessEngine.Move.__init__
+    ChessEngine.Move.__init__ = _countingInit
+
+
+def disable():
+    '''
+    Stop counting and put the original methods back, the counts are kept until reset
+    '''
+    if not enabled():
+        return
+    for name in HOT_PATHS:
+        setattr(ChessEngine.GameState, name, _originals[name])
+    ChessEngine.Move.__init__ = _originals["Move.__init__"]
+    _originals.clear()
+
+
+def reset():
+    for entry in stats.values():
+        entry.__init__()  # in place, the wrappers hold on to their entry
+
+
+def reportRows() -> list[ReportRow]:
+    '''
+    Functions that were called, most self time first
+    '''
+    rows = [ReportRow(name, entry.calls, entry.seconds, entry.selfSeconds, entry.moves)
+            for name, entry in stats.items() if entry.calls]
+    return sorted(rows, key=lambda row: row.selfSeconds, reverse=True)
+
+
+def report() -> str:
+    lines = [f"{'function':<22}{'calls':>9}{'total ms':>11}{'self ms':>11}{'us/call':>9}{'moves':>10}"]
+    for row in reportRows():
+        lines.append(f"{row.function:<22}{row.calls:>9}{row.seconds * 1000:>11.1f}{row.selfSeconds * 1000:>11.1f}"
+                     f"{row.seconds / row.calls * 1e6:>9.1f}{row.moves:>10}")
+    return '\n'.join(lines)
+
+
+def writeReport(path: str):
+    '''
+    Save the report as CSV if path ends in .csv, JSON otherwise
+    '''
+    rows = reportRows()
+    with open(path, 'w', newline='') as file:
+        if path.lower().endswith(".csv"):
+            writer = csv.writer(file)
+            writer.writerow(REPORT_FIELDS)
+            writer.writerows(rows)
+        else:
+            json.dump([row._asdict() for row in rows], file, indent=1)
@@ -0,0 +1,347 @@
+# Move search: negamax with alpha-beta, iterative deepening and a transposition table, on top of GameState.push/pop
+import argparse
+import time
+from typing import Callable, Iterable, NamedTuple, Optional
+from Pieces import *
+import ChessEngine
+import Zobrist
+
+PIECE_VALUES = {PAWN: 100, KNIGHT: 320, BISHOP: 330,
+                ROOK: 500, QUEEN: 900, KING: 0}
+# piece -> value from white's point of view
+SIGNED_VALUES = {colour + type: value if colour == WHITE else -value
+                 for colour in (WHITE, BLACK) for type, value in PIECE_VALUES.items()}
+SIGNED_VALUES[EMPTY] = 0
+# what controlling a square (attacking it more often than the other side does) is worth, more in the centre
+CONTROL_WEIGHTS = [[2 + (row in (2, 3, 4, 5) and col in (2, 3, 4, 5)) * 2 + (row in (3, 4) and col in (3, 4)) * 2
+                    for col in range(8)] for row in range(8)]
+
+MATE_SCORE = 100000  # minus the plies to the mate, so sooner mates score higher
+INFINITY = MATE_SCORE + 1
+MAX_DEPTH = 64
+MAX_PLY = 96  # quiescence stops here whatever happens
+DEFAULT_TIME = 1.0  # seconds per move
+DEFAULT_TT_SIZE = 1 << 16  # positions
+NODES_PER_CHECK = 256  # nodes between looks at the clock
+PROMOTION_CHOICES = [QUEEN, KNIGHT, ROOK, BISHOP]
+DELTA_MARGIN = 200  # what quiescence allows for positional gains when pruning captures that can't reach alpha
+# promotion choice -> what sets the move's key apart from the same move promoting to another piece
+PROMOTION_KEYS = {None: 0, QUEEN: 1, KNIGHT: 2, ROOK: 3, BISHOP: 4}
+
+# transposition table bounds
+EXACT = 0
+LOWER = 1  # the score is at least this, the search failed high
+UPPER = 2  # the score is at most this, the search failed low
+
+
+class SearchResult(NamedTuple):
+    move: Optional[ChessEngine.Move]  # None if there are no legal moves
+    score: int  # centipawns for the side to move, see isMate
+    depth: int  # of the last iteration that finished
+    nodes: int
+    seconds: float
+    pv: list[ChessEngine.Move]  # expected line, starting with move
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+def withPromotions(moves: list[ChessEngine.Move]) -> list[ChessEngine.Move]:
+    '''
+    moves with each promotion once per piece it can promote to, as copies so the cached moves aren't changed
+    '''
+    if not any(move.isPawnPromotion for move in moves):
+        return moves
+    return [promotion for move in moves for promotion in
+            ([move.withPromotion(choice) for choice in PROMOTION_CHOICES] if move.isPawnPromotion else [move])]
+
+
+def moveKey(move: ChessEngine.Move) -> int:
+    '''
+    moveID told apart by promotion choice, for the transposition table, killer moves and history
+    '''
+    return move.moveID * 8 + PROMOTION_KEYS[move.promotionChoice]
+
+
+def isMate(score: int) -> bool:
+    return abs(score) > MATE_SCORE - MAX_PLY * 2
+
+
+def evaluate(gs: ChessEngine.GameState) -> int:
+    '''
+    Static score for the side to move: material, plus CONTROL_WEIGHTS for every square one side's territory
+    (the attacker counts the visualiser draws) covers more than the other's
+    '''
+    score = 0
+    whiteCounts = gs.territory.counts[WHITE]
+    blackCounts = gs.territory.counts[BLACK]
+    for row, boardRow in enumerate(gs.board):
+        whiteRow, blackRow, weights = whiteCounts[row], blackCounts[row], CONTROL_WEIGHTS[row]
+        for col in range(8):
+            score += SIGNED_VALUES[boardRow[col]]
+            white, black = whiteRow[col], blackRow[col]
+            if white > black:
+                score += weights[col]
+            elif black > white:
+                score -= weights[col]
+    return score if gs.whiteToMove else -score
+
+
+class Searcher():
+    '''
+    Keeps the transposition table and move ordering statistics between searches, so searching the next move of
+    the same game starts warm
+    '''
+
+    def __init__(self, ttSize: int = DEFAULT_TT_SIZE) -> None:
+        # key -> [depth, score, bound, moveKey of the best move or None]
+        self.tt = Zobrist.MoveCache(ttSize)
+        self.killers: list[list[int]] = [[] for _ in range(MAX_PLY + 1)]  # quiet moves that cut off, by ply
+        self.history: dict[int, int] = {}  # moveKey -> depth weighted count of cutoffs
+        self.nodes = 0
+        self.deadline: float = None
+        self.maxNodes: int = None
+        self.stopped: Callable[[], bool] = None
+        self.repetitions: set[int] = set()  # keys of the positions played before the search root
+        self.path: list[int] = []  # keys from the root to the current node
+
+    def search(self, gs: ChessEngine.GameState, maxTime: float = DEFAULT_TIME, maxNodes: int = None,
+               maxDepth: int = MAX_DEPTH, onIteration: Callable[[SearchResult], None] = None,
+               stopped: Callable[[], bool] = None, history: Iterable[int] = ()) -> SearchResult:
+        '''
+        Search gs one ply deeper at a time until maxTime seconds or maxNodes nodes are spent (either None for no
+        limit), maxDepth is reached or stopped returns True. Returns the result of the deepest finished iteration,
+        which onIteration is also called with. gs is left as it was. history holds the keys of earlier positions
+        gs doesn't know about, such as when it was set up from a packed position
+        '''
+        start = time.perf_counter()
+        self.nodes = 0
+        self.deadline = start + maxTime if maxTime is not None else None
+        self.maxNodes = maxNodes
+        self.stopped = stopped
+        self.killers = [[] for _ in range(MAX_PLY + 1)]
+        self.history = {key: count // 2 for key, count in self.history.items()}  # older cutoffs count less
+        self.repetitions = set(gs.zobristUpdates) | {record[3] for record in gs.pushedMoves} | set(history)
+        self.path = []
+
+        moves = withPromotions(gs.getValidMoves()[0])
+        result = SearchResult(moves[0] if moves else None,
+                              0 if not moves or not gs.inCheck else -MATE_SCORE, 0, 0, 0.0, moves[:1])
+        if len(moves) <= 1:
+            return result._replace(seconds=time.perf_counter() - start)
+
+        pushed = len(gs.pushedMoves)
+        for depth in range(1, maxDepth + 1):
+            try:
+                score = self.negamax(gs, depth, -INFINITY, INFINITY, 0)
+            except SearchTimeout:
+                while len(gs.pushedMoves) > pushed:
+                    gs.pop()
+                break
+            pv = self.principalVariation(gs, depth)
+            result = SearchResult(pv[0] if pv else result.move, score, depth, self.nodes,
+                                  time.perf_counter() - start, pv)
+            if onIteration is not None:
+                onIteration(result)
+            if isMate(score):
+                break  # a deeper search finds nothing better than the shortest mate
+        return result._replace(nodes=self.nodes, seconds=time.perf_counter() - start)
+
+    def checkBudget(self):
+        if (self.deadline is not None and time.perf_counter() >= self.deadline) or \
+                (self.maxNodes is not None and self.nodes >= self.maxNodes) or \
+                (self.stopped is not None and self.stopped()):
+            raise SearchTimeout
+
+    def negamax(self, gs: ChessEngine.GameState, depth: int, alpha: int, beta: int, ply: int) -> int:
+        self.nodes += 1
+        if self.nodes % NODES_PER_CHECK == 0:
+            self.checkBudget()
+        key = gs.zobristKey
+        if ply > 0 and (key in self.repetitions or key in self.path):
+            return 0
+
+        entry = self.tt.get(key)
+        ttMove = None
+        if entry is not None:
+            entryDepth, score, bound, ttMove = entry
+            if ply > 0 and entryDepth >= depth:
+                score = fromTT(score, ply)
+                if bound == EXACT or (bound == LOWER and score >= beta) or (bound == UPPER and score <= alpha):
+                    return score
+
+        if depth <= 0:
+            return self.quiescence(gs, alpha, beta, ply)
+        moves = withPromotions(gs.getValidMoves()[0])
+        if not moves:
+            return -MATE_SCORE + ply if gs.inCheck else 0
+
+        alphaBefore = alpha
+        bestScore, bestMove = -INFINITY, None
+        self.path.append(key)
+        for move in self.orderMoves(moves, ttMove, ply):
+            gs.push(move)
+            score = -self.negamax(gs, depth - 1, -beta, -alpha, ply + 1)
+            gs.pop()
+            if score > bestScore:
+                bestScore, bestMove = score, move
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                if not move.isCapture:
+                    self.addCutoff(move, depth, ply)
+                break
+        self.path.pop()
+
+        bound = UPPER if bestScore <= alphaBefore else LOWER if bestScore >= beta else EXACT
+        self.tt.put(key, [depth, toTT(bestScore, ply), bound, moveKey(bestMove)])
+        return bestScore
+
+    def quiescence(self, gs: ChessEngine.GameState, alpha: int, beta: int, ply: int) -> int:
+        '''
+        Play out captures and promotions (or every move when in check) until the position is quiet, so the
+        static evaluation isn't taken in the middle of an exchange. Captures that can't reach alpha or that give
+        up material to a defended piece are skipped
+        '''
+        self.nodes += 1
+        if self.nodes % NODES_PER_CHECK == 0:
+            self.checkBudget()
+        captures = gs.getCaptures()
+        if gs.inCheck:
+            moves = withPromotions(gs.getValidMoves()[0])
+            if not moves:
+                return -MATE_SCORE + ply
+            if ply >= MAX_PLY:
+                return evaluate(gs)
+            bestScore = -INFINITY
+        else:
+            standPat = evaluate(gs)
+            if standPat >= beta or ply >= MAX_PLY:
+                return standPat
+            alpha = max(alpha, standPat)
+            bestScore = alpha
+            defenders = gs.territory.counts[BLACK if gs.whiteToMove else WHITE]
+            moves = []
+            for move in captures:
+                gain = PIECE_VALUES[move.pieceCaptured[1]] if move.isCapture else 0
+                if move.isPawnPromotion:
+                    # only queens here, negamax tries the underpromotions
+                    move = move.withPromotion(QUEEN)
+                    gain += PIECE_VALUES[QUEEN] - PIECE_VALUES[PAWN]
+                # delta pruning: even winning the piece outright can't lift the score to alpha
+                elif standPat + gain + DELTA_MARGIN <= alpha:
+                    continue
+                # a defended piece worth less than its attacker loses material however the exchange goes on
+                elif defenders[move.endRow][move.endCol] and PIECE_VALUES[move.pieceMoved[1]] > gain:
+                    continue
+                moves.append(move)
+
+        for move in self.orderMoves(moves, None, ply):
+            gs.push(move)
+            score = -self.quiescence(gs, -beta, -alpha, ply + 1)
+            gs.pop()
+            if score > bestScore:
+                bestScore = score
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                break
+        return bestScore
+
+    def orderMoves(self, moves: list[ChessEngine.Move], ttMove: int, ply: int) -> list[ChessEngine.Move]:
+        '''
+        The transposition table's move, then captures and promotions by victim and attacker value (MVV-LVA),
+        then killer moves, then quiet moves by history
+        '''
+        killers = self.killers[ply]
+        history = self.history
+
+        def priority(move):
+            key = moveKey(move)
+            if key == ttMove:
+                return 1 << 30
+            if move.isCapture or move.isPawnPromotion:
+                victim = PIECE_VALUES[move.pieceCaptured[1]] if move.pieceCaptured != EMPTY else PIECE_VALUES[PAWN]
+                if move.isPawnPromotion:
+                    victim += PIECE_VALUES[move.promotionChoice]
+                return (1 << 20) + victim * 16 - PIECE_VALUES[move.pieceMoved[1]] // 10
+            if key in killers:
+                return (1 << 19) - killers.index(key)
+            return history.get(key, 0)
+
+        # a copy, the move lists are shared with the move cache
+        return sorted(moves, key=priority, reverse=True)
+
+    def addCutoff(self, move: ChessEngine.Move, depth: int, ply: int):
+        key = moveKey(move)
+        killers = self.killers[ply]
+        if key not in killers:
+            killers.insert(0, key)
+            del killers[2:]
+        self.history[key] = min(self.history.get(
+            key, 0) + depth * depth, (1 << 19) - 2)
+
+    def principalVariation(self, gs: ChessEngine.GameState, depth: int) -> list[ChessEngine.Move]:
+        '''
+        Follow the best moves stored in the transposition table from the current position
+        '''
+        pv = []
+        seen = set()
+        while len(pv) < depth and gs.zobristKey not in seen:
+            seen.add(gs.zobristKey)
+            entry = self.tt.get(gs.zobristKey)
+            moves = withPromotions(gs.getValidMoves()[0])
+            move = next((move for move in moves if entry is not None and moveKey(move) == entry[3]), None)
+            if move is None:
+                break
+            pv.append(move)
+            gs.push(move)
+        for _ in pv:
+            gs.pop()
+        return pv
+
+
+def toTT(score: int, ply: int) -> int:
+    '''
+    Mate scores count plies from the root, the table stores them counted from the position instead
+    '''
+    return score + ply if score > MATE_SCORE - MAX_PLY * 2 else score - ply if score < -MATE_SCORE + MAX_PLY * 2 else score
+
+
+def fromTT(score: int, ply: int) -> int:
+    return score - ply if score > MATE_SCORE - MAX_PLY * 2 else score + ply if score < -MATE_SCORE + MAX_PLY * 2 else score
+
+
+def describeScore(score: int) -> str:
+    '''
+    Score as pawns (+0.35) or moves to mate (#3, #-2) for the side to move
+    '''
+    if isMate(score):
+        plies = MATE_SCORE - abs(score)
+        return f"#{'' if score > 0 else '-'}{(plies + 1) // 2}"
+    return f"{score / 100:+.2f}"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Search a position for the best move")
+    parser.add_argument("--fen", default="rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1")
+    parser.add_argument("--time", type=float, default=DEFAULT_TIME, help=f"seconds to search (default {DEFAULT_TIME})")
+    parser.add_argument("--nodes", type=int, help="stop after this many nodes instead")
+    parser.add_argument("--depth", type=int, default=MAX_DEPTH, help="deepest iteration to search")
+    args = parser.parse_args()
+
+    gs = ChessEngine.GameState()
+    gs.setFen(args.fen)
+
+    def report(result: SearchResult):
+        print(f"depth {result.depth} score {describeScore(result.score)} nodes {result.nodes} "
+              f"time {result.seconds:.2f}s pv {' '.join(move.getLongNotation() for move in result.pv)}")
+
+    result = Searcher().search(gs, None if args.nodes else args.time, args.nodes, args.depth, report)
+    print(f"best move {result.move.getLongNotation() if result.move else None} "
+          f"({result.nodes / result.seconds if result.seconds else 0:.0f} nodes/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+# Piece sprites packed into one sheet, with pre-scaled sheets per square size that are saved together as a single file
+import os
+import struct
+import zlib
+from collections import OrderedDict
+import pygame as p
+from Pieces import PIECES
+
+MAX_SHEETS = 8  # scaled sheets kept besides the source one
+ATLAS_MAGIC = b"CTVA"
+ATLAS_VERSION = 1
+_HEADER = struct.Struct("<4sHIHH")  # magic, version, source signature, source size, sheet count
+_SHEET = struct.Struct("<HI")  # square size, length of its RGBA pixels
+
+
+def sourceSignature(directory: str) -> int:
+    '''
+    Checksum of the piece images' sizes and modification times, a saved atlas from other images doesn't match it
+    '''
+    signature = 0
+    for piece in PIECES:
+        stat = os.stat(os.path.join(directory, f"{piece}.png"))
+        signature = zlib.crc32(
+            f"{piece}:{stat.st_size}:{stat.st_mtime_ns}".encode(), signature)
+    return signature
+
+
+class SpriteAtlas():
+    '''
+    Every piece image side by side in one surface, in Pieces.PIECES order, along with copies of that sheet scaled to
+    the square sizes that have been asked for. sprites hands out subsurfaces so no pixels are copied
+    '''
+
+    def __init__(self, sourceSize: int, signature: int) -> None:
+        self.sourceSize = sourceSize
+        self.signature = signature
+        # square size -> sheet, least recently used first, the source sheet is never evicted
+        self.sheets: OrderedDict[int, p.Surface] = OrderedDict()
+        # square size -> raw RGBA pixels of sheets read from disk, only turned into surfaces when used
+        self.packed: dict[int, bytes] = {}
+        self.changed = False  # holds sheets that aren't saved yet
+        # sizes whose sheet has been converted to the display's pixel format, which needs a display to exist
+        self.converted: set[int] = set()
+
+    def sheet(self, size: int) -> p.Surface:
+        sheet = self.sheets.get(size)
+        if sheet is None:
+            if size in self.packed:
+                sheet = p.image.frombytes(self.packed.pop(
+                    size), (size * len(PIECES), size), "RGBA")
+            else:
+                source = self.sheet(self.sourceSize)
+                sheet = p.Surface((size * len(PIECES), size), p.SRCALPHA)
+                for idx in range(len(PIECES)):
+                    sprite = source.subsurface(
+                        (idx * self.sourceSize, 0, self.sourceSize, self.sourceSize))
+                    # adding onto the transparent sheet copies pixels exactly, a normal blit would blend them
+                    sheet.blit(p.transform.scale(sprite, (size, size)),
+                               (idx * size, 0), special_flags=p.BLEND_RGBA_ADD)
+                self.changed = True
+            self.sheets[size] = sheet
+            scaled = [other for other in self.sheets if other != self.sourceSize]
+            if len(scaled) > MAX_SHEETS:
+                del self.sheets[scaled[0]]
+                self.converted.discard(scaled[0])
+        self.sheets.move_to_end(size)
+        return sheet
+
+    def sprites(self, size: int) -> dict[str, p.Surface]:
+        '''
+        Piece -> size x size sprite
+        '''
+        sheet = self.sheet(size)
+        if size not in self.converted and p.display.get_surface() is not None:
+            sheet = self.sheets[size] = sheet.convert_alpha()
+            self.converted.add(size)
+        return {piece: sheet.subsurface((idx * size, 0, size, size)) for idx, piece in enumerate(PIECES)}
+
+    def save(self, path: str):
+        '''
+        Write every sheet to path as one file, replacing it in a single step. Pixels are stored uncompressed so
+        loading is a read and a copy
+        '''
+        sheets = {size: p.image.tobytes(sheet, "RGBA")
+                  for size, sheet in self.sheets.items()}
+        sheets.update(self.packed)
+        with open(path + ".tmp", "wb") as file:
+            file.write(_HEADER.pack(ATLAS_MAGIC, ATLAS_VERSION,
+                       self.signature, self.sourceSize, len(sheets)))
+            for size, pixels in sheets.items():
+                file.write(_SHEET.pack(size, len(pixels)))
+                file.write(pixels)
+        os.replace(path + ".tmp", path)
+        self.changed = False
+
+
+def buildAtlas(directory: str) -> SpriteAtlas:
+    '''
+    Decode the piece PNGs in directory into a new atlas
+    '''
+    images = [p.image.load(os.path.join(directory, f"{piece}.png"))
+              for piece in PIECES]
+    size = images[0].get_height()
+    source = p.Surface((size * len(PIECES), size), p.SRCALPHA)
+    for idx, image in enumerate(images):
+        if image.get_size() != (size, size):
+            image = p.transform.scale(image, (size, size))
+        source.blit(image, (idx * size, 0), special_flags=p.BLEND_RGBA_ADD)
+    atlas = SpriteAtlas(size, sourceSignature(directory))
+    atlas.sheets[size] = source
+    atlas.changed = True
+    return atlas
+
+
+def loadAtlas(path: str, directory: str) -> SpriteAtlas:
+    '''
+    Atlas saved at path, or None if there isn't one or it was built from different images than those in directory
+    '''
+    try:
+        with open(path, "rb") as file:
+            data = file.read()
+        magic, version, signature, sourceSize, count = _HEADER.unpack_from(data)
+        if magic != ATLAS_MAGIC or version != ATLAS_VERSION or signature != sourceSignature(directory):
+            return None
+        atlas = SpriteAtlas(sourceSize, signature)
+        offset = _HEADER.size
+        for _ in range(count):
+            size, length = _SHEET.unpack_from(data, offset)
+            offset += _SHEET.size
+            if length != size * size * len(PIECES) * 4 or offset + length > len(data):
+                return None
+            atlas.packed[size] = data[offset:offset + length]
+            offset += length
+    except (OSError, struct.error):
+        return None
+    return atlas if sourceSize in atlas.packed else None
@@ -0,0 +1,147 @@
+# Territory (attack map) owned by GameState, kept up to date move by move instead of being rebuilt
+from typing import Iterable, Tuple
+import numpy as np
+from Pieces import *
+
+Square = Tuple[int, int]
+
+ORTHOGONAL = [(-1, 0), (0, -1), (1, 0), (0, 1)]
+DIAGONAL = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+KNIGHT_JUMPS = [(-2, -1), (-2, 1), (-1, -2), (-1, 2),
+                (1, -2), (1, 2), (2, -1), (2, 1)]
+KING_STEPS = ORTHOGONAL + DIAGONAL
+
+# heatmap kinds, as seen by one side: its own attackers, the enemy pieces defending against them and the difference
+ATTACKERS = "attackers"
+DEFENDERS = "defenders"
+NET = "net"
+HEATMAPS = [ATTACKERS, DEFENDERS, NET]
+HEATMAP_DTYPE = np.int8  # at most 16 pieces attack a square
+
+
+def pieceAttacks(board: list[list[str]], row: int, col: int) -> list[Square]:
+    '''
+    Squares the piece on (row, col) attacks or defends, sliders stop on (and include) the first piece they meet
+    '''
+    piece = board[row][col]
+    colour, type = piece[0], piece[1]
+    attacks = []
+    if type == PAWN:
+        endRow = row - 1 if colour == WHITE else row + 1
+        if 0 <= endRow < 8:
+            for endCol in (col - 1, col + 1):
+                if 0 <= endCol < 8:
+                    attacks.append((endRow, endCol))
+    elif type == KNIGHT or type == KING:
+        for dr, dc in KNIGHT_JUMPS if type == KNIGHT else KING_STEPS:
+            endRow, endCol = row + dr, col + dc
+            if 0 <= endRow < 8 and 0 <= endCol < 8:
+                attacks.append((endRow, endCol))
+    else:
+        directions = ORTHOGONAL if type == ROOK else DIAGONAL if type == BISHOP else KING_STEPS
+        for dr, dc in directions:
+            endRow, endCol = row + dr, col + dc
+            while 0 <= endRow < 8 and 0 <= endCol < 8:
+                attacks.append((endRow, endCol))
+                if board[endRow][endCol] != EMPTY:
+                    break
+                endRow, endCol = endRow + dr, endCol + dc
+    return attacks
+
+
+class TerritoryMap():
+    '''
+    Per-square attacker counts for both colours.
+    Every square remembers which pieces attack it, so a move only recomputes the pieces standing on the squares it
+    changed plus the sliders whose rays passed through those squares.
+    '''
+
+    def __init__(self, board: list[list[str]]) -> None:
+        self.counts = {WHITE: [[0] * 8 for _ in range(8)],
+                       BLACK: [[0] * 8 for _ in range(8)]}
+        # square -> squares of the pieces attacking it
+        self.attackedBy: list[list[set[Square]]] = [
+            [set() for _ in range(8)] for _ in range(8)]
+        # square of a piece -> (its colour, the squares it attacks)
+        self.attacks: dict[Square, Tuple[str, list[Square]]] = {}
+        for row in range(8):
+            for col in range(8):
+                if board[row][col] != EMPTY:
+                    self._addPiece(board, row, col)
+
+    def attackers(self, row: int, col: int, colour: str) -> int:
+        '''
+        Number of pieces of colour attacking (row, col)
+        '''
+        return self.counts[colour][row][col]
+
+    def heatmap(self, colour: str = WHITE, kind: str = NET) -> np.ndarray:
+        '''
+        8x8 array of attackers, defenders or net control (attackers - defenders) for colour, indexed [row][col]
+        '''
+        if kind not in HEATMAPS:
+            raise ValueError(
+                f"Unknown heatmap '{kind}', pick from {HEATMAPS}")
+        enemyColour = BLACK if colour == WHITE else WHITE
+        if kind == ATTACKERS:
+            return np.array(self.counts[colour], dtype=HEATMAP_DTYPE)
+        if kind == DEFENDERS:
+            return np.array(self.counts[enemyColour], dtype=HEATMAP_DTYPE)
+        return np.array(self.counts[colour], dtype=HEATMAP_DTYPE) - np.array(self.counts[enemyColour], dtype=HEATMAP_DTYPE)
+
+    def update(self, board: list[list[str]], changedSquares: list[Square]):
+        '''
+        Bring the map in line with board after the pieces on changedSquares were moved, captured or restored
+        '''
+        affected = set(changedSquares)
+        for row, col in changedSquares:
+            affected |= self.attackedBy[row][col]
+        for square in affected:
+            if square in self.attacks:
+                self._removePiece(square)
+        for row, col in affected:
+            if board[row][col] != EMPTY:
+                self._addPiece(board, row, col)
+
+    def _addPiece(self, board: list[list[str]], row: int, col: int):
+        colour = board[row][col][0]
+        attacks = pieceAttacks(board, row, col)
+        self.attacks[(row, col)] = (colour, attacks)
+        counts = self.counts[colour]
+        for endRow, endCol in attacks:
+            counts[endRow][endCol] += 1
+            self.attackedBy[endRow][endCol].add((row, col))
+
+    def _removePiece(self, square: Square):
+        colour, attacks = self.attacks.pop(square)
+        counts = self.counts[colour]
+        for endRow, endCol in attacks:
+            counts[endRow][endCol] -= 1
+            self.attackedBy[endRow][endCol].discard(square)
+
+
+def heatmapStack(positions: Iterable, colour: str = WHITE, kind: str = NET) -> np.ndarray:
+    '''
+    (N, 8, 8) heatmaps for many positions, each a GameState (whose territory is already up to date) or a board
+    '''
+    maps = [position.territory if hasattr(position, "territory") else TerritoryMap(position)
+            for position in positions]
+    stack = np.empty((len(maps), 8, 8), dtype=HEATMAP_DTYPE)
+    for idx, territory in enumerate(maps):
+        stack[idx] = territory.heatmap(colour, kind)
+    return stack
+
+
+def changedSquares(move) -> list[Square]:
+    '''
+    Every square whose contents a move changes, including en passant victims and castling rooks
+    '''
+    squares = [(move.startRow, move.startCol), (move.endRow, move.endCol)]
+    if move.isEnPassant:
+        squares.append((move.startRow, move.endCol))
+    if move.isCastle:
+        if move.endCol - move.startCol == 2:  # king side
+            squares += [(move.endRow, 7), (move.endRow, move.endCol - 1)]
+        else:
+            squares += [(move.endRow, 0), (move.endRow, move.endCol + 1)]
+    return squares
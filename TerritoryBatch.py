@@ -0,0 +1,200 @@
+# Batch territory evaluation: attacker counts at every ply of every game in a PGN file or directory, written as shards
+import argparse
+import json
+import os
+import sys
+import time
+from itertools import islice
+from typing import Iterator, NamedTuple, Optional
+import numpy as np
+from Pieces import *
+import PgnImport
+import Territory
+
+DEFAULT_SHARD_SIZE = 256  # games per output file
+COMPRESSED = "npz"  # one compressed archive per shard
+MEMMAP = "npy"  # one plain array file per shard and field, for np.load(mmap_mode="r")
+FORMATS = [COMPRESSED, MEMMAP]
+SHARD_FIELDS = ["territory", "offsets", "games", "complete"]
+CHECKPOINT_NAME = "checkpoint.json"
+CHECKPOINT_VERSION = 1
+
+
+class GameTerritory(NamedTuple):
+    index: int  # position of the game across all the input files, from 0
+    territory: np.ndarray  # (plies + 1, 2, 8, 8) white then black attacker counts, starting position first
+    error: Optional[str]  # None if every move was valid, otherwise the maps stop at the last valid move
+
+
+def territoryGame(game: PgnImport.PgnGame) -> GameTerritory:
+    '''
+    Play a game and record both colours' attacker counts after every move
+    '''
+    maps = []
+
+    def record(gs):
+        counts = gs.territory.counts
+        # a copy, the counts change with the next move
+        maps.append(np.array((counts[WHITE], counts[BLACK]), dtype=Territory.HEATMAP_DTYPE))
+
+    imported = PgnImport.convertGame(game, record)
+    territory = np.stack(maps) if maps else np.empty(
+        (0, 2, 8, 8), dtype=Territory.HEATMAP_DTYPE)
+    return GameTerritory(game.index, territory, imported.error)
+
+
+def pgnFiles(path: str) -> list[str]:
+    '''
+    path itself if it's a file, otherwise every .pgn file below it in a stable order
+    '''
+    if not os.path.isdir(path):
+        return [path]
+    files = []
+    for directory, subdirectories, names in os.walk(path):
+        subdirectories.sort()
+        files += [os.path.join(directory, name)
+                  for name in sorted(names) if name.lower().endswith(".pgn")]
+    return files
+
+
+def readAllGames(files: list[str]) -> Iterator[PgnImport.PgnGame]:
+    '''
+    Games of every file one after the other, numbered across all of them
+    '''
+    index = 0
+    for file in files:
+        with open(file, encoding="utf-8", errors="replace") as stream:
+            for game in PgnImport.readGames(stream):
+                yield game._replace(index=index)
+                index += 1
+
+
+def shardPath(directory: str, shard: int, field: str = None) -> str:
+    return os.path.join(directory, f"shard-{shard:05d}" + (f".{field}.npy" if field else ".npz"))
+
+
+def writeShard(directory: str, shard: int, games: list[GameTerritory], format: str = COMPRESSED):
+    '''
+    Save a shard's games as SHARD_FIELDS: every game's maps end to end, where each game's maps start (plus the total),
+    the games' indices and whether they were played to the end. Files are written under a temporary name and renamed
+    '''
+    lengths = [len(game.territory) for game in games]
+    arrays = {
+        "territory": np.concatenate([game.territory for game in games]) if games else
+        np.empty((0, 2, 8, 8), dtype=Territory.HEATMAP_DTYPE),
+        "offsets": np.concatenate(([0], np.cumsum(lengths, dtype=np.int64))),
+        "games": np.array([game.index for game in games], dtype=np.int64),
+        "complete": np.array([game.error is None for game in games], dtype=bool),
+    }
+    if format == COMPRESSED:
+        paths = {shardPath(directory, shard): arrays}
+    else:
+        paths = {shardPath(directory, shard, field): array for field, array in arrays.items()}
+    for path, data in paths.items():
+        with open(path + ".tmp", "wb") as file:
+            if format == COMPRESSED:
+                np.savez_compressed(file, **data)
+            else:
+                np.save(file, data)
+        os.replace(path + ".tmp", path)
+
+
+def loadShard(directory: str, shard: int, format: str = COMPRESSED) -> dict[str, np.ndarray]:
+    '''
+    SHARD_FIELDS of a shard written by writeShard, the plain array files are memory mapped rather than read
+    '''
+    if format == COMPRESSED:
+        with np.load(shardPath(directory, shard)) as archive:
+            return {field: archive[field] for field in SHARD_FIELDS}
+    return {field: np.load(shardPath(directory, shard, field), mmap_mode="r") for field in SHARD_FIELDS}
+
+
+def readCheckpoint(directory: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(directory, CHECKPOINT_NAME)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def writeCheckpoint(directory: str, checkpoint: dict):
+    path = os.path.join(directory, CHECKPOINT_NAME)
+    with open(path + ".tmp", "w") as file:
+        json.dump(checkpoint, file, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def runBatch(path: str, output: str, workers: int = os.cpu_count() or 1, shardSize: int = DEFAULT_SHARD_SIZE,
+             format: str = COMPRESSED, batchSize: int = PgnImport.DEFAULT_BATCH_SIZE) -> dict:
+    '''
+    Evaluate every game under path into shards of shardSize games in output, carrying on from the checkpoint there
+    if an earlier run was stopped. The checkpoint is only moved on once a shard is completely written, so at worst
+    the shard being written when the run stopped is redone. Returns the final checkpoint
+    '''
+    if format not in FORMATS:
+        raise ValueError(f"Unknown output format '{format}', pick from {FORMATS}!")
+    files = pgnFiles(path)
+    os.makedirs(output, exist_ok=True)
+    settings = {"version": CHECKPOINT_VERSION, "files": [os.path.abspath(file) for file in files],
+                "shardSize": shardSize, "format": format}
+    checkpoint = readCheckpoint(output)
+    if checkpoint is None:
+        checkpoint = dict(settings, games=0, shards=0, plies=0, errors=0)
+    elif any(checkpoint.get(key) != value for key, value in settings.items()):
+        raise ValueError(
+            f"{output} holds a run with different input files or settings, use another output directory!")
+    elif checkpoint["games"]:
+        print(f"resuming after {checkpoint['games']} games ({checkpoint['shards']} shards)")
+
+    start = time.perf_counter()
+    gameCount = plyCount = 0
+    games = islice(readAllGames(files), checkpoint["games"], None)
+    shard: list[GameTerritory] = []
+    results = PgnImport.importGames(games, workers, batchSize, territoryGame)
+    while True:
+        game = next(results, None)
+        if game is not None:
+            shard.append(game)
+            gameCount += 1
+            plyCount += max(len(game.territory) - 1, 0)
+        if shard and (len(shard) == shardSize or game is None):
+            writeShard(output, checkpoint["shards"], shard, format)
+            checkpoint["games"] += len(shard)
+            checkpoint["shards"] += 1
+            checkpoint["plies"] += sum(max(len(game.territory) - 1, 0) for game in shard)
+            checkpoint["errors"] += sum(game.error is not None for game in shard)
+            writeCheckpoint(output, checkpoint)
+            shard = []
+        if game is None:
+            break
+
+    seconds = time.perf_counter() - start
+    print(f"{gameCount} games, {plyCount} plies in {seconds:.2f}s "
+          f"({gameCount / seconds if seconds else 0:.1f} games/s, {plyCount / seconds if seconds else 0:.0f} plies/s), "
+          f"{checkpoint['games']} games in {checkpoint['shards']} shards in total, {checkpoint['errors']} with errors")
+    return checkpoint
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Record both colours' territory (attacker counts per square) at every ply of every game")
+    parser.add_argument("pgn", help="PGN file, or directory searched for .pgn files")
+    parser.add_argument("-o", "--output", required=True,
+                        help="directory for the shards and checkpoint, rerun with the same one to resume")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1,
+                        help="worker processes, 1 to evaluate in this process (default: one per CPU)")
+    parser.add_argument("--shard-size", type=int, default=DEFAULT_SHARD_SIZE,
+                        help=f"games per shard (default {DEFAULT_SHARD_SIZE})")
+    parser.add_argument("--format", choices=FORMATS, default=COMPRESSED,
+                        help="npz: a compressed archive per shard, npy: plain arrays that can be memory mapped")
+    parser.add_argument("--batch-size", type=int, default=PgnImport.DEFAULT_BATCH_SIZE,
+                        help=f"games sent to a worker at a time (default {PgnImport.DEFAULT_BATCH_SIZE})")
+    args = parser.parse_args()
+    try:
+        runBatch(args.pgn, args.output, args.workers, args.shard_size, args.format, args.batch_size)
+    except ValueError as e:
+        sys.exit(str(e))
+
+
+if __name__ == "__main__":
+    main()
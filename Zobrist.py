@@ -0,0 +1,85 @@
+# Zobrist position keys and the LRU cache of generated moves keyed by them
+import random
+from collections import OrderedDict
+from typing import Tuple
+from Pieces import *
+
+# positions cached per GameState, off by default: perft and search visit too few positions twice for the hits to pay
+# for the LRU bookkeeping (kiwipete perft 3 took 0.64s with 4096 entries against 0.49s without, a 30000 node search
+# 3.85s against 3.22s)
+DEFAULT_CACHE_SIZE = 0
+
+_random = random.Random(0x5EED)  # fixed seed so keys are stable between runs and processes
+
+PIECE_KEYS = {piece: [[_random.getrandbits(64) for _ in range(8)] for _ in range(8)]
+              for piece in PIECES}
+BLACK_TO_MOVE_KEY = _random.getrandbits(64)
+CASTLE_KEYS = [_random.getrandbits(64) for _ in range(4)]  # wks, wqs, bks, bqs
+EN_PASSANT_KEYS = [_random.getrandbits(64) for _ in range(8)]  # by column
+
+
+def castleKey(castleRights: Tuple[bool, bool, bool, bool]) -> int:
+    key = 0
+    for idx, castleRight in enumerate(castleRights):
+        if castleRight:
+            key ^= CASTLE_KEYS[idx]
+    return key
+
+
+def enPassantKey(enPassantPossible: tuple) -> int:
+    return EN_PASSANT_KEYS[enPassantPossible[1]] if enPassantPossible else 0
+
+
+def hashPosition(board: list[list[str]], whiteToMove: bool, castleRights: Tuple[bool, bool, bool, bool], enPassantPossible: tuple) -> int:
+    '''
+    Full Zobrist key of a position, GameState keeps its own key up to date incrementally from this starting value
+    '''
+    key = 0
+    for row in range(8):
+        for col in range(8):
+            piece = board[row][col]
+            if piece != EMPTY:
+                key ^= PIECE_KEYS[piece][row][col]
+    if not whiteToMove:
+        key ^= BLACK_TO_MOVE_KEY
+    return key ^ castleKey(castleRights) ^ enPassantKey(enPassantPossible)
+
+
+class MoveCache():
+    '''
+    Bounded least recently used cache of getValidMoves results keyed by Zobrist key
+    '''
+
+    def __init__(self, maxSize: int) -> None:
+        self.maxSize = maxSize
+        self.entries: OrderedDict[int, list] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: int):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: int, entry: list):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __str__(self) -> str:
+        lookups = self.hits + self.misses
+        hitRate = self.hits / lookups if lookups else 0
+        return f"{len(self)}/{self.maxSize} positions, {self.hits} hits, {self.misses} misses ({hitRate:.0%} hit rate)"
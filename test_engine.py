@@ -0,0 +1,512 @@
+# Engine tests, a class per feature. python -m unittest or pytest runs them
+import os
+import random
+import tempfile
+import unittest
+import numpy as np
+from unittest import mock
+from Pieces import *
+import Analysis
+import Bitboard
+import ChessEngine
+import Fen
+import Headless
+import Perft
+import PgnImport
+import PositionStore
+import Search
+import Territory
+import Zobrist
+
+MAX_PERFT_NODES = 20000  # deeper counts are left to python Perft.py
+RANDOM_GAMES = 8
+RANDOM_GAME_PLIES = 80
+PROMOTION_CHOICES = [QUEEN, ROOK, BISHOP, KNIGHT]
+CACHE_SIZES = [0, 64]  # move cache off, and small enough to evict during a random game
+
+
+def randomGames(backend: str = ChessEngine.LIST_BACKEND, cacheSize: int = 0):
+    '''
+    Play RANDOM_GAMES seeded random games with push, yielding the game state after every move
+    '''
+    rng = random.Random(1)
+    for _ in range(RANDOM_GAMES):
+        gs = ChessEngine.GameState(backend=backend, cacheSize=cacheSize)
+        for _ in range(RANDOM_GAME_PLIES):
+            moves, _ = gs.getValidMoves()
+            if not moves:
+                break
+            move = rng.choice(moves)
+            gs.push(move.withPromotion(rng.choice(PROMOTION_CHOICES)) if move.isPawnPromotion else move)
+            yield gs
+
+
+def positionState(gs: ChessEngine.GameState) -> tuple:
+    return (gs.getFen(), [row[:] for row in gs.board], gs.whiteKingLoc, gs.blackKingLoc, gs.zobristKey,
+            gs.territory.counts[WHITE], gs.territory.counts[BLACK], gs.checkmate, gs.stalemate)
+
+
+class BitboardTest(unittest.TestCase):
+    def testIncrementalBitboards(self):
+        for cacheSize in CACHE_SIZES:
+            for gs in randomGames(ChessEngine.BITBOARD_BACKEND, cacheSize):
+                bitboards = Bitboard.BitboardPosition(gs.board)
+                self.assertEqual((gs.bitboards.pieces, gs.bitboards.colours, gs.bitboards.mailbox),
+                                 (bitboards.pieces, bitboards.colours, bitboards.mailbox))
+
+    def testSameMovesAsLists(self):
+        for gs in randomGames(ChessEngine.BITBOARD_BACKEND):
+            lists = ChessEngine.GameState(cacheSize=0)
+            lists.setFen(gs.getFen())
+            self.assertEqual(sorted(move.getLongNotation() for move in gs.getValidMoves()[0]),
+                             sorted(move.getLongNotation() for move in lists.getValidMoves()[0]))
+
+
+class TerritoryTest(unittest.TestCase):
+    def testIncrementalTerritory(self):
+        for cacheSize in CACHE_SIZES:
+            for gs in randomGames(cacheSize=cacheSize):
+                self.assertEqual(gs.territory.counts, Territory.TerritoryMap(gs.board).counts)
+
+    def testUndoneMoves(self):
+        for gs in randomGames():
+            if len(gs.pushedMoves) % 10 == 0:
+                # take back half the game, checking every position on the way
+                for _ in range(len(gs.pushedMoves) // 2):
+                    gs.pop()
+                    self.assertEqual(gs.territory.counts, Territory.TerritoryMap(gs.board).counts)
+
+
+class PerftTest(unittest.TestCase):
+    def testCounts(self):
+        for backend in ChessEngine.BACKENDS:
+            for name, fen, counts in Perft.POSITIONS:
+                gs = Perft.positionFromFen(fen, backend, cacheSize=0)
+                for depth, expected in enumerate(counts, start=1):
+                    if expected > MAX_PERFT_NODES:
+                        break
+                    with self.subTest(backend=backend, position=name, depth=depth):
+                        self.assertEqual(Perft.perft(gs, depth), expected)
+
+    def testDivide(self):
+        gs = Perft.positionFromFen(Perft.POSITIONS[0][1])
+        results = Perft.divide(gs, 2)
+        self.assertEqual((len(results), sum(nodes for _, nodes in results)), (20, 400))
+
+
+class ZobristTest(unittest.TestCase):
+    def testIncrementalKeys(self):
+        for cacheSize in CACHE_SIZES:
+            for gs in randomGames(cacheSize=cacheSize):
+                self.assertEqual(gs.zobristKey, Zobrist.hashPosition(
+                    gs.board, gs.whiteToMove, gs.currentCastleRights, gs.enPassantPossible))
+
+    def testCachedMoves(self):
+        # revisiting positions with pop and push serves their moves from the cache, unchanged
+        for gs in randomGames(cacheSize=CACHE_SIZES[-1]):
+            if len(gs.pushedMoves) >= 2:
+                moves = [move.getLongNotation() for move in gs.getValidMoves()[0]]
+                undone = [gs.pop(), gs.pop()]
+                hits = gs.moveCache.hits
+                for move in reversed(undone):
+                    gs.getValidMoves()
+                    gs.push(move)
+                self.assertEqual([move.getLongNotation() for move in gs.getValidMoves()[0]], moves)
+                self.assertEqual(gs.moveCache.hits, hits + 3)
+        self.assertTrue(all(move.promotionChoice is None for move in gs.getValidMoves()[0]))
+
+
+class FenTest(unittest.TestCase):
+    def testRoundTrips(self):
+        for gs in randomGames():
+            fen = gs.getFen()
+            copy = ChessEngine.GameState(cacheSize=0)
+            copy.setFen(fen)
+            self.assertEqual(copy.getFen(), fen)
+            copy.setPackedPosition(gs.getPackedPosition())
+            self.assertEqual(copy.getFen(), fen)
+            self.assertEqual(copy.zobristKey, gs.zobristKey)
+
+    def testImpossiblePositions(self):
+        for fen in ["P3k3/8/8/8/8/8/8/4K3 w - - 0 1",  # pawn on the last rank
+                    "4k3/8/8/8/8/8/8/p3K3 b - - 0 1",  # pawn on the first rank
+                    "4k3/8/8/8/8/8/3P4/4K3 w - e3 0 1",  # en passant square on the mover's side
+                    "4k3/8/8/8/3Pp3/8/8/4K3 w - d3 0 1",  # rank 3 with white to move
+                    "4k3/8/8/3p4/8/8/8/4K3 w - e6 0 1",  # no pawn in front of it
+                    "4k3/8/4p3/3pP3/8/8/8/4K3 w - e6 0 1",  # the square itself is taken
+                    "4k3/4p3/8/4p3/8/8/8/4K3 w - e6 0 1",  # and so is the one the pawn started from
+                    "4k2R/8/8/8/8/8/8/4K3 w - - 0 1",  # the king of the side not to move is in check
+                    "4k3/8/8/8/8/3n4/8/4K3 b - - 0 1",
+                    "4k3/8/8/8/8/8/8/4K2k w - - 0 1"]:  # two black kings
+            with self.subTest(fen=fen):
+                with self.assertRaises(ValueError):
+                    Fen.parseFen(fen)
+
+    def testMissingCastlingPieces(self):
+        gs = ChessEngine.GameState(cacheSize=0)
+        gs.setFen("r3k3/8/8/8/8/8/8/R3K2R w KQkq - 0 1")
+        self.assertEqual(gs.getFen(), "r3k3/8/8/8/8/8/8/R3K2R w KQq - 0 1")
+        gs.setFen("4k3/8/8/8/8/8/8/4K3 w K - 0 1")
+        self.assertNotIn("e1g1", [move.getLongNotation() for move in gs.getValidMoves()[0]])
+
+    def testEnPassant(self):
+        gs = ChessEngine.GameState(cacheSize=0)
+        gs.setFen("4k3/8/8/3pP3/8/8/8/4K3 w - d6 0 1")
+        self.assertIn("e5d6", [move.getLongNotation() for move in gs.getValidMoves()[0]])
+        gs.setFen("4k3/8/8/8/3Pp3/8/8/4K3 b - d3 0 1")
+        self.assertIn("e4d3", [move.getLongNotation() for move in gs.getValidMoves()[0]])
+
+    def testCheckedSideToMove(self):
+        gs = ChessEngine.GameState(cacheSize=0)
+        gs.setFen("4k2R/8/8/8/8/8/8/4K3 b - - 0 1")
+        self.assertTrue(gs.hasLegalMove())
+        self.assertTrue(gs.inCheck)
+
+
+class PushPopTest(unittest.TestCase):
+    def testRestoresPosition(self):
+        for gs in randomGames():
+            before = positionState(gs)
+            for move in gs.getValidMoves()[0]:
+                gs.push(move)
+                gs.pop()
+                self.assertEqual(positionState(gs), before)
+
+    def testLeavesLogAlone(self):
+        gs = ChessEngine.GameState(cacheSize=0)
+        gs.push(gs.getValidMoves()[0][0])
+        self.assertEqual((gs.moveLog, gs.moveLogSize, gs.moveIdx), ([], 0, None))
+        gs.pop()
+        self.assertEqual(gs.pushedMoves, [])
+
+
+class HeatmapTest(unittest.TestCase):
+    def testHeatmaps(self):
+        gs = ChessEngine.GameState(cacheSize=0)
+        gs.setFen("4k3/8/8/8/8/8/8/R3K3 w - - 0 1")
+        attackers = gs.getTerritoryHeatmap(WHITE, Territory.ATTACKERS)
+        defenders = gs.getTerritoryHeatmap(WHITE, Territory.DEFENDERS)
+        self.assertEqual((attackers.shape, attackers.dtype), ((8, 8), Territory.HEATMAP_DTYPE))
+        # the rook sees up its file and along the rank up to and including its own king, the king its neighbours
+        self.assertEqual(attackers[:, 0].tolist(), [1, 1, 1, 1, 1, 1, 1, 0])
+        self.assertEqual(attackers[7].tolist(), [0, 1, 1, 2, 1, 1, 0, 0])
+        self.assertEqual(defenders[1, 3:6].tolist(), [1, 1, 1])
+        self.assertTrue(np.array_equal(gs.getTerritoryHeatmap(WHITE), attackers - defenders))
+        self.assertTrue(np.array_equal(gs.getTerritoryHeatmap(BLACK), defenders - attackers))
+        with self.assertRaises(ValueError):
+            gs.getTerritoryHeatmap(WHITE, "unknown")
+
+    def testHeatmapStack(self):
+        states = [ChessEngine.GameState(cacheSize=0) for _ in range(3)]
+        states[1].push(states[1].getValidMoves()[0][0])
+        stack = Territory.heatmapStack(states + [states[2].board], BLACK, Territory.ATTACKERS)
+        self.assertEqual(stack.shape, (4, 8, 8))
+        for idx, gs in enumerate(states):
+            self.assertTrue(np.array_equal(stack[idx], gs.getTerritoryHeatmap(BLACK, Territory.ATTACKERS)))
+        self.assertTrue(np.array_equal(stack[3], stack[2]))
+        self.assertEqual(Territory.heatmapStack([]).shape, (0, 8, 8))
+
+
+class MoveLogTest(unittest.TestCase):
+    def testRedoPromotion(self):
+        # a logged promotion without a choice asks once on redo and keeps the answer, undo restores castling
+        gs = ChessEngine.GameState(cacheSize=0)
+        gs.setFen("r3k3/1P6/8/8/8/8/8/4K3 w q - 0 1")
+        move = next(move for move in gs.getValidMoves()[0] if move.getLongNotation()[:4] == "b7a8")
+        gs.moveLog.append(move)
+        gs.moveLogSize = 1
+        with mock.patch("builtins.input", return_value="N") as input:
+            for _ in range(2):
+                gs.redoMove()
+                self.assertEqual(gs.getFen(), "N3k3/8/8/8/8/8/8/4K3 b - - 0 1")
+                gs.undoMove()
+                self.assertEqual(gs.getFen(), "r3k3/1P6/8/8/8/8/8/4K3 w q - 0 1")
+        self.assertEqual(input.call_count, 1)
+        self.assertEqual((move.promotionChoice, gs.moveLog[0].promotionChoice), (None, KNIGHT))
+
+
+class NotationTest(unittest.TestCase):
+    def testDisambiguation(self):
+        gs = ChessEngine.GameState(cacheSize=0)
+        gs.setFen("4k3/8/8/R6R/8/Q7/8/Q1Q1K3 w - - 0 1")
+        index = gs.getNotationIndex()
+        # queens on a1, a3 and c1 all reach b2: a1 shares a file with a3 and a rank with c1
+        for san, longNotation in [("Qa1b2", "a1b2"), ("Q3b2", "a3b2"), ("Qcb2", "c1b2"), ("Q1a2", "a1a2"),
+                                  ("Rad5", "a5d5"), ("Rhd5", "h5d5"), ("Ra8", "a5a8")]:
+            with self.subTest(san=san):
+                self.assertEqual(index[san].getLongNotation(), longNotation)
+        for san in ["Qb2", "Rd5", "Qab2", "Qa3b2"]:
+            with self.subTest(san=san):
+                self.assertNotIn(san, index)
+
+    def testConvertNotation(self):
+        gs = ChessEngine.GameState(cacheSize=0)
+        gs.setFen("4k3/1P6/8/8/8/5N2/8/RN2K2R w KQ - 0 1")
+        for san, longNotation in [("Nbd2", "b1d2"), ("Nfd2+", "f3d2"), ("O-O", "e1g1"), ("0-0", "e1g1"),
+                                  ("b8=N!?", "b7b8n"), ("b8=Q#", "b7b8q")]:
+            with self.subTest(san=san):
+                self.assertEqual(gs.convertNotationToValidMove(san, display=False).getLongNotation(), longNotation)
+        # without a piece the promotion is left for the caller to ask about, PgnImport rejects it
+        self.assertIsNone(gs.convertNotationToValidMove("b8", display=False).promotionChoice)
+        for san in ["Nd2", "O-O-O", "b8=K", "Ra1=Q", "e4"]:
+            with self.subTest(san=san):
+                with self.assertRaises(ValueError):
+                    gs.convertNotationToValidMove(san, display=False)
+        self.assertTrue(all(move.promotionChoice is None for move in gs.getValidMoves()[0]))
+
+
+class PgnImportTest(unittest.TestCase):
+    PGN = ['[Event "first"]',
+           '[White "A \\"quoted\\" name"]',
+           '',
+           '1. e4 {a comment',
+           '[that looks like a tag]} e5 2. Nf3 (2. f4 exf4 (2... d5)) Nc6 $1 3. Bb5 a6 1-0',
+           '',
+           '1. d4 d5 *',
+           '% escaped line',
+           '[Event "third"]',
+           '1. e4 e5 2. Nf3 Ke6']
+
+    def testReadGames(self):
+        games = list(PgnImport.readGames(self.PGN))
+        self.assertEqual([game.index for game in games], [0, 1, 2])
+        self.assertEqual(games[0].tags, {"Event": "first", "White": 'A "quoted" name'})
+        self.assertIn("[that looks like a tag]", games[0].movetext)
+        self.assertEqual((games[1].tags, games[1].movetext), ({}, "1. d4 d5 *"))
+        self.assertEqual(games[2].tags, {"Event": "third"})
+
+    def testSanTokens(self):
+        movetext = next(PgnImport.readGames(self.PGN)).movetext
+        self.assertEqual(PgnImport.sanTokens(movetext), ["e4", "e5", "Nf3", "Nc6", "Bb5", "a6"])
+        self.assertEqual(PgnImport.sanTokens("1.e4 1...e5 2.Nf3!? ; rest of line\n Nc6 1/2-1/2"),
+                         ["e4", "e5", "Nf3!?", "Nc6"])
+
+    def testImportGames(self):
+        games = list(PgnImport.readGames(self.PGN)) * 3
+        for workers in (1, 2):
+            with self.subTest(workers=workers):
+                imported = list(PgnImport.importGames(games, workers, batchSize=1))
+                self.assertEqual([game.moves for game in imported[:3]],
+                                 [["e2e4", "e7e5", "g1f3", "b8c6", "f1b5", "a7a6"], ["d2d4", "d7d5"],
+                                  ["e2e4", "e7e5", "g1f3"]])
+                self.assertEqual([game.error is None for game in imported], [True, True, False] * 3)
+                self.assertIn("ply 4", imported[2].error)
+
+
+class SeekTest(unittest.TestCase):
+    def playGame(self, seed: int, plies: int = 70) -> ChessEngine.GameState:
+        '''
+        A logged random game of up to plies moves, played with makeMove
+        '''
+        rng = random.Random(seed)
+        gs = ChessEngine.GameState(cacheSize=0)
+        for _ in range(plies):
+            moves, _ = gs.getValidMoves()
+            if not moves:
+                break
+            move = rng.choice(moves)
+            gs.makeMove(move.withPromotion(rng.choice(PROMOTION_CHOICES)) if move.isPawnPromotion else move)
+        return gs
+
+    def replayed(self, moves: list[ChessEngine.Move]) -> tuple:
+        '''
+        Position after playing moves on a new game, to compare seek and undo/redo against
+        '''
+        gs = ChessEngine.GameState(moves, cacheSize=0)
+        for move in moves:
+            gs.push(move)
+        return gs.getFen().rsplit(' ', 2)[0], gs.zobristKey, gs.territory.counts
+
+    def assertAtPly(self, gs: ChessEngine.GameState, moves: list[ChessEngine.Move], ply: int):
+        self.assertEqual(gs.getPly(), ply)
+        self.assertEqual((gs.getFen().rsplit(' ', 2)[0], gs.zobristKey, gs.territory.counts),
+                         self.replayed(moves[:ply]))
+        self.assertEqual(gs.territory.counts, Territory.TerritoryMap(gs.board).counts)
+
+    def testSeekUndoRedo(self):
+        for seed in range(3):
+            gs = self.playGame(seed)
+            moves = list(gs.moveLog)
+            rng = random.Random(seed)
+            for ply in [0, len(moves), ChessEngine.SNAPSHOT_INTERVAL, 1] + rng.sample(range(len(moves) + 1), 12):
+                with self.subTest(seed=seed, ply=ply):
+                    gs.seek(ply)
+                    self.assertAtPly(gs, moves, ply)
+                    if ply > 0:
+                        gs.undoMove()
+                        self.assertAtPly(gs, moves, ply - 1)
+                        gs.redoMove()
+                        self.assertAtPly(gs, moves, ply)
+            self.assertEqual(gs.moveLog, moves)
+
+    def testSeekPreloadedLog(self):
+        # a log handed to the constructor has no snapshots past the start until seek gets there
+        moves = list(self.playGame(3).moveLog)
+        gs = ChessEngine.GameState(moves, cacheSize=0)
+        for ply in [len(moves) - 1, 5, len(moves), 0]:
+            gs.seek(ply)
+            self.assertAtPly(gs, moves, ply)
+
+    def testBranchTruncation(self):
+        gs = self.playGame(4)
+        moves = list(gs.moveLog)
+        branchPly = ChessEngine.SNAPSHOT_INTERVAL + 3
+        gs.seek(branchPly)
+        branch = next(move for move in gs.getValidMoves()[0] if move != moves[branchPly])
+        gs.makeMove(branch.withPromotion(QUEEN) if branch.isPawnPromotion else branch)
+        newMoves = moves[:branchPly] + [gs.moveLog[-1]]
+        self.assertEqual((gs.moveLog, gs.moveLogSize), (newMoves, branchPly + 1))
+        self.assertEqual(len(gs.plyStates), branchPly + 2)
+        self.assertTrue(all(ply <= branchPly + 1 for ply in gs.snapshots))
+        for ply in [0, branchPly + 1, ChessEngine.SNAPSHOT_INTERVAL, branchPly + 1]:
+            gs.seek(ply)
+            self.assertAtPly(gs, newMoves, ply)
+        with self.assertRaises(ValueError):
+            gs.seek(branchPly + 2)
+        gs.push(gs.getValidMoves()[0][0])
+        with self.assertRaises(ValueError):
+            gs.seek(0)
+
+
+class PositionStoreTest(unittest.TestCase):
+    def testRoundTrip(self):
+        pgn = ['[Event "a"]', '', '1. e4 e5 2. Nf3 Nc6 *', '', '[Event "b"]', '', '1. d4 Ke7 *', '',
+               '[Event "c"]', '', '1. c4 *']
+        games = [PositionStore.storeGame(game) for game in PgnImport.readGames(pgn)]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "games.store")
+            # written out of order, the index is sorted by game id
+            PositionStore.writeStore(path, [games[2], games[0], games[1]])
+            store = PositionStore.PositionStore(path)
+            self.assertEqual((len(store), store.gameIds().tolist()), (3, [0, 1, 2]))
+            self.assertEqual([len(store.game(gameId)) for gameId in range(3)], [5, 2, 2])
+            self.assertEqual(store.entry(1)["complete"], False)
+            gs = ChessEngine.GameState(cacheSize=0)
+            for ply, move in enumerate(["e2e4", "e7e5", "g1f3", "b8c6"], start=1):
+                gs.push(next(valid for valid in gs.getValidMoves()[0] if valid.getLongNotation() == move))
+                self.assertEqual(Fen.formatFen(store.position(0, ply)), gs.getFen())
+                counts = gs.territory.counts
+                self.assertEqual(store.territory(0, ply).tolist(), [counts[WHITE], counts[BLACK]])
+            for gameId, ply in [(3, 0), (0, 5), (0, -1)]:
+                with self.assertRaises(ValueError):
+                    store.record(gameId, ply)
+            del store  # the map has to be closed before the directory goes
+            with open(path, "r+b") as file:
+                file.truncate(os.path.getsize(path) - 1)
+            with self.assertRaises(ValueError):
+                PositionStore.PositionStore(path)
+
+
+class SearchTest(unittest.TestCase):
+    def testCaptures(self):
+        # what quiescence searches: the captures and promotions getValidMoves finds, less en passant
+        for backend in ChessEngine.BACKENDS:
+            with self.subTest(backend=backend):
+                for gs in randomGames(backend):
+                    captures = {move.moveID for move in gs.getCaptures()}
+                    if gs.inCheck:
+                        self.assertEqual(captures, set())
+                        continue
+                    moves, _ = gs.getValidMoves()
+                    self.assertEqual(captures, {move.moveID for move in moves
+                                                if (move.isCapture and not move.isEnPassant) or move.isPawnPromotion})
+
+    def testQuiescence(self):
+        gs = ChessEngine.GameState(cacheSize=0)
+        gs.setFen("4k3/8/8/3p4/4P3/8/8/4K3 w - - 0 1")
+        self.assertEqual(Search.Searcher().search(gs, None, maxDepth=1).move.getLongNotation(), "e4d5")
+        # the pawn is defended, the queen taking it is left out
+        gs.setFen("4k3/8/2p5/3p4/8/8/8/3QK3 w - - 0 1")
+        self.assertEqual(Search.Searcher().quiescence(gs, -Search.INFINITY, Search.INFINITY, 0), Search.evaluate(gs))
+
+
+class LegalMoveTest(unittest.TestCase):
+    def testLazyMoves(self):
+        for backend in ChessEngine.BACKENDS:
+            for cacheSize in CACHE_SIZES:
+                with self.subTest(backend=backend, cacheSize=cacheSize):
+                    for gs in randomGames(backend, cacheSize):
+                        moves, _ = gs.getValidMoves()
+                        self.assertEqual(sorted(move.moveID for move in gs.iterLegalMoves()),
+                                         sorted(move.moveID for move in moves))
+                        self.assertEqual(gs.hasLegalMove(), bool(moves))
+                        for move in moves:
+                            legalMove = gs.legalMove(ChessEngine.Move((move.startRow, move.startCol),
+                                                                      (move.endRow, move.endCol), gs.board))
+                            self.assertEqual((legalMove.moveID, legalMove.isCastle, legalMove.isEnPassant,
+                                              legalMove.isPawnPromotion),
+                                             (move.moveID, move.isCastle, move.isEnPassant, move.isPawnPromotion))
+                        # the same squares, played by the other side's piece or to a square it can't reach
+                        for move in gs.getAllPossibleMoves()[0]:
+                            self.assertEqual(gs.isLegal(move), move in moves)
+
+    def testMates(self):
+        gs = ChessEngine.GameState(cacheSize=0)
+        for fen, checkmate in [("rnb1kbnr/pppp1ppp/8/4p3/6Pq/5P2/PPPPP2P/RNBQKBNR w KQkq - 1 3", True),
+                               ("K1k5/P7/8/8/8/8/8/8 w - - 0 1", False)]:
+            gs.setFen(fen)
+            self.assertFalse(gs.hasLegalMove())
+            gs.getValidMoves()
+            self.assertEqual((gs.checkmate, gs.stalemate), (checkmate, not checkmate))
+
+
+class AnalysisTest(unittest.TestCase):
+    def testInlineAnalysis(self):
+        notified = []
+        analysis = Analysis.InlineAnalysis(lambda: notified.append(True))
+        gs = ChessEngine.GameState(cacheSize=0)
+        gs.setFen("6bn/5Ppk/6pp/8/8/8/8/K7 w - - 0 1")  # only promoting to a knight mates
+        fen = gs.getFen()
+        id = analysis.post(gs, 1.0)
+        result = analysis.poll()
+        self.assertEqual((result.id, notified), (id, [True]))
+        self.assertEqual(result.move, "f7f8n")
+        self.assertEqual(result.pv, ["f7f8n"])
+        self.assertIn("f7f8", result.moves)
+        self.assertEqual(gs.getFen(), fen)
+        counts = gs.territory.counts
+        self.assertEqual(result.territory.tolist(), [counts[WHITE], counts[BLACK]])
+
+
+class HeadlessTest(unittest.TestCase):
+    def testFenLines(self):
+        lines = ["startpos moves e2e4 e7e5",
+                 "P3k3/8/8/8/8/8/8/4K3 w - - 0 1",
+                 "4k3/8/8/8/8/8/3P4/4K3 w - e3 0 1",
+                 "4k3/8/8/8/8/8/8/4K3 w K - 0 1 moves e1g1",
+                 "# skipped",
+                 "",
+                 "fen 4k3/8/8/3pP3/8/8/8/4K3 w - d6 0 1 moves e5d6"]
+        games = list(Headless.analyseFen(lines))
+        self.assertEqual([game.label for game in games], ["line 1", "line 2", "line 3", "line 4", "line 7"])
+        self.assertEqual([len(game.positions) for game in games], [3, 0, 0, 1, 2])
+        self.assertEqual([game.error is None for game in games], [True, False, False, False, True])
+        self.assertIn("ply 1", games[3].error)
+        self.assertEqual(games[4].positions[-1].fen, "4k3/8/3P4/8/8/8/8/4K3 b - - 0 1")
+
+    def testUnexpectedErrors(self):
+        # a line or game that raises something other than ValueError is reported and the rest still analysed
+        for analyse, lines in [(Headless.analyseFen, ["startpos", "startpos moves e2e4"]),
+                               (Headless.analysePgn, ['[Event "a"]', '', '1. e4 *', '', '[Event "b"]', '', '1. d4 *'])]:
+            with self.subTest(analyse=analyse.__name__):
+                reportPosition = Headless.reportPosition
+                calls = []
+
+                def failFirst(gs, ply):
+                    calls.append(ply)
+                    if len(calls) == 1:
+                        raise KeyError(ply)
+                    return reportPosition(gs, ply)
+
+                Headless.reportPosition = failFirst
+                try:
+                    games = list(analyse(lines))
+                finally:
+                    Headless.reportPosition = reportPosition
+                self.assertEqual(len(games), 2)
+                self.assertTrue(games[0].error.startswith("unexpected KeyError"))
+                self.assertEqual((games[1].error, len(games[1].positions)), (None, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()